@@ -0,0 +1,91 @@
+"""
+Benchmark of message colorizing.
+
+Colorizes a mix of typical build output with the default colorizers, once by
+applying them one by one the way BlessingsStringFormatter used to and once
+with the compiled ColorizerEngine. A styling terminal is forced so that the
+escape sequences are really produced, even when the output is not a tty.
+
+Run with `python -m bench.colorize` from the root of the repository.
+
+"""
+
+import blessings
+
+from bench import utils
+from piper.logging import COLORIZERS
+from piper.logging import Colorizer
+from piper.logging import ColorizerEngine
+
+SAMPLES = (
+    'Collecting requests==2.7.0 (from -r requirements.txt (line 3))',
+    '  Downloading requests-2.7.0-py2.py3-none-any.whl (470kB)',
+    'test/test_build.py::TestBuildRun::test_all_steps_success PASSED',
+    'test/test_env.py::TestTempDirEnvSetup::test_worktree FAILED',
+    'gcc -O2 -Wall -Iinclude -c src/main.c -o build/main.o',
+    'In function main: warning: unused variable x [-Wunused-variable]',
+    'Error: could not find a version that satisfies the requirement',
+    'Build 3f2504e0-4f89-11d3-9a0c-0305e82c3301 started',
+    'PATH=/usr/local/bin:/usr/bin:/bin HOME=/root LANG=C.UTF-8',
+    '============ 123 passed, 2 skipped in 4.56 seconds ============',
+    'Installing collected packages: six, jsonschema, logbook, blessings',
+    'Successfully installed blessings-1.6 jsonschema-2.5.1 logbook-0.10.1',
+)
+
+
+def get_colorizers():
+    terminal = blessings.Terminal(kind='xterm-256color', force_styling=True)
+    ret = []
+    for colorizer in COLORIZERS:
+        colorizer = Colorizer(
+            colorizer.regexp.pattern,
+            colorizer.formatting[:-len('{t.normal}')],
+            colorizer.aborting,
+            colorizer.regexp.flags,
+        )
+        colorizer.terminal = terminal
+        ret.append(colorizer)
+
+    return tuple(ret)
+
+
+def generate_lines(lines=utils.LINES):
+    return [SAMPLES[x % len(SAMPLES)] for x in range(lines)]
+
+
+def sequential(colorizers, lines):
+    for message in lines:
+        for colorizer in colorizers:
+            done, message = colorizer.colorize(message)
+            if done and colorizer.aborting is True:
+                break
+
+
+def compiled(engine, lines):
+    for message in lines:
+        engine.colorize(message)
+
+
+def run(lines=utils.LINES, repeat=utils.REPEAT):
+    colorizers = get_colorizers()
+    engine = ColorizerEngine(colorizers)
+    lines = generate_lines(lines)
+
+    return utils.time_cases((
+        ('sequential', lambda: sequential(colorizers, lines)),
+        ('compiled', lambda: compiled(engine, lines)),
+    ), repeat)
+
+
+def main(argv=None):
+    ns = utils.get_parser(
+        'python -m bench.colorize', 'Benchmark message colorizing.',
+    ).parse_args(argv)
+
+    results = run(ns.count, ns.repeat)
+    utils.print_times(results, ns.count)
+    utils.print_speedup(results, 'sequential', 'compiled')
+
+
+if __name__ == '__main__':  # pragma: nocover
+    main()
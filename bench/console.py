@@ -0,0 +1,71 @@
+"""
+Benchmark of formatting console lines when stdout is not a terminal.
+
+Formats records of typical build output with the formatter that used to be
+installed on the console no matter what, BlessingsStringFormatter with all the
+colorizers, and with the PlainFormatter that is used when stdout is not a tty.
+The terminal is left as it is, so when run in a pipe the blessings formatter
+produces the same text, escape codes and all being empty.
+
+Run with `python -m bench.console | cat` from the root of the repository.
+
+"""
+
+import datetime
+import logbook
+import sys
+
+from bench import utils
+from bench.colorize import SAMPLES
+from piper.logging import COLORIZERS
+from piper.logging import BlessingsStringFormatter
+from piper.logging import PlainFormatter
+
+CHANNEL = 'Build 1a2b3c4 : test (2/3): py.test -v'
+
+
+def generate_records(lines=utils.LINES):
+    ret = []
+    for x in range(lines):
+        record = logbook.LogRecord(
+            CHANNEL, logbook.INFO, SAMPLES[x % len(SAMPLES)]
+        )
+        # Loggers stamp records as they handle them.
+        record.time = datetime.datetime.utcnow()
+        ret.append(record)
+
+    return ret
+
+
+def format_all(formatter, records):
+    handler = None
+    for record in records:
+        formatter(record, handler)
+
+
+def run(lines=utils.LINES, repeat=utils.REPEAT):
+    records = generate_records(lines)
+    blessings = BlessingsStringFormatter(colorizers=COLORIZERS)
+    plain = PlainFormatter()
+
+    return utils.time_cases((
+        ('blessings', lambda: format_all(blessings, records)),
+        ('plain', lambda: format_all(plain, records)),
+    ), repeat)
+
+
+def main(argv=None):
+    ns = utils.get_parser(
+        'python -m bench.console',
+        'Benchmark formatting console lines for output that is not a tty.',
+    ).parse_args(argv)
+
+    results = run(ns.count, ns.repeat)
+    utils.print_times(results, ns.count)
+    sys.stdout.write('saving: {0:.2f} us/line\n'.format(
+        (results['blessings'] - results['plain']) / ns.count * 1e6
+    ))
+
+
+if __name__ == '__main__':  # pragma: nocover
+    main()
@@ -0,0 +1,425 @@
+"""
+Benchmark suite of the logging hot path.
+
+Feeds synthetic step output through the parts of piper.logging that every
+line of output goes through, and reports lines per second and allocations
+for each of them:
+
+* `format_record`: BlessingsStringFormatter with all colorizers, on a styling
+  terminal.
+* `plain`: PlainFormatter, used when stdout is not a terminal and for files.
+* `json`: JSONFormatter, for JSON lines logs.
+* `colorize`: the colorizers alone, through a ColorizerEngine.
+* `colorizers`: the colorizers alone, applied one by one with
+  Colorizer.colorize.
+* `colorize_channel`: coloring of the channel names of steps and processes.
+
+The output is generated from a fixed seed, so every run sees the same lines:
+pytest output, compiler spam, long lines, lines full of UUIDs and lines full
+of paths.
+
+Every corpus is also run through a reference case, the plain
+logbook.StringFormatter, which is not part of piper. The `cost` of a case is
+how many times longer it takes than the reference on the same corpus, on the
+same machine in the same run, so that it can be compared between machines.
+
+Allocations are measured in a separate run under tracemalloc, since tracing
+slows everything down. `peak` is the most memory held at any point while
+formatting the corpus, and `blocks` is the number of memory blocks still
+allocated afterwards. They are only compared to baselines of the same number
+of lines.
+
+Results are compared to the baselines in `bench/baselines/formatting.json`.
+Run with `python -m bench.formatting` from the root of the repository; see
+`--help` for saving new baselines and for failing on regressions.
+
+"""
+
+import datetime
+import json
+import logbook
+import os
+import random
+import statistics
+import sys
+import tracemalloc
+import uuid
+
+from bench import utils
+from bench.colorize import get_colorizers
+from bench.colorize import sequential
+from piper.logging import DEFAULT_LOGFILE_FORMAT_STRING
+from piper.logging import BlessingsStringFormatter
+from piper.logging import ColorizerEngine
+from piper.logging import JSONFormatter
+from piper.logging import PlainFormatter
+
+import blessings
+
+LINES = 2000
+REPEAT = 5
+SEED = 1337
+BASELINES = os.path.join(os.path.dirname(__file__), 'baselines',
+                         'formatting.json')
+REFERENCE = 'reference'
+
+# Allocation changes below these are left out of checks. A few blocks of the
+# interpreter's own come and go between runs.
+MIN_PEAK_CHANGE = 4096
+MIN_BLOCKS_CHANGE = 10
+
+STEPS = ('lint', 'test', 'build', 'docs', 'package')
+COMMANDS = ('flake8', 'py.test -v', 'make -j4', 'sphinx-build', 'tox')
+
+
+def pytest_output(rnd, lines):
+    for x in range(lines):
+        module = rnd.choice(('build', 'env', 'logging', 'process', 'config'))
+        result = rnd.choice(('PASSED',) * 8 + ('FAILED', 'SKIPPED'))
+        yield 'test/test_{0}.py::Test{1}::test_case_{2} {3}'.format(
+            module, module.title(), x, result,
+        )
+
+
+def compiler_output(rnd, lines):
+    for x in range(lines):
+        name = 'src/module_{0}/file_{1}.c'.format(rnd.randrange(50), x)
+        if rnd.random() < 0.1:
+            yield '{0}:{1}:{2}: warning: unused variable tmp{3} ' \
+                  '[-Wunused-variable]'.format(name, x, rnd.randrange(80), x)
+        else:
+            yield 'gcc -O2 -Wall -Iinclude -DVERSION=1.{0} -c {1} ' \
+                  '-o build/{2}.o'.format(x, name, x)
+
+
+def long_lines(rnd, lines):
+    words = ('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'KEY=value', 'a/b')
+    for x in range(lines):
+        yield ' '.join(rnd.choice(words) for _ in range(400))
+
+
+def uuid_lines(rnd, lines):
+    for x in range(lines):
+        yield 'build {0} step {1} agent {2}'.format(
+            uuid.UUID(int=rnd.getrandbits(128)),
+            uuid.UUID(int=rnd.getrandbits(128)),
+            uuid.UUID(int=rnd.getrandbits(128)),
+        )
+
+
+def path_lines(rnd, lines):
+    for x in range(lines):
+        yield 'copying /usr/lib/python3/site-packages/pkg{0}/mod.py -> ' \
+              'build/lib/pkg{0}/mod.py'.format(x)
+
+
+CORPORA = (
+    ('pytest', pytest_output),
+    ('compiler', compiler_output),
+    ('long', long_lines),
+    ('uuids', uuid_lines),
+    ('paths', path_lines),
+)
+
+
+def generate(corpus, lines=LINES, seed=SEED):
+    """
+    Generate `lines` messages of one of the corpora.
+
+    """
+
+    rnd = random.Random(seed)
+    return list(dict(CORPORA)[corpus](rnd, lines))
+
+
+def make_records(messages):
+    ret = []
+    for x, message in enumerate(messages):
+        step = x % len(STEPS)
+        channel = 'Build 1a2b3c4 : {0} ({1}/{2}): {3}'.format(
+            STEPS[step], step + 1, len(STEPS), COMMANDS[step],
+        )
+
+        record = logbook.LogRecord(channel, logbook.INFO, message)
+        record.time = datetime.datetime.utcnow()
+        record.extra.update(step=STEPS[step], step_index=step + 1,
+                            command=COMMANDS[step])
+        ret.append(record)
+
+    return ret
+
+
+def get_styling_formatter():
+    formatter = BlessingsStringFormatter(colorizers=get_colorizers())
+    formatter.terminal = blessings.Terminal(
+        kind='xterm-256color', force_styling=True
+    )
+
+    return formatter
+
+
+def get_cases():
+    """
+    Return (name, function) of all cases. The functions take a list of fresh
+    records and process all of them.
+
+    """
+
+    def formatter_case(formatter):
+        def run(records):
+            for record in records:
+                formatter(record, None)
+        return run
+
+    def colorize(records):
+        for record in records:
+            engine.colorize(record.message)
+
+    def colorizers(records):
+        sequential(engine.colorizers, (record.message for record in records))
+
+    def colorize_channel(records):
+        for record in records:
+            styling.colorize_channel(record.channel)
+
+    engine = ColorizerEngine(get_colorizers())
+    styling = get_styling_formatter()
+
+    return (
+        (REFERENCE, formatter_case(
+            logbook.StringFormatter(DEFAULT_LOGFILE_FORMAT_STRING)
+        )),
+        ('format_record', formatter_case(get_styling_formatter())),
+        ('plain', formatter_case(PlainFormatter())),
+        ('json', formatter_case(JSONFormatter('1a2b3c4'))),
+        ('colorize', colorize),
+        ('colorizers', colorizers),
+        ('colorize_channel', colorize_channel),
+    )
+
+
+def measure(func, reference, messages, repeat=REPEAT):
+    """
+    Return the best lines per second of `repeat` runs, and the cost of them
+    compared to the reference.
+
+    Every run of the case is paired with a run of the reference right before
+    it, so that both see the machine in the same state; the cost is the
+    median of the pairs.
+
+    Records are made before every run, since formatting changes them.
+
+    """
+
+    def setup():
+        return make_records(messages)
+
+    times = []
+    costs = []
+    for _ in range(repeat):
+        base = utils.best_time(reference, 1, setup)
+        elapsed = utils.best_time(func, 1, setup)
+
+        times.append(elapsed)
+        costs.append(elapsed / base)
+
+    return len(messages) / min(times), statistics.median(costs)
+
+
+def measure_allocations(func, messages):
+    """
+    Return (peak bytes, blocks left) of running `func` once under tracemalloc.
+
+    """
+
+    records = make_records(messages)
+
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        func(records)
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+
+    finally:
+        tracemalloc.stop()
+
+    blocks = sum(
+        stat.count_diff for stat in after.compare_to(before, 'filename')
+    )
+    return peak, blocks
+
+
+def run(lines=LINES, repeat=REPEAT, allocations=True):
+    """
+    Run all cases on all corpora.
+
+    Returns a dict of `case/corpus` to a dict with `lines_per_sec` and
+    `cost`, and with `peak` and `blocks` when measuring allocations.
+
+    """
+
+    cases = dict(get_cases())
+    reference = cases.pop(REFERENCE)
+
+    ret = {}
+    for corpus, _ in CORPORA:
+        messages = generate(corpus, lines)
+
+        for case, func in sorted(cases.items()):
+            result = dict(zip(
+                ('lines_per_sec', 'cost'),
+                measure(func, reference, messages, repeat),
+            ))
+            if allocations:
+                result['peak'], result['blocks'] = measure_allocations(
+                    func, messages
+                )
+
+            ret['{0}/{1}'.format(case, corpus)] = result
+
+    return ret
+
+
+def load_baselines(filename=BASELINES):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_baselines(results, lines, filename=BASELINES):
+    data = {}
+    for key, result in results.items():
+        data[key] = {'cost': round(result['cost'], 3)}
+        if 'peak' in result:
+            data[key].update(
+                lines=lines, peak=result['peak'], blocks=result['blocks'],
+            )
+
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def compare(result, baseline, lines):
+    """
+    Return the relative changes of a result to its baseline, as a dict of
+    `cost`, `peak` and `blocks` to the change. Positive is worse. Allocation
+    changes smaller than the minimums are left out, and so are allocations
+    of a different number of lines than the baseline.
+
+    """
+
+    ret = {}
+    if baseline.get('cost'):
+        ret['cost'] = result['cost'] / baseline['cost'] - 1
+
+    if baseline.get('lines') != lines:
+        return ret
+
+    for key, minimum in (('peak', MIN_PEAK_CHANGE),
+                         ('blocks', MIN_BLOCKS_CHANGE)):
+        if key not in result or not baseline.get(key):
+            continue
+
+        value = result[key]
+        if abs(value - baseline[key]) >= minimum:
+            ret[key] = value / baseline[key] - 1
+
+    return ret
+
+
+def report(results, baselines, lines, out=sys.stdout):
+    """
+    Print the results as a table. Returns the changes to the baseline of
+    every result that has one; see :func:`compare`.
+
+    """
+
+    def change(changes, key):
+        if key not in changes:
+            return ''
+        return '{0:+.0%}'.format(changes[key])
+
+    ret = {}
+    out.write('{0:<28} {1:>12} {2:>6} {3:>6} {4:>10} {5:>6} {6:>8} '
+              '{7:>6}\n'.format(
+                  'case/corpus', 'lines/sec', 'cost', 'change', 'peak KiB',
+                  'change', 'blocks', 'change',
+              ))
+
+    for key in sorted(results):
+        result = results[key]
+        changes = ret[key] = compare(result, baselines.get(key, {}), lines)
+
+        peak = blocks = ''
+        if 'peak' in result:
+            peak = '{0:.1f}'.format(result['peak'] / 1024)
+            blocks = result['blocks']
+
+        out.write('{0:<28} {1:>12,.0f} {2:>6.2f} {3:>6} {4:>10} {5:>6} '
+                  '{6:>8} {7:>6}\n'.format(
+                      key, result['lines_per_sec'], result['cost'],
+                      change(changes, 'cost'), peak, change(changes, 'peak'),
+                      blocks, change(changes, 'blocks'),
+                  ))
+
+    return ret
+
+
+def build_parser():
+    parser = utils.get_parser(
+        'python -m bench.formatting',
+        'Benchmark the formatting of log lines.',
+        LINES, REPEAT,
+    )
+    parser.add_argument(
+        '--no-allocations', dest='allocations', action='store_false',
+        help='Skip measuring allocations',
+    )
+    parser.add_argument(
+        '--save', action='store_true',
+        help='Store the results as the new baselines',
+    )
+    parser.add_argument(
+        '--check', type=float, metavar='FRACTION',
+        help='Exit with 1 if the cost or the allocations of any case are '
+             'more than FRACTION over its baseline, e.g. 0.25',
+    )
+    parser.add_argument(
+        '--baselines', default=BASELINES,
+        help='Baseline file (default: %(default)s)',
+    )
+
+    return parser
+
+
+def main(argv=None):
+    ns = build_parser().parse_args(argv)
+
+    results = run(ns.count, ns.repeat, ns.allocations)
+    changes = report(results, load_baselines(ns.baselines), ns.count)
+
+    if ns.save:
+        save_baselines(results, ns.count, ns.baselines)
+        print("Baselines saved to '{0}'".format(ns.baselines))
+
+    if ns.check is not None:
+        worse = sorted(
+            '{0} ({1})'.format(key, what)
+            for key, change in changes.items()
+            for what, value in change.items()
+            if value > ns.check
+        )
+        if worse:
+            print('Worse than the baselines: {0}'.format(', '.join(worse)))
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':  # pragma: nocover
+    sys.exit(main())
@@ -0,0 +1,86 @@
+"""
+Helpers shared by the benchmarks.
+
+Every benchmark runs a few named cases on the same input, takes the best of
+`--repeat` runs of each and prints them next to each other.
+
+"""
+
+import argparse
+import sys
+import time
+
+LINES = 10000
+REPEAT = 5
+
+
+def best_time(func, repeat=REPEAT, setup=None):
+    """
+    Return the best time in seconds of `repeat` calls of `func`.
+
+    With `setup`, `func` is called with what `setup` returns, made anew for
+    every call and outside of the timing.
+
+    """
+
+    best = None
+    for _ in range(repeat):
+        args = () if setup is None else (setup(),)
+
+        start = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+
+def time_cases(cases, repeat=REPEAT):
+    """
+    Return a dict of the name to the best time of every (name, function).
+
+    """
+
+    return {name: best_time(func, repeat) for name, func in cases}
+
+
+def get_parser(prog, description, count=LINES, repeat=REPEAT, unit='lines'):
+    """
+    Return a parser of the options every benchmark has: the amount of input,
+    as `--<unit>`, and the number of runs.
+
+    """
+
+    parser = argparse.ArgumentParser(prog=prog, description=description)
+    parser.add_argument(
+        '--{0}'.format(unit), dest='count', type=int, default=count,
+        help='Number of {0} (default: %(default)s)'.format(unit),
+    )
+    parser.add_argument(
+        '--repeat', type=int, default=repeat,
+        help='Runs of every case, the best one counts '
+             '(default: %(default)s)',
+    )
+
+    return parser
+
+
+def print_times(results, count, unit='line', out=sys.stdout):
+    """
+    Print the best times of :func:`time_cases` for `count` units of input.
+
+    """
+
+    width = max(len(name) for name in results)
+    for name, best in sorted(results.items()):
+        out.write(
+            '{0:>{w}}: {1:8.2f} ms for {2} {3}s ({4:.2f} us/{3})\n'.format(
+                name, best * 1e3, count, unit, best / count * 1e6, w=width,
+            )
+        )
+
+
+def print_speedup(results, slow, fast, out=sys.stdout):
+    out.write('speedup: {0:.1f}x\n'.format(results[slow] / results[fast]))
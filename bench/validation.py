@@ -0,0 +1,64 @@
+"""
+Benchmark of step config validation.
+
+Generates a config with 500 steps and measures creating and validating all of
+them, the way Build.configure_steps does. The `uncached` numbers clear the
+compiled schema cache before every step, which is what every step used to
+cost before schemas were compiled once per class.
+
+Run with `python -m bench.validation` from the root of the repository.
+
+"""
+
+from bench import utils
+from piper.abc import DynamicItem
+from piper.step import CommandLineStep
+
+STEPS = 500
+
+
+def generate_config(steps=STEPS):
+    return {
+        'step-{0}'.format(x): {
+            'class': 'piper.step.CommandLineStep',
+            'command': 'make target-{0}'.format(x),
+            'requirements': None,
+            'needs': ['step-{0}'.format(x - 1)] if x else [],
+        }
+        for x in range(steps)
+    }
+
+
+def configure(config, cached=True):
+    build = None
+    for key, step_config in config.items():
+        if not cached:
+            DynamicItem._compiled.clear()
+
+        step = CommandLineStep(build, dict(step_config), key)
+        step.validate()
+
+
+def run(steps=STEPS, repeat=utils.REPEAT):
+    config = generate_config(steps)
+
+    return utils.time_cases((
+        ('uncached', lambda: configure(config, False)),
+        ('cached', lambda: configure(config, True)),
+    ), repeat)
+
+
+def main(argv=None):
+    parser = utils.get_parser(
+        'python -m bench.validation', 'Benchmark step config validation.',
+        count=STEPS, unit='steps',
+    )
+    ns = parser.parse_args(argv)
+
+    results = run(ns.count, ns.repeat)
+    utils.print_times(results, ns.count, 'step')
+    utils.print_speedup(results, 'uncached', 'cached')
+
+
+if __name__ == '__main__':  # pragma: nocover
+    main()
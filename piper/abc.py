@@ -1,5 +1,6 @@
 import logbook
 import jsonschema
+import jsonschema.validators
 
 
 class DynamicItem:
@@ -12,11 +13,16 @@ class DynamicItem:
 
     """
 
+    # The final schema of every class and the compiled validator for it,
+    # keyed by class. See :func:`compile`.
+    _compiled = {}
+
     def __init__(self, build, config):
         self.build = build
         self.config = config
 
         self.log = logbook.Logger(self.__class__.__name__)
+        self._schema, self.validator = self.compile()
 
         # Set missing optional keys to None or default values
         for k in set(self.schema['properties']) - set(self.schema['required']):
@@ -46,8 +52,28 @@ class DynamicItem:
 
         return self._schema
 
+    def compile(self):
+        """
+        Return the final schema of this class and a validator for it.
+
+        The `schema` properties of the subclasses build on top of each other,
+        which is too slow to do for every single instance. The schema is
+        built and checked against its metaschema once per class, and every
+        instance after that gets the cached schema and validator.
+
+        """
+
+        cls = self.__class__
+        if cls not in DynamicItem._compiled:
+            schema = self.schema
+            validator = jsonschema.validators.validator_for(schema)
+            validator.check_schema(schema)
+            DynamicItem._compiled[cls] = schema, validator(schema)
+
+        return DynamicItem._compiled[cls]
+
     def validate(self):
-        jsonschema.validate(self.config, self.schema)
+        self.validator.validate(self.config)
 
     def validate_requirements(self):
         """
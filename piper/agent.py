@@ -1,19 +1,33 @@
-import contextlib
 import json
 import logbook
+import multiprocessing
+import os
+import threading
+import time
 
+from piper import logging
 from piper.api import RESTful
 from piper.build import Build
 from piper.config import AgentConfig
 from piper.config import BuildConfig
 from piper.db.core import LazyDatabaseMixin
+from piper.utils import mkdir
 from piper.utils import oneshot
 
+from xdg import BaseDirectory
+
 
 class Agent(LazyDatabaseMixin):
     """
     Listener endpoint that recieves requests and executes them
 
+    The agent runs up to `slots` builds at the same time, each in a worker
+    process of its own, and only takes on a request while it has a free
+    slot. `building` holds the ids of the builds running in the slots.
+
+    The state of the agent is sent to the database by a thread of its own;
+    see :func:`update`.
+
     """
 
     FIELDS_TO_DB = (
@@ -35,8 +49,17 @@ class Agent(LazyDatabaseMixin):
         self.config = config
 
         self.id = config.raw['agent']['id']
-        self.building = None
-        self._properties = None
+        self.debug = False
+        self.slots = config.raw['agent'].get('slots', 1)
+        self.building = set()
+        self.slot_freed = threading.Condition()
+        self.update_needed = threading.Condition()
+        self.pending = False
+        self.updater = None
+        self.facts = Facts(
+            config.raw['agent'].get('facts_ttl', Facts.ttl),
+            on_refresh=self.refreshed,
+        )
 
         self.log = logbook.Logger(self.id)
 
@@ -56,13 +79,26 @@ class Agent(LazyDatabaseMixin):
         self.log.info('Opening changes() feed from database...')
 
         try:
-            for change in self.db.build.feed():
+            for change in self.db.build.feed(filter=self.eligible):
+                self.wait_for_slot()
                 self.handle(change)
 
         except KeyboardInterrupt:  # pragma: nocover
             print()
             self.log.info('Kill signal recieved. Exiting.')
 
+    def eligible(self, build):
+        """
+        Filter of the builds this agent can take, for the build feed.
+
+        Builds that list `eligible_agents` are only for the agents listed;
+        others are for anyone.
+
+        """
+
+        agents = build['config']['eligible_agents'].default(None)
+        return agents.eq(None).or_(agents.contains(self.id))
+
     def handle(self, change):
         """
         Handle a changeset from Rethink.
@@ -73,6 +109,8 @@ class Agent(LazyDatabaseMixin):
         * The build has been deleted.
         * This agent ID is not present in the `eligible_agents` list.
         * The build is already started by another agent.
+        * Another agent claims the build first; see
+          :func:`piper.db.core.BuildManager.claim`.
 
         By default the changes are squashed and only the latest state of the
         changeset is sent to this function. See the
@@ -99,82 +137,374 @@ class Agent(LazyDatabaseMixin):
         #     self.log.info('Not able to build. Doing nothing.')
         #     return
 
-        if config.get('started') is not None:
+        # Changes of builds that are running are not worth a claim.
+        if change['new_val'].get('started') is not None:
             self.log.info('Build already started. Doing nothing.')
             return
 
+        if not self.db.build.claim(id, self.id):
+            self.log.info('Build claimed by another agent. Doing nothing.')
+            return
+
         return self.build(id, config)
 
     def build(self, id, config):
         """
-        Run a build of a configuration.
+        Start a build of a configuration in a free slot.
+
+        The build runs in a worker process of its own, so that builds cannot
+        get in the way of each other or of the agent. A thread waits for the
+        worker to exit and frees the slot. Returns the worker.
+
+        Workers are spawned rather than forked. The agent runs the updater,
+        the reapers, facter and the log writers in threads, and a fork could
+        copy a lock that one of them holds, never to be released.
+
+        The build ships its log to the database of the agent.
 
         """
 
-        with self.busy(id):
-            # Set the config as being built by this agent.
-            # config['agent'] = self
+        self.lock(id)
+        config = dict(config, db=self.config.raw['db'])
 
-            config = BuildConfig(raw=config).load()
-            self.log.info('Starting build...')
+        worker = multiprocessing.get_context('spawn').Process(
+            target=run_build, args=(id, config, self.debug),
+            name='build {0}'.format(id),
+        )
+        worker.start()
 
-            build = Build(config)
-            ret = build.run()
+        reaper = threading.Thread(
+            target=self.reap, args=(id, worker),
+            name='reaper {0}'.format(id),
+        )
+        reaper.daemon = True
+        reaper.start()
 
-            self.log.debug('Build returned {0}'.format(ret))
+        return worker
+
+    def reap(self, id, worker):
+        """
+        Wait for the worker of a build to exit and free its slot.
+
+        """
+
+        try:
+            worker.join()
+            if worker.exitcode != 0:
+                self.log.error('Build worker {0} exited with {1}'.format(
+                    id, worker.exitcode
+                ))
+
+        finally:
+            self.unlock(id)
 
     def update(self):
         """
         Update state of the agent in the database
 
+        Slots are freed by the reaper threads and facts come in from the
+        facter thread, while the main thread reads the build feed. A database
+        connection is not to be shared between threads, so the state is sent
+        by an updater thread on a connection of its own, and this only wakes
+        it up. Updates that come in while it is busy are sent as one, with
+        the latest state.
+
+        """
+
+        with self.update_needed:
+            if self.updater is None:
+                self.updater = threading.Thread(
+                    target=self.send_updates, name='agent updater'
+                )
+                self.updater.daemon = True
+                self.updater.start()
+
+            self.pending = True
+            self.update_needed.notify()
+
+    def send_updates(self):
+        """
+        Send the state of the agent whenever :func:`update` asks for it.
+        The target of the updater thread.
+
+        """
+
+        manager = self.connect_agent_db()
+
+        while True:
+            with self.update_needed:
+                while not self.pending:
+                    self.update_needed.wait()
+                self.pending = False
+
+            try:
+                with self.slot_freed:
+                    data = self.as_dict()
+                manager.update(data)
+
+            except Exception:
+                self.log.exception('Could not update the agent')
+
+    def connect_agent_db(self):
         """
+        Get an agent manager on a connection of its own, for the updater.
 
-        data = self.as_dict()
-        self.db.agent.update(data)
+        """
+
+        db = self.config.get_database()
+        db.setup(self.config)
+        return db.agent
 
     @property
     def properties(self):
         """
-        Grab system properties for the agent. Will be cached once it's ran.
+        System properties of the agent, as facter facts. See :class:`Facts`.
 
-        :returns: Dictionary of system values
+        :returns: Dictionary of system values, empty until facter has run
+                  for the first time
 
         """
 
-        if self._properties is None:
-            self.log.info('Grabbing fresh facter facts')
-            facter = oneshot('facter --json')
-            data = json.loads(facter)
+        return self.facts.get() or {}
 
-            self._properties = data
+    def refreshed(self, facts):
+        """
+        Send fresh facts to the database.
 
-        return self._properties
+        """
+
+        self.log.info('Facter facts refreshed')
+        self.update()
 
     @property
     def raw(self):  # pragma: nocover
         return self.id
 
-    @contextlib.contextmanager
-    def busy(self, id):
+    def as_dict(self):
+        ret = super(Agent, self).as_dict()
+        ret['building'] = sorted(ret['building'])
+
+        return ret
+
+    def busy(self):
         """
-        Context locker that sets and resets the `building` attribute.
+        Return whether all build slots are taken.
 
         """
 
-        self.building = id
-        self.log.info('Locking for build {0}'.format(id))
-        self.update()
+        return len(self.building) >= self.slots
+
+    def wait_for_slot(self):
+        """
+        Wait until there is a free build slot.
+
+        """
+
+        with self.slot_freed:
+            if self.busy():
+                self.log.info('All {0} slots busy. Waiting...'.format(
+                    self.slots
+                ))
+
+            while self.busy():
+                self.slot_freed.wait()
+
+    def lock(self, id):
+        """
+        Take a build slot for a build.
+
+        """
+
+        with self.slot_freed:
+            self.building.add(id)
+            self.log.info('Locking for build {0}'.format(id))
+            self.update()
+
+    def unlock(self, id):
+        """
+        Free the build slot of a build.
+
+        """
+
+        with self.slot_freed:
+            self.building.discard(id)
+            self.log.info('Unlocking from build {0}'.format(id))
+            self.update()
+            self.slot_freed.notify_all()
+
+
+class Facts:
+    """
+    Facter facts of the host, cached on disk.
+
+    Facter takes a while, so the facts are kept in `piper/facts.json` in the
+    XDG cache dir and only refreshed when they are older than `ttl` seconds.
+    The refresh runs in a thread of its own. Until it is done the facts at
+    hand are served as they are, even when stale or not there at all, so
+    that nothing ever waits for facter. `on_refresh` is called with the new
+    facts when a refresh is done.
+
+    After a failed refresh, the next one waits `retry` seconds, or `ttl` if
+    that is shorter.
+
+    """
+
+    ttl = 3600
+    retry = 300
+
+    def __init__(self, ttl=None, path=None, on_refresh=None):
+        if ttl is not None:
+            self.ttl = ttl
+
+        if path is None:
+            path = os.path.join(
+                BaseDirectory.xdg_cache_home, 'piper', 'facts.json'
+            )
+
+        self.path = path
+        self.on_refresh = on_refresh
+
+        self.data = None
+        self.fetched = None
+        self.failed = None
+        self.refreshing = None
+        self.lock = threading.Lock()
+
+        self.log = logbook.Logger(self.__class__.__name__)
+
+    def get(self):
+        """
+        Return the facts at hand, or None if there are none yet. Starts a
+        refresh if they are stale.
+
+        """
+
+        with self.lock:
+            if self.data is None:
+                self.load()
+
+            if self.stale() and not self.backing_off() and \
+                    self.refreshing is None:
+                self.refreshing = threading.Thread(
+                    target=self.refresh, name='facter'
+                )
+                self.refreshing.daemon = True
+                self.refreshing.start()
+
+            return self.data
+
+    def stale(self):
+        return self.fetched is None or time.time() - self.fetched >= self.ttl
+
+    def backing_off(self):
+        return self.failed is not None and \
+            time.time() - self.failed < min(self.retry, self.ttl)
+
+    def load(self):
+        """
+        Load the facts from the cache file, if there is a readable one.
+
+        """
+
+        try:
+            with open(self.path) as f:
+                self.data = json.load(f)
+            self.fetched = os.path.getmtime(self.path)
+
+        except (OSError, ValueError):
+            pass
+
+    def save(self, data):
+        """
+        Write the facts to the cache file.
+
+        The file is replaced in one go, so that it is never seen half
+        written.
+
+        """
+
+        tmp = '{0}.{1}'.format(self.path, os.getpid())
 
         try:
-            yield
+            mkdir(os.path.dirname(self.path))
+            with open(tmp, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp, self.path)
+
+        except OSError as exc:
+            self.log.warn('Could not cache facter facts: {0}'.format(exc))
+
+    def refresh(self):
+        """
+        Run facter and cache its facts.
+
+        """
+
+        try:
+            self.log.info('Grabbing fresh facter facts')
+            data = json.loads(oneshot('facter --json'))
+            self.save(data)
+
+            with self.lock:
+                self.data = data
+                self.fetched = time.time()
+                self.failed = None
 
         except Exception:
-            self.log.exception('Build threw internal exception')
+            self.log.exception('Grabbing facter facts failed')
+            with self.lock:
+                self.failed = time.time()
+            return
 
         finally:
-            self.building = None
-            self.log.info('Unlocking from build {0}'.format(id))
-            self.update()
+            with self.lock:
+                self.refreshing = None
+
+        if self.on_refresh is not None:
+            self.on_refresh(data)
+
+
+def run_build(id, config, debug=False):
+    """
+    Run a build of a configuration. The target of the worker processes of
+    :class:`Agent`.
+
+    The worker is a fresh interpreter, without the log handlers of the agent,
+    so it logs to a console handler and a session log of its own.
+
+    """
+
+    handlers = logging.get_handlers(debug, 'build-{0}'.format(id))
+    for handler in handlers:
+        handler.push_application()
+
+    log = logbook.Logger('build {0}'.format(id))
+
+    try:
+        # Set the config as being built by this agent.
+        # config['agent'] = self
+
+        config = BuildConfig(raw=config).load()
+        log.info('Starting build...')
+
+        build = Build(config)
+        build.id = id
+        ret = build.run(
+            config.raw.get('pipeline', 'build'),
+            config.raw.get('env', 'local'),
+        )
+
+        log.debug('Build returned {0}'.format(ret))
+        return ret
+
+    except Exception:
+        log.exception('Build threw internal exception')
+        raise SystemExit(1)
+
+    finally:
+        for handler in reversed(handlers):
+            handler.pop_application()
+            handler.close()
 
 
 class AgentCLI(LazyDatabaseMixin):
@@ -199,6 +529,7 @@ class AgentCLI(LazyDatabaseMixin):
 
     def run(self, ns):
         if ns.agent_command in (None, 'start'):
+            self.agent.debug = ns.verbose
             self.log.info('Starting agent')
             self.agent.listen()
 
@@ -1,11 +1,20 @@
 import ago
+import collections
+import contextlib
 import logbook
+import os
 import requests
+import time
+
+from concurrent import futures
 
 from piper import config
 from piper import logging
+from piper import process
 from piper import utils
 from piper.api import RESTful
+from piper.cache import StepCache
+from piper.trace import Tracer
 from piper.db.core import LazyDatabaseMixin
 from piper.vcs import GitVCS
 
@@ -38,6 +47,10 @@ class Build(LazyDatabaseMixin):
         'started',
         'ended',
         'created',
+
+        # Bulk data
+        'timings',
+        'rusage',
     )
 
     def __init__(self, config):
@@ -53,9 +66,16 @@ class Build(LazyDatabaseMixin):
         self.success = None
         self.crashed = False
         self.status = None
+        self.timings = []
+        self.rusage = {}
+        self.clock = None
+        self.tracer = None
 
         self.pipeline = None
         self.env = None
+        self.cache = StepCache()
+        self.log_handler = None
+        self.db_log_handler = None
 
         self.log = logbook.Logger(self.__class__.__name__)
 
@@ -66,6 +86,9 @@ class Build(LazyDatabaseMixin):
         This is run when starting the script from the command line.
         Returns boolean success.
 
+        The log handlers are closed even if the build crashes, so that the
+        last of the log, which explains the crash, is written.
+
         """
 
         self.pipeline = pipeline
@@ -73,11 +96,21 @@ class Build(LazyDatabaseMixin):
 
         self.log.info('Setting up {0}...'.format(self.pipeline))
         self.started = utils.now()
+        self.clock = time.monotonic()
+
+        try:
+            self.setup()
+            self.execute()
+            self.teardown()
+            self.finish()
 
-        self.setup()
-        self.execute()
-        self.teardown()
-        self.finish()
+        except Exception:
+            self.crashed = True
+            self.log.exception('Build crashed.')
+            raise
+
+        finally:
+            self.close_logs()
 
         return self.success
 
@@ -94,8 +127,112 @@ class Build(LazyDatabaseMixin):
             past_tense='%s {0}' % verb  # hee hee
         )
         self.log.info('{0} {1}'.format(self.version, ts))
+        self.log_timings()
+        self.log_rusage()
+
+    def close_logs(self):
+        """
+        Pop the log handlers of the build and write whatever they still have
+        queued.
+
+        """
+
+        for handler in (self.db_log_handler, self.log_handler):
+            if handler is not None:
+                handler.pop_application()
+                handler.close()
+
+    @contextlib.contextmanager
+    def timer(self, name, kind='phase'):
+        """
+        Measure the time spent inside of the block and add it to `timings`.
+
+        The start of each timing is in seconds since the build started.
+        Monotonic time is used, so the timings are unaffected by changes to
+        the system clock during the build.
+
+        """
+
+        start = time.monotonic()
+        if self.clock is None:
+            self.clock = start
+
+        try:
+            yield
+
+        finally:
+            duration = time.monotonic() - start
+            self.timings.append({
+                'name': name,
+                'type': kind,
+                'start': start - self.clock,
+                'duration': duration,
+            })
+
+            if self.tracer is not None:
+                self.tracer.complete(name, kind, start, duration)
+
+    def log_timings(self):
+        """
+        Log a summary table of where the time of the build was spent.
 
-        self.log_handler.pop_application()
+        """
+
+        if not self.timings:
+            return
+
+        width = max(len(t['name']) for t in self.timings) + 2
+        row = '{0:<5} {1:<{width}} {2:>9} {3:>9}'
+
+        self.log.info('Timings:')
+        self.log.info(
+            row.format('type', 'name', 'start', 'duration', width=width)
+        )
+
+        for t in sorted(self.timings, key=lambda t: t['start']):
+            self.log.info(row.format(
+                t['type'],
+                t['name'],
+                '{0:.3f}s'.format(t['start']),
+                '{0:.3f}s'.format(t['duration']),
+                width=width,
+            ))
+
+    def log_rusage(self):
+        """
+        Log a summary table of the resources used by the process of every
+        step that ran one.
+
+        """
+
+        if not self.rusage:
+            return
+
+        width = max(len(key) for key in self.rusage) + 2
+        row = '{0:<{width}} {1:>9} {2:>9} {3:>9} {4:>9} {5:>9} {6:>9} {7:>9}'
+
+        self.log.info('Resources:')
+        self.log.info(row.format(
+            'step', 'user', 'system', 'max rss', 'blk in', 'blk out',
+            'vol csw', 'inv csw', width=width,
+        ))
+
+        for step in self.order:
+            usage = self.rusage.get(step.key)
+            if usage is None:
+                continue
+
+            self.log.info(row.format(
+                step.key,
+                '{0:.3f}s'.format(usage['user']),
+                '{0:.3f}s'.format(usage['system']),
+                '{0:.1f}M'.format(usage['max_rss'] / 2 ** 20),
+                usage['blocks_in'],
+                usage['blocks_out'],
+                usage['voluntary_switches'],
+                usage['involuntary_switches'],
+                width=width,
+            ))
 
     def setup(self):
         """
@@ -108,13 +245,19 @@ class Build(LazyDatabaseMixin):
 
         # self.add_build()
         self.set_logfile()
-        self.set_version()
 
-        self.configure_env()
-        self.configure_steps()
-        self.configure_pipeline()
+        with self.timer('set_version'):
+            self.set_version()
 
-        self.setup_env()
+        with self.timer('configure_env'):
+            self.configure_env()
+        with self.timer('configure_steps'):
+            self.configure_steps()
+        with self.timer('configure_pipeline'):
+            self.configure_pipeline()
+
+        with self.timer('setup_env'):
+            self.setup_env()
 
     def queue(self, pipeline, env):
         """
@@ -130,7 +273,9 @@ class Build(LazyDatabaseMixin):
 
         url = '{0}/builds/'.format(app_conf['masters'][0])
 
-        requests.post(url, json=self.config.raw)
+        requests.post(
+            url, json=dict(self.config.raw, pipeline=pipeline, env=env)
+        )
 
     def set_logfile(self):
         """
@@ -144,10 +289,39 @@ class Build(LazyDatabaseMixin):
         )
         self.log = logbook.Logger(self.log_key)
 
-        self.logfile = 'logs/piper/{0}.log'.format(self.id)
-        self.log_handler = logging.get_file_logger(self.logfile)
+        compression = self.config.raw.get('log_compression')
+        format = self.config.raw.get('log_format', 'text')
+        extension = 'jsonl' if format == 'json' else 'log'
+
+        self.log_handler = logging.get_file_logger(
+            'logs/piper/{0}.{1}'.format(self.id, extension),
+            compression=compression,
+            format=format,
+            build_id=self.id,
+        )
+        self.logfile = self.log_handler.filename
         self.log_handler.push_application()
 
+        # Builds that come from the database ship their logs back to it.
+        if self.id is not None and 'db' in self.config.raw:
+            self.db_log_handler = logging.DatabaseHandler(
+                self.connect_log_db,
+                self.id,
+                'logs/piper/{0}.spill'.format(self.id),
+                level=self.log_handler.level,
+            )
+            self.db_log_handler.push_application()
+
+    def connect_log_db(self):
+        """
+        Get a log manager on a connection of its own, for the log shipper.
+
+        """
+
+        db = self.config.get_database()
+        db.setup(self.config)
+        return db.logs
+
     def set_version(self):
         """
         Set the version for this pipeline
@@ -179,11 +353,16 @@ class Build(LazyDatabaseMixin):
 
     def configure_steps(self):
         """
-        Configures the steps according to their config sections.
+        Configures the steps of the pipeline according to their config
+        sections.
+
+        Steps that are not in the pipeline are left alone, so that their
+        classes never need to be imported.
 
         """
 
-        for step_key, step_config in self.config.raw['steps'].items():
+        for step_key in self.config.raw['pipelines'][self.pipeline]:
+            step_config = self.config.raw['steps'][step_key]
             cls = self.config.classes[step_config['class']]
 
             step = cls(self, step_config, step_key)
@@ -202,9 +381,62 @@ class Build(LazyDatabaseMixin):
             step = self.steps[step_key]
             self.order.append(step)
 
+        # Build the graph once here so that broken `needs` are reported
+        # before the env is set up.
+        self.get_graph()
+
         self.log.debug('Step order configured.')
         self.log.info('Steps: ' + ', '.join(map(repr, self.order)))
 
+    def get_graph(self):
+        """
+        Return an ordered mapping of step to the steps it needs to wait for.
+
+        Steps that do not declare `needs` wait for the step before them in the
+        pipeline, so a pipeline without any `needs` runs in strict order just
+        like it always has.
+
+        """
+
+        keys = {step.key: step for step in self.order}
+        graph = collections.OrderedDict()
+
+        previous = None
+        for step in self.order:
+            if step.needs is None:
+                needs = (previous,) if previous is not None else ()
+            else:
+                missing = [key for key in step.needs if key not in keys]
+                if missing:
+                    raise config.ConfigError(
+                        "Step '{0}' needs {1}, which are not in the '{2}' "
+                        "pipeline.".format(
+                            step.key, ', '.join(missing), self.pipeline
+                        )
+                    )
+                needs = tuple(keys[key] for key in step.needs)
+
+            graph[step] = needs
+            previous = step
+
+        # Walk the graph the same way execute() does to make sure that every
+        # step can actually be reached.
+        done = set()
+        while len(done) < len(graph):
+            ready = [
+                step for step, needs in graph.items()
+                if step not in done and done.issuperset(needs)
+            ]
+            if not ready:
+                raise config.ConfigError(
+                    'Circular `needs` between steps: {0}'.format(
+                        ', '.join(s.key for s in graph if s not in done)
+                    )
+                )
+            done.update(ready)
+
+        return graph
+
     def setup_env(self):
         """
         Execute setup steps of the env
@@ -218,41 +450,225 @@ class Build(LazyDatabaseMixin):
         """
         Runs the steps and determines whether to continue or not.
 
+        Steps are started as soon as all the steps they need are done, with
+        at most `jobs` of them running at the same time. The first failing
+        step stops any further steps from being started, and interrupts the
+        processes of the steps that are still running.
+
         Of all the things to happen in this application, this is probably
         the most important part!
 
         """
 
+        graph = self.get_graph()
         total = len(self.order)
         self.log.info('Running {0}...'.format(self.pipeline))
 
         for x, step in enumerate(self.order, start=1):
             step.set_index(x, total)
 
-            # Update db status to show that we are running this build
-            self.status = '{0}/{1}: {2}'.format(x, total, step.key)
-            # self.db.build.update(self)
-
-            step.log.info('Running...')
-            proc = self.env.execute(step)
-
-            if proc.success:
-                step.log.info('Step complete.')
-            else:
-                # If the success is not positive, bail and stop running.
-                step.log.error('Step failed.')
-                self.log.error('{0} failed.'.format(self.pipeline))
-                self.success = False
-                break
+        if self.jobs > 1 and total > 1:
+            self.share_build_log()
+
+        pending = collections.OrderedDict(graph)
+        done = set()
+        running = {}
+
+        with futures.ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            while pending or running:
+                # Fill up the free slots with steps that are ready to go,
+                # unless something has already failed.
+                for step, needs in list(pending.items()):
+                    if self.success is False or len(running) >= self.jobs:
+                        break
+
+                    if done.issuperset(needs):
+                        del pending[step]
+                        running[pool.submit(self.execute_step, step)] = step
+
+                if not running:
+                    break
+
+                # Update db status to show what we are running right now
+                self.status = ', '.join(
+                    '{0}/{1}: {2}'.format(
+                        self.order.index(s) + 1, total, s.key
+                    )
+                    for s in running.values()
+                )
+                # self.db.build.update(self)
+
+                try:
+                    finished, _ = futures.wait(
+                        running, return_when=futures.FIRST_COMPLETED
+                    )
+
+                except KeyboardInterrupt:
+                    # Steps with timeouts run in sessions of their own and
+                    # did not get the Ctrl-C. The pool waits for all steps
+                    # to exit before this goes any further.
+                    self.log.warning('Interrupted. Stopping steps...')
+                    process.interrupt_sessions()
+                    self.success = False
+                    raise
+
+                for future in finished:
+                    step = running.pop(future)
+                    if future.result():
+                        done.add(step)
+                    elif self.success is not False:
+                        # If the success is not positive, bail and stop
+                        # running.
+                        self.log.error('{0} failed.'.format(self.pipeline))
+                        self.success = False
+
+                        if running:
+                            self.log.warning('Stopping running steps...')
+                            process.interrupt_processes()
 
         self.status = ''
-        # As long as we did not break out of the loop above, the build is
-        # to be deemed successful.
+        # As long as no step failed above, the build is to be deemed
+        # successful.
         if self.success is not False:
             self.success = True
 
+    def share_build_log(self):
+        """
+        Switch steps with direct output to bulk output, since other steps may
+        be writing to the build log at the same time.
+
+        The processes of direct steps write to the build log file themselves,
+        only atomically per write, and their samples, tails and idle timeouts
+        come from the file. See :class:`piper.process.DirectOutput`.
+
+        """
+
+        for step in self.order:
+            output = step.output or {}
+            if output.get('mode') == 'direct':
+                step.log.warning(
+                    'Steps may run at the same time. Using bulk output '
+                    'instead of direct.'
+                )
+                step.config['output'] = dict(output, mode='bulk')
+
+    def execute_step(self, step):
+        """
+        Execute a single step, from the cache if possible.
+
+        """
+
+        context = logging.context(step=step.key, step_index=step.index[0])
+        with self.timer(step.key, 'step'), context.threadbound():
+            if step.cache is not None:
+                if self.cacheable(step):
+                    return self.execute_cached_step(step)
+
+                step.log.warning(
+                    'Not caching the step; its output is not logged in full.'
+                )
+
+            return self.run_step(step)
+
+    def run_step(self, step):
+        """
+        Run a single step in the env and return its boolean success.
+
+        """
+
+        step.log.info('Running...')
+        proc = self.env.execute(step)
+        self.trace_process(proc, step=step.key)
+
+        step.rusage = proc.rusage
+        if proc.rusage is not None:
+            self.rusage[step.key] = proc.rusage
+
+        if proc.success:
+            step.log.info('Step complete.')
+            return True
+
+        step.log.error('Step failed.')
+        return False
+
+    def cacheable(self, step):
+        """
+        Return whether the result of a step can be cached.
+
+        In bulk and direct output mode only samples of the output are
+        logged, so that is all the cache would have to replay.
+
+        """
+
+        mode = (step.output or {}).get('mode')
+        return mode not in ('bulk', 'direct')
+
+    def execute_cached_step(self, step):
+        """
+        Run a step that has caching enabled.
+
+        If the cache has a result for the step, its log is replayed and the
+        step is successful without running anything. Otherwise the step is
+        run and its log is stored if it succeeds.
+
+        """
+
+        key = self.cache.key(step, self.env)
+        records = self.cache.get(key)
+
+        if records is not None:
+            step.log.info('Unchanged since {0}. Replaying log...'.format(
+                key[:7]
+            ))
+            self.cache.replay(step, records)
+            step.log.info('Step complete (cached).')
+            return True
+
+        with self.cache.capture(step) as records:
+            success = self.run_step(step)
+
+        if success:
+            self.cache.put(key, records)
+
+        return success
+
+    def trace_process(self, proc, **args):
+        """
+        Add a process that ran for the build to the trace, if there is one.
+        Steps and envs both call this for their processes, with `args` saying
+        what the process was for.
+
+        The process gets a track of its own, named after its pid and command.
+
+        """
+
+        if self.tracer is None or proc.popen is None:
+            return
+
+        pid = proc.popen.pid
+        self.tracer.name_process(pid, '{0} {1}'.format(pid, proc.cmd))
+        self.tracer.complete(
+            proc.cmd,
+            'process',
+            proc.started,
+            proc.ended - proc.started,
+            pid=pid,
+            tid=pid,
+            args=dict(args, exitcode=proc.popen.returncode),
+        )
+
+    @property
+    def jobs(self):
+        """
+        The maximum number of steps allowed to run at the same time.
+
+        """
+
+        return self.config.raw.get('jobs') or os.cpu_count() or 1
+
     def teardown(self):
-        self.teardown_env()
+        with self.timer('teardown_env'):
+            self.teardown_env()
 
     def teardown_env(self):
         """
@@ -287,10 +703,25 @@ class ExecCLI:
             help='The environment to execute in',
         )
 
+        cli.add_argument(
+            '--trace',
+            metavar='FILE',
+            help='Write a Chrome trace-event profile of the build to FILE',
+        )
+
         return 'exec', self.run
 
     def run(self, ns):
-        success = Build(self.config).run(ns.pipeline, ns.env)
+        build = Build(self.config)
+        if ns.trace:
+            build.tracer = Tracer(ns.trace)
+
+        try:
+            success = build.run(ns.pipeline, ns.env)
+
+        finally:
+            if build.tracer is not None:
+                build.tracer.write()
 
         return 0 if success else 1
 
@@ -0,0 +1,198 @@
+import contextlib
+import glob
+import hashlib
+import json
+import logbook
+import os
+
+from xdg import BaseDirectory
+from piper.logging import SEPARATOR
+
+
+class StepCache:
+    """
+    On-disk cache of the results of successful steps.
+
+    Steps opt in to caching by setting `cache` in their configuration. The
+    cache key is a hash of everything that decides what the step does: its
+    configuration, its command, the class of the env it runs in and the
+    contents of the input paths it declares. If nothing of that has changed
+    since the step last succeeded, the stored log is replayed instead of
+    running the step again.
+
+    Relative input paths are relative to the directory the step runs in,
+    the `cwd` of the env if it has one.
+
+    """
+
+    def __init__(self, path=None):
+        self._path = path
+
+        self.log = logbook.Logger(self.__class__.__name__)
+
+    @property
+    def path(self):
+        """
+        The directory the cache lives in. Created on first access.
+
+        """
+
+        if self._path is None:
+            self._path = BaseDirectory.save_cache_path('piper', 'steps')
+
+        return self._path
+
+    def key(self, step, env):
+        """
+        Calculate the cache key for running `step` inside of `env`.
+
+        """
+
+        env_cls = env.__class__
+        data = {
+            'config': step.config,
+            'command': step.get_command(),
+            'env': '{0}.{1}'.format(env_cls.__module__, env_cls.__name__),
+        }
+
+        sha = hashlib.sha256()
+        sha.update(json.dumps(data, sort_keys=True, default=str).encode())
+
+        root = getattr(env, 'cwd', None) or os.getcwd()
+        inputs = step.cache.get('inputs') or ()
+
+        for path, digest in self.hash_inputs(inputs, root):
+            sha.update('{0}\0{1}\0'.format(path, digest).encode())
+
+        return sha.hexdigest()
+
+    def hash_inputs(self, patterns, root):
+        """
+        Yield tuples of path and content hash for all files in the inputs.
+
+        Patterns are globbed relative to `root` and directories are walked.
+        Paths are yielded relative to `root`, so that the key is the same in
+        every temporary directory a build runs in. Patterns that match
+        nothing are still yielded so that creating them busts the cache.
+
+        """
+
+        for pattern in patterns:
+            paths = sorted(glob.glob(os.path.join(root, pattern)))
+            if not paths:
+                yield pattern, None
+
+            for path in paths:
+                if not os.path.isdir(path):
+                    yield self.relpath(path, root), self.hash_file(path)
+                    continue
+
+                for top, dirs, files in os.walk(path):
+                    dirs.sort()
+                    for name in sorted(files):
+                        target = os.path.join(top, name)
+                        yield self.relpath(target, root), \
+                            self.hash_file(target)
+
+    def relpath(self, path, root):
+        if path.startswith(os.path.join(root, '')):
+            return path[len(os.path.join(root, '')):]
+
+        return path
+
+    def hash_file(self, path):
+        sha = hashlib.sha256()
+
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                sha.update(chunk)
+
+        return sha.hexdigest()
+
+    def get_filename(self, key):
+        return os.path.join(self.path, '{0}.jsonl'.format(key))
+
+    def get(self, key):
+        """
+        Return the stored log records for `key`, or None if there are none.
+
+        """
+
+        filename = self.get_filename(key)
+        if not os.path.isfile(filename):
+            return None
+
+        with open(filename) as f:
+            return [json.loads(line) for line in f]
+
+    def put(self, key, records):
+        """
+        Store the log records for `key`.
+
+        The file is written next to its final name and then moved into place,
+        so that a build that dies halfway never leaves a broken entry.
+
+        """
+
+        filename = self.get_filename(key)
+        tmp = '{0}.{1}.tmp'.format(filename, os.getpid())
+
+        with open(tmp, 'w') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+
+        os.rename(tmp, filename)
+        self.log.debug("Stored result in '{0}'".format(filename))
+
+    @contextlib.contextmanager
+    def capture(self, step):
+        """
+        Collect the log records the step emits in the current thread.
+
+        Yields the list the records end up in.
+
+        """
+
+        handler = CaptureHandler(step.log_key + SEPARATOR)
+        with handler.threadbound():
+            yield handler.records
+
+    def replay(self, step, records):
+        """
+        Log stored records again as if the step had just emitted them.
+
+        """
+
+        for record in records:
+            channel = step.log_key + record['channel']
+            logbook.Logger(channel).log(record['level'], record['message'])
+
+
+class CaptureHandler(logbook.Handler):
+    """
+    Handler that keeps records from channels under a prefix in a list.
+
+    Only the parts needed to replay the record are kept. The channel is stored
+    without the prefix since the prefix contains the index of the step, which
+    might be different the next time around.
+
+    """
+
+    def __init__(self, prefix, level=logbook.INFO):
+        super(CaptureHandler, self).__init__(level=level, bubble=True)
+
+        self.prefix = prefix
+        self.records = []
+
+    def should_handle(self, record):
+        return (
+            super(CaptureHandler, self).should_handle(record) and
+            record.channel.startswith(self.prefix)
+        )
+
+    def emit(self, record):
+        self.records.append({
+            'channel': record.channel[len(self.prefix) - len(SEPARATOR):],
+            'level': record.level,
+            'message': record.message,
+        })
@@ -87,6 +87,10 @@ class CLI:
             return 0
 
         # Actually execute the command
-        exitcode = runners[ns.command](ns)
+        try:
+            exitcode = runners[ns.command](ns)
+        finally:
+            for handler in self.log_handlers:
+                handler.close()
 
         return exitcode
@@ -4,6 +4,7 @@ import logbook
 import jsonschema
 
 from xdg import BaseDirectory
+from piper import logfile
 from piper.utils import dynamic_load
 
 
@@ -36,6 +37,45 @@ class ConfigError(Exception):
     pass
 
 
+class ClassRegistry(dict):
+    """
+    Mapping of class strings to classes that imports each class the first time
+    it is looked up.
+
+    This keeps the classes of envs, steps and databases that a command never
+    touches from ever being imported.
+
+    Class strings that have moved still work, with a warning; see `MOVED`.
+
+    """
+
+    # Old class strings, to where the classes are now.
+    MOVED = {
+        'piper.db.RethinkDB': 'piper.db.rethink.RethinkDB',
+    }
+
+    def __init__(self, *args, **kwargs):
+        super(ClassRegistry, self).__init__(*args, **kwargs)
+
+        self.log = logbook.Logger(self.__class__.__name__)
+
+    def __missing__(self, key):
+        if key in self.MOVED:
+            self.log.warning(
+                "'{0}' has moved to '{1}'. Please update your "
+                "configuration.".format(key, self.MOVED[key])
+            )
+            cls = self[self.MOVED[key]]
+            self[key] = cls
+            return cls
+
+        self.log.debug("Loading class '{0}()'".format(key))
+
+        cls = dynamic_load(key)
+        self[key] = cls
+        return cls
+
+
 class Config:
     def __init__(self, filename=None, raw=None):
         args = (filename, raw)
@@ -46,7 +86,7 @@ class Config:
         self.filename = filename
         self.raw = raw
 
-        self.classes = {}
+        self.classes = ClassRegistry()
 
         self.log = logbook.Logger(self.__class__.__name__)
 
@@ -59,7 +99,6 @@ class Config:
             self.log.debug('Using provided raw configuration.')
 
         # self.validate_config()
-        self.load_classes()
         return self
 
     def load_config(self):
@@ -102,15 +141,6 @@ class Config:
 
         return set(traverse(self.raw))
 
-    def load_classes(self):
-        self.log.debug("Loading classes...")
-
-        for cls in self.collect_classes():
-            self.log.debug("Loading class '{0}()'".format(cls))
-            self.classes[cls] = dynamic_load(cls)
-
-        self.log.debug("Class loading done.")
-
     def validate_config(self):
         self.log.debug('Validating...')
         jsonschema.validate(self.raw, self.schema)
@@ -167,10 +197,42 @@ class BuildConfig(Config):
                 },
             },
             'db': DB_SCHEMA,
+            'jobs': {
+                'description':
+                    'The maximum number of steps to run at the same time. '
+                    'Defaults to the number of CPUs.',
+                'type': 'integer',
+                'minimum': 1,
+            },
+            'log_compression': {
+                'description':
+                    'Store build logs compressed with this codec, in frames '
+                    'that can be read from any line. Lines show up in the '
+                    'file a frame at a time.',
+                'enum': [None, 'gzip', 'zstd'],
+            },
+            'log_format': {
+                'description':
+                    "Format of build logs. 'json' writes JSON lines with "
+                    'the build, step, command, level, a monotonic timestamp '
+                    'and the message as fields.',
+                'enum': ['text', 'json'],
+            },
             'pipeline': {
                 'description': 'The key of the pipeline to execute.',
                 'type': 'string',
             },
+            'env': {
+                'description': 'The key of the env to execute in.',
+                'type': 'string',
+            },
+            'eligible_agents': {
+                'description':
+                    'Ids of the agents that may run the build. Any agent '
+                    'may if not set.',
+                'type': ['array', 'null'],
+                'items': {'type': 'string'},
+            },
         },
     }
 
@@ -180,6 +242,31 @@ class BuildConfig(Config):
 
         super(BuildConfig, self).__init__(filename, raw)
 
+    def load(self):
+        super(BuildConfig, self).load()
+        self.check_log_compression()
+        return self
+
+    def check_log_compression(self):
+        """
+        Make sure the codec of `log_compression` can be used, so that a build
+        does not fail at the first write of its log.
+
+        """
+
+        compression = (self.raw or {}).get('log_compression')
+        if compression is None:
+            return
+
+        try:
+            logfile.CODECS[compression][1]()
+
+        except ImportError as exc:
+            err = "Cannot use log_compression '{0}': {1}. Install it, or " \
+                "piper with the '{0}' extra.".format(compression, exc)
+            self.log.error(err)
+            raise ConfigError(err)
+
 
 class AgentConfig(Config):
     schema = {
@@ -213,6 +300,20 @@ class AgentConfig(Config):
                             'tasks.',
                         'type': 'boolean',
                     },
+                    'slots': {
+                        'description':
+                            'Number of builds to run at the same time, each '
+                            'in a worker process of its own. Defaults to 1.',
+                        'type': 'integer',
+                        'minimum': 1,
+                    },
+                    'facts_ttl': {
+                        'description':
+                            'Seconds before the cached facter facts of the '
+                            'agent are refreshed. Defaults to 3600.',
+                        'type': 'integer',
+                        'minimum': 0,
+                    },
                 },
             },
             'db': DB_SCHEMA,
@@ -1,2 +0,0 @@
-# flake8: noqa
-from piper.db.rethink import RethinkDB
@@ -116,6 +116,40 @@ class BuildManager:
 
         raise NotImplementedError()
 
+    def claim(self, build_id, agent_id):
+        """
+        Claim a build for an agent.
+
+        The agent and start time of the build are set in one conditional
+        update, and only if neither is set already. Out of any number of
+        agents claiming the same build at the same time, exactly one wins.
+
+        Should return whether the given agent did.
+
+        """
+
+        raise NotImplementedError()
+
+    def feed(self, filter=None):
+        """
+        Yield changes of builds as dicts with `old_val` and `new_val`,
+        forever.
+
+        Builds that are waiting to be claimed come first, as inserts in the
+        order they were created, and then the changes as they happen,
+        without any gaps or duplicates in between. A lost connection is
+        reconnected, backing off, and the feed resumes the same way.
+
+        `filter` is a function that takes a build document and returns an
+        expression in the query language of the database of whether it
+        matches. With a filter, only inserts of builds that are unclaimed
+        and match it are yielded, and the filtering is done by the
+        database, so that nothing else is sent.
+
+        """
+
+        raise NotImplementedError()
+
     def get(self, build_id):
         """
         Get a build and all its related fields.
@@ -146,6 +180,19 @@ class BuildManager:
         raise NotImplementedError()
 
 
+class LogManager:
+    def add(self, records):
+        """
+        Store a list of log records in one go.
+
+        Each record is a dict with at least the build id, time, level, channel
+        and message.
+
+        """
+
+        raise NotImplementedError()
+
+
 class Database:
     """
     Abstract class representing a persistance layer
@@ -154,6 +201,8 @@ class Database:
 
     agent = AgentManager()
     build = BuildManager()
+    # `log` is the logger of the database.
+    logs = LogManager()
 
     def __init__(self):
         self.log = logbook.Logger(self.__class__.__name__)
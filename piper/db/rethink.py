@@ -1,10 +1,48 @@
 import logbook
 import rethinkdb as rdb
+import time
 
+from piper import utils
 from piper.db import core as db
 
 
+# Errors that mean the connection to the database was lost
+CONNECTION_ERRORS = (rdb.ReqlDriverError, rdb.ReqlAvailabilityError)
+
+
+def unclaimed(build):
+    """
+    ReQL expression of whether a build is free to claim.
+
+    """
+
+    return build['agent'].default(None).eq(None).and_(
+        build['started'].default(None).eq(None)
+    )
+
+
+def inserted(filter):
+    """
+    ReQL predicate of changes that insert an unclaimed build that matches
+    `filter`.
+
+    """
+
+    def predicate(change):
+        build = change['new_val']
+        return change['old_val'].eq(None).and_(
+            unclaimed(build)
+        ).and_(
+            filter(build)
+        )
+
+    return predicate
+
+
 class RethinkManager:
+    # Secondary indexes of the table
+    indexes = ()
+
     def __init__(self, db):
         self.db = db
         self.conn = db.conn
@@ -12,6 +50,15 @@ class RethinkManager:
 
         self.log = logbook.Logger(self.__class__.__name__)
 
+    @property
+    def attribute(self):
+        """
+        The attribute of the database that the manager is set as.
+
+        """
+
+        return self.table_name
+
 
 class AgentManager(RethinkManager, db.AgentManager):
     table_name = 'agent'
@@ -28,6 +75,12 @@ class AgentManager(RethinkManager, db.AgentManager):
 
 class BuildManager(RethinkManager, db.BuildManager):
     table_name = 'build'
+    indexes = ('created',)
+
+    # Seconds to wait before reconnecting a lost feed, doubled after every
+    # failed try up to the maximum.
+    retry_delay = 1
+    max_retry_delay = 60
 
     def add(self, build):
         # TODO: Error handling
@@ -40,17 +93,99 @@ class BuildManager(RethinkManager, db.BuildManager):
         data = build.as_dict()
         return self.table.update(data).run(self.conn)
 
+    def claim(self, id, agent_id):
+        # Updates of a single document are atomic, so the check and the
+        # write cannot be split up by another agent.
+        ret = self.table.get(id).update(
+            lambda build: rdb.branch(
+                unclaimed(build),
+                {'agent': agent_id, 'started': utils.now()},
+                {},
+            )
+        ).run(self.conn)
+
+        return ret['replaced'] == 1
+
     def get(self, id):
         return self.table.get(id).run(self.conn)
 
-    def feed(self):
-        return self.table.changes().run(self.conn)
+    def feed(self, filter=None):
+        delay = self.retry_delay
+        lost = False
+
+        while True:
+            try:
+                if lost:
+                    self.conn.reconnect(noreply_wait=False)
+
+                for change in self.resume(filter):
+                    lost = False
+                    delay = self.retry_delay
+                    yield change
+
+                self.log.warning('Feed ended.')
+
+            except CONNECTION_ERRORS as exc:
+                self.log.warning('Feed lost: {0}'.format(exc))
+
+            lost = True
+            self.log.info('Reconnecting in {0} seconds...'.format(delay))
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_retry_delay)
+
+    def resume(self, filter=None):
+        """
+        Yield the pending builds as inserts, oldest first, and then the
+        changes of the table as they happen.
+
+        The change feed is opened before the pending builds are read, so
+        that nothing added in between is missed. Builds that show up as
+        both are only yielded once.
+
+        With a `filter`, both are filtered by the server; see
+        :func:`piper.db.core.BuildManager.feed`.
+
+        """
+
+        changes = self.table.changes()
+        pending = self.table.order_by(index='created').filter(unclaimed)
+
+        if filter is not None:
+            changes = changes.filter(inserted(filter))
+            pending = pending.filter(filter)
+
+        changes = changes.run(self.conn)
+        pending = pending.run(self.conn)
+
+        seen = set()
+        for build in pending:
+            seen.add(build['id'])
+            yield {'old_val': None, 'new_val': build}
+
+        for change in changes:
+            if change['old_val'] is None and change['new_val'] is not None:
+                id = change['new_val']['id']
+                if id in seen:
+                    seen.discard(id)
+                    continue
+
+            yield change
+
+
+class LogManager(RethinkManager, db.LogManager):
+    table_name = 'log'
+    attribute = 'logs'
+    indexes = ('build',)
+
+    def add(self, records):
+        return self.table.insert(records).run(self.conn)
 
 
 class RethinkDB(db.Database):
     managers = (
         AgentManager,
         BuildManager,
+        LogManager,
     )
 
     def setup(self, config):
@@ -102,6 +237,7 @@ class RethinkDB(db.Database):
         tables = rdb.table_list().run(conn)
         for man in self.setup_managers():
             self.create_table(tables, man, conn)
+            self.create_indexes(man, conn)
 
     def create_table(self, tables, man, conn):
         """
@@ -121,6 +257,27 @@ class RethinkDB(db.Database):
         rdb.table_create(name).run(conn)
         return True
 
+    def create_indexes(self, man, conn):
+        """
+        Idempotently create the secondary indexes of a table, and wait for
+        them to be ready.
+
+        """
+
+        table = rdb.table(man.table_name)
+        existing = table.index_list().run(conn)
+
+        for index in man.indexes:
+            if index in existing:
+                continue
+
+            self.log.info("Creating index '{0}' on '{1}'...".format(
+                index, man.table_name
+            ))
+            table.index_create(index).run(conn)
+
+        table.index_wait().run(conn)
+
     def connect(self, config):
         """
         Start a connection to RethinkDB.
@@ -142,14 +299,14 @@ class RethinkDB(db.Database):
     def setup_managers(self):
         """
         Create instances of all manager classes, setting them as attributes
-        with the same name as their table names.
+        with the same name as their table names, unless they say otherwise.
 
         """
 
         ret = []
         for manager in self.managers:
             man = manager(self)
-            setattr(self, man.table_name, man)
+            setattr(self, man.attribute, man)
             ret.append(man)
 
         return ret
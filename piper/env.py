@@ -1,14 +1,34 @@
+import errno
+import fcntl
 import os
 import tempfile
-import sh
+import time
 import shutil
 
+from piper import utils
 from piper.abc import DynamicItem
+from piper.pool import VirtualEnvPool
 from piper.process import Process
 from piper.schema import REQUIREMENT_SCHEMA
 
+# ioctl request for cloning a file, from linux/fs.h
+FICLONE = 0x40049409
+
+# Errors that mean that the filesystem cannot clone files
+REFLINK_UNSUPPORTED = (
+    errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY, errno.EPERM,
+)
+
+
+class EnvError(Exception):
+    pass
+
 
 class Env(DynamicItem):
+    # Environment variables of the processes of the steps, if not those of
+    # piper itself.
+    environ = None
+
     @property
     def schema(self):
         if not hasattr(self, '_schema'):
@@ -27,20 +47,125 @@ class Env(DynamicItem):
     def execute(self, step):
         cmd = step.get_command()
 
-        proc = Process(self.config, cmd, step.log_key)
+        proc = Process(
+            self.config, cmd, step.log_key, step.output,
+            step.build.log_handler, step.limits, self.environ,
+        )
         proc.setup()
         proc.run()
 
         return proc
 
 
-class PythonVirtualEnv(Env):  # pragma: nocover
+class PythonVirtualEnv(Env):
+    """
+    Env that runs steps inside of a Python virtualenv.
+
+    The virtualenv comes from a pool shared by all builds on the agent, keyed
+    by the interpreter and the contents of the requirements files. The first
+    build with a given set of requirements installs them; later builds just
+    link the finished env into the working directory. The steps run with the
+    env activated, in an environment of their own; the one of piper is left
+    alone, since other envs might be running steps at the same time.
+
+    Requirements files should not install anything from the working
+    directory, since the env outlives the build that made it.
+
+    """
+
+    @property
+    def schema(self):
+        if not hasattr(self, '_schema'):
+            self._schema = super(PythonVirtualEnv, self).schema
+            self._schema['properties']['python'] = {
+                'description': 'Interpreter to create the virtualenv with.',
+                'default': 'python3',
+                'type': 'string',
+            }
+            self._schema['properties']['requirements_files'] = {
+                'description':
+                    'Requirements files to install. Defaults to '
+                    'requirements.txt, if there is one.',
+                'type': ['array', 'null'],
+                'items': {'type': 'string'},
+            }
+            self._schema['properties']['path'] = {
+                'description':
+                    'Where in the working directory to link the virtualenv.',
+                'default': 'venv',
+                'type': 'string',
+            }
+            self._schema['properties']['pool_size'] = {
+                'description':
+                    'Megabytes of disk the pool of virtualenvs on the agent '
+                    'may use before the least recently used ones are removed.',
+                'default': 4096,
+                'type': 'integer',
+            }
+
+        return self._schema
+
     def setup(self):
-        if not os.path.exists('bin/python'):
-            # TODO: Should use Process()
-            self.log.info('Setting up virtualenv...')
-            for line in sh.Command('virtualenv')(['.'], _iter=True):
-                self.log.debug(line)
+        self.requirements_files = self.config['requirements_files']
+        if self.requirements_files is None:
+            self.requirements_files = [
+                name for name in ('requirements.txt',) if os.path.isfile(name)
+            ]
+
+        self.pool = VirtualEnvPool(self.config['pool_size'] * 2 ** 20)
+        self.key = self.pool.key(
+            self.config['python'],
+            self.requirements_files,
+        )
+
+        venv = self.pool.acquire(self.key, self.create)
+
+        self.link = os.path.join(os.getcwd(), self.config['path'])
+        if os.path.islink(self.link):
+            os.unlink(self.link)
+        os.symlink(venv, self.link)
+        self.log.info("Linked virtualenv to '{0}'".format(self.link))
+
+        self.activate(self.link)
+
+    def create(self, path):
+        pip = os.path.join(path, 'bin', 'pip')
+        commands = [
+            'virtualenv -p {0} {1}'.format(self.config['python'], path),
+        ]
+        for filename in self.requirements_files:
+            commands.append('{0} install -r {1}'.format(pip, filename))
+
+        for cmd in commands:
+            proc = Process(self.config, cmd, self.__class__.__name__)
+            proc.setup()
+            proc.run()
+            self.build.trace_process(proc, env=self.__class__.__name__)
+
+            if not proc.success:
+                raise EnvError("'{0}' failed".format(cmd))
+
+    def activate(self, path):
+        """
+        Set up the environment variables of the steps so that they run inside
+        of the virtualenv.
+
+        """
+
+        self.environ = dict(os.environ)
+
+        self.environ['VIRTUAL_ENV'] = path
+        self.environ['PATH'] = os.pathsep.join(
+            (os.path.join(path, 'bin'), self.environ.get('PATH', ''))
+        )
+        self.environ.pop('PYTHONHOME', None)
+
+    def teardown(self):
+        if os.path.islink(self.link):
+            os.unlink(self.link)
+
+        self.pool.release(self.key)
+        self.pool.evict()
 
 
 class TempDirEnv(Env):
@@ -51,8 +176,23 @@ class TempDirEnv(Env):
     Once build is done, the temporary directory is removed unless specified
     to be kept.
 
+    How the repository ends up in the temporary directory is decided by the
+    `workspace` strategy:
+
+    * `copy`: Copy everything, including `.git` and build outputs.
+    * `ignore`: Copy only the files that git would consider, meaning tracked
+      files and untracked files that are not ignored.
+    * `hardlink`: Hardlink every file. Fast, but a step that modifies a file
+      in place modifies it in the checkout as well.
+    * `reflink`: Copy-on-write clones of every file, on filesystems that
+      support it (btrfs, xfs). Falls back to copying.
+    * `worktree`: A `git worktree` of the current commit. Uncommitted
+      changes are not included.
+
     """
 
+    WORKSPACES = ('copy', 'ignore', 'hardlink', 'reflink', 'worktree')
+
     @property
     def schema(self):
         if not hasattr(self, '_schema'):
@@ -64,6 +204,13 @@ class TempDirEnv(Env):
                 'default': True,
                 'type': 'boolean',
             }
+            self._schema['properties']['workspace'] = {
+                'description':
+                    'Strategy used to put the repository in the temporary '
+                    'directory.',
+                'default': 'copy',
+                'enum': list(self.WORKSPACES),
+            }
 
         return self._schema
 
@@ -71,21 +218,70 @@ class TempDirEnv(Env):
         self.dir = tempfile.mkdtemp(prefix='piper-')
         self.log.info("Created temporary dir '{0}'".format(self.dir))
 
-        self.cwd = os.path.join(self.dir, os.getcwd().split('/')[-1])
-        self.log.info("Copying repo to '{0}'...".format(self.cwd))
+        self.source = os.getcwd()
+        self.cwd = os.path.join(self.dir, os.path.basename(self.source))
 
-        shutil.copytree(os.getcwd(), self.cwd)
-        self.log.info("Copying done.")
+        strategy = self.config['workspace']
+        self.log.info("Setting up workspace in '{0}' with {1}...".format(
+            self.cwd, strategy
+        ))
+
+        start = time.monotonic()
+        getattr(self, 'workspace_{0}'.format(strategy))()
+        self.log.info("Workspace set up with {0} in {1:.3f}s.".format(
+            strategy, time.monotonic() - start
+        ))
 
         os.chdir(self.dir)
         self.log.info("Working directory set to '{0}'".format(self.cwd))
 
+    def workspace_copy(self):
+        shutil.copytree(self.source, self.cwd)
+
+    def workspace_ignore(self):
+        files = utils.oneshot(
+            'git ls-files -z --cached --others --exclude-standard'
+        )
+
+        for name in sorted(set(filter(None, files.split('\0')))):
+            src = os.path.join(self.source, name)
+            if not os.path.lexists(src):
+                # Deleted from the working tree, but not yet from the index.
+                continue
+
+            dst = os.path.join(self.cwd, name)
+            if os.path.isdir(src) and not os.path.islink(src):
+                # Submodules are listed as a single entry.
+                shutil.copytree(src, dst, symlinks=True)
+                continue
+
+            utils.mkdir(os.path.dirname(dst))
+            shutil.copy2(src, dst, follow_symlinks=False)
+
+    def workspace_hardlink(self):
+        shutil.copytree(
+            self.source, self.cwd, symlinks=True, copy_function=link
+        )
+
+    def workspace_reflink(self):
+        shutil.copytree(
+            self.source, self.cwd, symlinks=True, copy_function=reflink
+        )
+
+    def workspace_worktree(self):
+        utils.oneshot('git worktree add --detach {0} HEAD'.format(self.cwd))
+
     def teardown(self):
         verb = 'Keeping'
-        if self.config.delete_when_done:
+        if self.config['delete_when_done']:
             verb = 'Removing'
             shutil.rmtree(self.dir)
 
+            if self.config['workspace'] == 'worktree':
+                # Let git forget about the worktree that was just removed.
+                os.chdir(self.source)
+                utils.oneshot('git worktree prune')
+
         self.log.info("{1} '{0}'".format(self.dir, verb))
 
     def execute(self, step):
@@ -100,3 +296,37 @@ class TempDirEnv(Env):
 
         # Execute the base method
         return super(TempDirEnv, self).execute(step)
+
+
+def link(src, dst):
+    """
+    Hardlink `src` to `dst`, copying it if they are on different devices.
+
+    """
+
+    try:
+        os.link(src, dst)
+    except OSError as exc:
+        if exc.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copy2(src, dst)
+
+
+def reflink(src, dst):
+    """
+    Make a copy-on-write clone of `src` at `dst` if the filesystem supports
+    it, or a normal copy if it does not.
+
+    """
+
+    try:
+        with open(src, 'rb') as s, open(dst, 'wb') as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+    except OSError as exc:
+        if exc.errno not in REFLINK_UNSUPPORTED:
+            raise
+        shutil.copy2(src, dst)
+
+    else:
+        shutil.copystat(src, dst)
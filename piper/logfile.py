@@ -0,0 +1,199 @@
+import bisect
+import gzip
+
+
+def gzip_codec():
+    return gzip.compress, gzip.decompress
+
+
+def zstd_codec():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('zstd log compression needs the zstandard package')
+
+    return (
+        zstandard.ZstdCompressor().compress,
+        zstandard.ZstdDecompressor().decompress,
+    )
+
+
+# name: (file extension, function returning (compress, decompress))
+CODECS = {
+    'gzip': ('.gz', gzip_codec),
+    'zstd': ('.zst', zstd_codec),
+}
+
+
+def get_filename(filename, compression=None):
+    """
+    Return the name a log file is stored as, with the given compression.
+
+    """
+
+    if compression is None:
+        return filename
+
+    return filename + CODECS[compression][0]
+
+
+def get_index_filename(filename):
+    return filename + '.idx'
+
+
+class FrameWriter:
+    """
+    Text file writer that compresses its data in independent frames.
+
+    Text is collected until at least `frame_size` bytes of full lines are
+    waiting, which are then compressed on their own and appended to the file.
+    For every frame, its offset in the file and the number of the first line
+    in it is added to an index file next to it. A log can then be read from
+    any line by decompressing only the frames from that line on; see
+    :class:`FrameReader`.
+
+    gzip frames are gzip members, so the file as a whole is still a normal
+    gzip file that `zcat` can read. The same goes for zstd frames and
+    `zstdcat`.
+
+    Lines that are not in a finished frame are only written on :func:`close`.
+
+    """
+
+    def __init__(self, filename, compression='gzip', frame_size=2 ** 20):
+        self.filename = filename
+        self.frame_size = frame_size
+        self.compress, _ = CODECS[compression][1]()
+
+        self.buffer = []
+        self.size = 0
+
+        # Appending to an existing log continues its line numbers.
+        self.lines = FrameReader(filename, compression).count()
+
+        self.stream = open(filename, 'ab')
+        self.index = open(get_index_filename(filename), 'a')
+        self.offset = self.stream.tell()
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.size += len(text)
+
+        if self.size >= self.frame_size:
+            self.write_frame()
+
+    def write_frame(self, final=False):
+        text = ''.join(self.buffer)
+
+        # Frames only hold full lines, so that every line can be found from
+        # the index. The rest waits for the next frame.
+        end = len(text) if final else text.rfind('\n') + 1
+        text, rest = text[:end], text[end:]
+        self.buffer = [rest] if rest else []
+        self.size = len(rest)
+
+        if not text:
+            return
+
+        frame = self.compress(text.encode('utf-8'))
+        self.stream.write(frame)
+        self.index.write('{0} {1}\n'.format(self.offset, self.lines))
+
+        self.offset += len(frame)
+        self.lines += text.count('\n')
+
+    def flush(self):
+        """
+        Flush the frames written so far to disk.
+
+        """
+
+        self.stream.flush()
+        self.index.flush()
+
+    def close(self):
+        self.write_frame(final=True)
+        self.stream.close()
+        self.index.close()
+
+
+class FrameReader:
+    """
+    Reader of files written by :class:`FrameWriter`.
+
+    """
+
+    def __init__(self, filename, compression='gzip'):
+        self.filename = filename
+        _, self.decompress = CODECS[compression][1]()
+        self.offsets, self.starts = self.read_index(filename)
+
+    @staticmethod
+    def read_index(filename):
+        offsets = []
+        starts = []
+
+        try:
+            with open(get_index_filename(filename)) as f:
+                for line in f:
+                    offset, start = line.split()
+                    offsets.append(int(offset))
+                    starts.append(int(start))
+
+        except FileNotFoundError:
+            pass
+
+        return offsets, starts
+
+    def count(self):
+        """
+        Return the number of lines in the log.
+
+        Only the last frame needs to be decompressed.
+
+        """
+
+        if not self.offsets:
+            return 0
+
+        with open(self.filename, 'rb') as f:
+            frame = self.read_frame(f, len(self.offsets) - 1)
+
+        return self.starts[-1] + frame.count(b'\n')
+
+    def read_frame(self, f, index):
+        start = self.offsets[index]
+        end = None
+        if index + 1 < len(self.offsets):
+            end = self.offsets[index + 1]
+
+        f.seek(start)
+        data = f.read() if end is None else f.read(end - start)
+        return self.decompress(data)
+
+    def lines(self, start=0):
+        """
+        Yield the lines of the log, starting at line number `start`.
+
+        Only the frames from the one that holds `start` are decompressed.
+
+        """
+
+        if not self.offsets:
+            return
+
+        index = max(bisect.bisect_right(self.starts, start) - 1, 0)
+        skip = start - self.starts[index]
+
+        with open(self.filename, 'rb') as f:
+            for x in range(index, len(self.offsets)):
+                text = self.read_frame(f, x).decode('utf-8')
+                lines = text.split('\n')
+                if lines[-1] == '':
+                    lines.pop()
+
+                if skip:
+                    lines = lines[skip:]
+                    skip = 0
+
+                yield from lines
@@ -2,12 +2,23 @@
 # coding: utf-8
 
 import re
+import json
 import os
 import sys
+import time
+import queue
+import pickle
+import datetime
+import itertools
+import sre_constants
+import sre_parse
+import string
 import hashlib
 import logbook
+import threading
 import blessings
 
+from piper import logfile
 from piper import utils
 
 # TODO: Some of these only work on dark terminals. Investigate.
@@ -49,6 +60,10 @@ DEFAULT_LOGFILE_FORMAT_STRING = (
 # Dot was used at first, but that breaks command lines more than not.
 SEPARATOR = ': '
 
+# Extra field of records that are left out of log files, like the samples of
+# output that is in the build log already.
+CONSOLE_ONLY = 'console_only'
+
 
 class Colorizer:
     terminal = blessings.Terminal()
@@ -110,6 +125,185 @@ COLORIZERS = (
 )
 
 
+class ColorizerEngine:
+    """
+    Compiled form of a chain of Colorizer() instances.
+
+    Applying the colorizers one at a time means one regexp search per
+    colorizer for every line of output, even though most lines match none of
+    them. The engine finds a piece of literal text that every match of each
+    regexp has to contain, like the slash of a path or the equal sign of an
+    environment variable, and only searches messages that contain it. Most
+    searches are replaced by a substring check.
+
+    Matches are colorized through a dispatch table of (regexp, template)
+    pairs, where the `{t.*}` fields of the formatting have been resolved
+    against the terminal once instead of for every match.
+
+    The result is identical to applying the colorizers one by one, including
+    aborting colorizers stopping the chain and every colorizer seeing the
+    output of the ones before it.
+
+    """
+
+    # Patterns that look at what is before the match can not be continued
+    # with search(pos); they need to be searched on the remaining string.
+    POSITIONAL_RXP = re.compile(r'\^|\\[AbB]|\(\?<[=!]')
+
+    def __init__(self, colorizers):
+        self.colorizers = colorizers
+        self.table = tuple(
+            (
+                colorizer.regexp,
+                find_literal(colorizer.regexp),
+                self.compile_template(colorizer),
+                bool(self.POSITIONAL_RXP.search(colorizer.regexp.pattern)),
+                colorizer.aborting is True,
+            )
+            for colorizer in colorizers
+        )
+
+    def compile_template(self, colorizer):
+        """
+        Turn the formatting of a colorizer into a format string that only
+        takes the groups of the match.
+
+        """
+
+        formatter = string.Formatter()
+        ret = []
+
+        for literal, field, spec, conversion in formatter.parse(
+            colorizer.formatting
+        ):
+            ret.append(literal.replace('{', '{{').replace('}', '}}'))
+            if field is None:
+                continue
+
+            if field == 't' or field.startswith(('t.', 't[')):
+                value, _ = formatter.get_field(
+                    field, (), {'t': colorizer.terminal}
+                )
+                value = formatter.format_field(
+                    formatter.convert_field(value, conversion), spec
+                )
+                ret.append(value.replace('{', '{{').replace('}', '}}'))
+                continue
+
+            if conversion:
+                field += '!' + conversion
+            if spec:
+                field += ':' + spec
+            ret.append('{' + field + '}')
+
+        return ''.join(ret)
+
+    def colorize(self, message):
+        if not isinstance(message, str):
+            return message
+
+        for regexp, literal, template, positional, aborting in self.table:
+            if literal is not None and literal not in message:
+                continue
+
+            matched, message = self.apply(regexp, template, positional,
+                                          message)
+            if matched and aborting:
+                break
+
+        return message
+
+    def apply(self, regexp, template, positional, message):
+        """
+        Colorize all matches of one colorizer in the message.
+
+        """
+
+        def replace(match):
+            return template.format(*match.groups())
+
+        if not positional:
+            message, count = regexp.subn(replace, message)
+            return count > 0, message
+
+        # Same as the recursion in Colorizer.colorize(): every search starts
+        # over on what is left after the previous match.
+        ret = []
+        rest = message
+        match = regexp.search(rest)
+        matched = match is not None
+
+        while match is not None:
+            start, stop = match.span()
+            ret.append(rest[:start])
+            ret.append(replace(match))
+            rest = rest[stop:]
+            if stop == 0:
+                break
+            match = regexp.search(rest)
+
+        ret.append(rest)
+        return matched, ''.join(ret)
+
+
+def find_literal(regexp):
+    """
+    Find the longest piece of text that every match of `regexp` contains.
+
+    Returns None if there is no such text, or if the pattern could not be
+    looked into.
+
+    """
+
+    try:
+        parsed = sre_parse.parse(regexp.pattern, regexp.flags)
+        runs = list(iter_literals(parsed, regexp.flags & re.I))
+    except Exception:  # pragma: nocover
+        return None
+
+    if not runs:
+        return None
+
+    return max(runs, key=len)
+
+
+def iter_literals(items, ignorecase):
+    """
+    Yield the runs of literal text that have to be part of a match.
+
+    Only literals outside of branches and optional repeats are required.
+    Letters are left out of case insensitive patterns.
+
+    """
+
+    run = ''
+    for op, av in items:
+        if op == sre_constants.LITERAL:
+            char = chr(av)
+            if not (ignorecase and char.lower() != char.upper()):
+                run += char
+                continue
+
+        if run:
+            yield run
+            run = ''
+
+        if op == sre_constants.SUBPATTERN:
+            # (group, pattern), or (group, add_flags, del_flags, pattern)
+            # from Python 3.6 on.
+            sub = ignorecase
+            if len(av) == 4:
+                sub = (sub or av[1] & re.I) and not av[2] & re.I
+            yield from iter_literals(av[-1], sub)
+
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            if av[0] >= 1:
+                yield from iter_literals(av[2], ignorecase)
+
+    if run:
+        yield run
+
+
 class BlessingsStringFormatter(logbook.StringFormatter):
     """
     StringFormatter subclass that gives access to blessings.Terminal().
@@ -122,6 +316,7 @@ class BlessingsStringFormatter(logbook.StringFormatter):
 
     def __init__(self, format_string=None, colorizers=tuple()):
         self.colorizers = colorizers
+        self.engine = ColorizerEngine(colorizers)
         self.terminal = blessings.Terminal()
         self.md5_cache = {}
 
@@ -206,17 +401,517 @@ class BlessingsStringFormatter(logbook.StringFormatter):
 
         """
 
-        for colorizer in self.colorizers:
-            done, message = colorizer.colorize(rc.message)
-            rc.message = message
+        rc.message = self.engine.colorize(rc.message)
+        return rc
+
+
+class PlainFormatter(logbook.StringFormatter):
+    """
+    Formatter for output that is not a terminal.
+
+    The lines are the same as with :data:`DEFAULT_LOGFILE_FORMAT_STRING`, but
+    they are put together directly instead of through str.format(), and the
+    timestamp only goes through strftime() once every second.
+
+    """
+
+    def __init__(self):
+        super(PlainFormatter, self).__init__(DEFAULT_LOGFILE_FORMAT_STRING)
+        # (second, formatted second), replaced as a whole since handlers
+        # format records from many threads.
+        self.stamp = (None, None)
+
+    def format_record(self, record, handler):
+        time = record.time
+        second = time.replace(microsecond=0)
+
+        cached, stamp = self.stamp
+        if second != cached:
+            stamp = second.strftime('%Y-%m-%d %H:%M:%S')
+            self.stamp = (second, stamp)
+
+        return '[%s.%06d] %5s %s: %s' % (
+            stamp,
+            time.microsecond,
+            record.level_name,
+            record.channel,
+            record.message,
+        )
+
+    def format_output(self, record):
+        """
+        Format a record of raw process output as the bare output.
+
+        """
+
+        return record.message
+
+
+class JSONFormatter:
+    """
+    Formatter of JSON lines, for log pipelines to index without parsing text.
+
+    Every line is an object with the build id, the key and index of the step
+    and the command of the process that logged it, if any, the level and
+    channel of the record, a monotonic timestamp in seconds and the message.
+    Steps and processes add their part through :func:`context`.
+
+    """
+
+    # A prepared encoder skips setting one up for every line; the encoding
+    # itself is done in C.
+    encode = json.JSONEncoder(
+        ensure_ascii=False, separators=(',', ':'), default=str,
+    ).encode
+
+    def __init__(self, build_id=None):
+        self.build_id = build_id
+
+    def __call__(self, record, handler):
+        extra = record.extra
+        data = {
+            'build': self.build_id,
+            'step': extra.get('step'),
+            'step_index': extra.get('step_index'),
+            'command': extra.get('command'),
+            'level': record.level_name,
+            'channel': record.channel,
+            # Records are formatted as they are handled, in the thread that
+            # logged them.
+            'monotonic': time.monotonic(),
+            'message': record.message,
+        }
+
+        if record.exc_info:
+            data['exception'] = record.formatted_exception
+
+        return self.encode(data)
+
+
+def context(**extra):
+    """
+    Get a processor that adds `extra` to the extra fields of records.
+
+    Use it with `.threadbound()` to cover what the current thread logs.
+
+    """
+
+    def process(record):
+        record.extra.update(extra)
+
+    return logbook.Processor(process)
+
+
+class BatchingHandler(logbook.Handler):
+    """
+    Base class for handlers that write records in batches from a background
+    thread.
+
+    Records are turned into items by :func:`prepare` in the thread that logs
+    them and put on a bounded queue. A single writer thread takes them off in
+    order and passes them to :func:`write` in batches: as soon as the items
+    waiting add up to `flush_size`, as measured by :func:`measure`, or when
+    the oldest waiting item is `flush_interval` seconds old. The threads that
+    read the output of steps never wait on the writing, unless it is slow
+    enough for the queue to fill up. What happens then depends on `policy`:
+
+    * 'block' waits for room in the queue, so that nothing is lost.
+    * 'drop' drops the record. An item from :func:`dropped_item` with the
+      number of dropped records is written in their place, once there is room
+      again.
+
+    :func:`close` writes everything that has been queued before it returns.
+
+    Records logged by the writer thread itself, like those of a database
+    driver, are left to the other handlers. Queueing them could wait on a
+    full queue that only the writer thread can empty.
+
+    """
+
+    POLICIES = ('block', 'drop')
+
+    def __init__(self, level=logbook.NOTSET, filter=None, bubble=False,
+                 max_queue=10000, flush_size=1000, flush_interval=1.0,
+                 policy='block'):
+        logbook.Handler.__init__(self, level, filter, bubble)
+
+        if policy not in self.POLICIES:
+            raise ValueError('Unknown policy {0!r}'.format(policy))
+
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+
+        self.queue = queue.Queue(max_queue)
+        self.dropped = 0
+        self.closed = False
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self, name):
+        """
+        Start the writer thread. Called by subclasses once they are set up.
+
+        """
+
+        self.thread = threading.Thread(target=self.run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def prepare(self, record):
+        """
+        Turn a record into the item that is queued and written.
+
+        """
+
+        raise NotImplementedError()
+
+    def measure(self, item):
+        return 1
+
+    def dropped_item(self, count):
+        raise NotImplementedError()
+
+    def write(self, batch):
+        raise NotImplementedError()
+
+    def teardown(self):
+        """
+        Clean up after the writer thread has stopped.
+
+        """
+
+    def should_handle(self, record):
+        return threading.current_thread() is not self.thread and \
+            logbook.Handler.should_handle(self, record)
+
+    def emit(self, record):
+        self.put(self.prepare(record))
+
+    def put(self, item):
+        """
+        Queue an item for writing, according to the policy.
+
+        """
+
+        if self.closed:
+            return
+
+        if self.policy == 'block':
+            self.queue.put(item)
+            return
+
+        with self.lock:
+            try:
+                # Note the records dropped since the last one that fit,
+                # where they were dropped.
+                if self.dropped:
+                    self.queue.put_nowait(self.dropped_item(self.dropped))
+                    self.dropped = 0
+                self.queue.put_nowait(item)
+
+            except queue.Full:
+                self.dropped += 1
+
+    def flush(self):
+        """
+        Wait until everything queued so far has been written.
+
+        """
+
+        if self.closed:
+            return
+
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait()
+
+    def close(self):
+        """
+        Write everything that is queued and stop the writer thread.
+
+        """
+
+        if self.closed:
+            return
+
+        self.closed = True
+        with self.lock:
+            if self.dropped:
+                self.queue.put(self.dropped_item(self.dropped))
+                self.dropped = 0
+
+        self.queue.put(None)
+        self.thread.join()
+        self.teardown()
+
+    def run(self):
+        """
+        Write items from the queue until :func:`close` is called.
+
+        Besides items, the queue holds an Event for every :func:`flush` and
+        None once the handler is closed.
 
-            if done and colorizer.aborting is True:
+        """
+
+        batch = []
+        size = 0
+        deadline = None
+
+        while True:
+            timeout = None
+            if deadline is not None:
+                timeout = max(deadline - time.monotonic(), 0)
+
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = TIMEOUT
+
+            if item is not None and item is not TIMEOUT and \
+                    not isinstance(item, threading.Event):
+                if not batch:
+                    deadline = time.monotonic() + self.flush_interval
+                batch.append(item)
+                size += self.measure(item)
+                if size < self.flush_size:
+                    continue
+
+            if batch:
+                self.write(batch)
+            batch = []
+            size = 0
+            deadline = None
+
+            if item is None:
                 break
+            if isinstance(item, threading.Event):
+                item.set()
 
-        return rc
 
+# Marks the writer thread of a BatchingHandler waking up to write a batch.
+TIMEOUT = object()
+
+
+class BatchedFileHandler(BatchingHandler,
+                         logbook.StringFormatterHandlerMixin):
+    """
+    File handler that writes to disk in batches from a background thread.
+
+    Records are formatted in the thread that logs them. Batches are written
+    once `flush_size` bytes are waiting; see :class:`BatchingHandler`.
+
+    With `compression` set to one of :data:`piper.logfile.CODECS`, the file is
+    written as compressed frames by a :class:`piper.logfile.FrameWriter`.
+
+    Records with :data:`CONSOLE_ONLY` set are not written.
+
+    """
+
+    def __init__(self, filename, level=logbook.NOTSET, format_string=None,
+                 filter=None, bubble=False, encoding='utf-8', max_queue=10000,
+                 flush_size=2 ** 16, flush_interval=1.0, policy='block',
+                 compression=None):
+        BatchingHandler.__init__(
+            self, level, filter, bubble, max_queue, flush_size,
+            flush_interval, policy,
+        )
+        logbook.StringFormatterHandlerMixin.__init__(self, format_string)
+
+        self.filename = filename
+        self.compression = compression
+        if compression is None:
+            self.stream = open(filename, 'a', encoding=encoding)
+        else:
+            self.stream = logfile.FrameWriter(filename, compression)
+
+        self.start('log writer: {0}'.format(filename))
+
+    def should_handle(self, record):
+        return not record.extra.get(CONSOLE_ONLY) and \
+            BatchingHandler.should_handle(self, record)
+
+    def prepare(self, record):
+        return self.format(record) + '\n'
+
+    def emit_output(self, record):
+        """
+        Write a record of raw output, regardless of level and filter.
+
+        Formatters with a `format_output` method, like :class:`PlainFormatter`,
+        format it with that instead, so that text logs get the output as it
+        is. See :class:`piper.process.BulkOutput`.
+
+        """
+
+        if hasattr(self.formatter, 'format_output'):
+            self.put(self.formatter.format_output(record) + '\n')
+        else:
+            self.put(self.prepare(record))
+
+    @property
+    def takes_output(self):
+        """
+        Whether processes can write their output straight into the file, as
+        with :class:`piper.process.DirectOutput`. Not when it is compressed,
+        or when the formatter would change raw output.
+
+        """
+
+        return self.compression is None and \
+            hasattr(self.formatter, 'format_output')
+
+    def measure(self, item):
+        return len(item)
+
+    def dropped_item(self, count):
+        return '{0} log records dropped\n'.format(count)
+
+    def write(self, batch):
+        self.stream.write(''.join(batch))
+        self.stream.flush()
+
+    def teardown(self):
+        self.stream.close()
+
+
+class DatabaseHandler(BatchingHandler):
+    """
+    Handler that ships the log records of a build to the database.
+
+    Records are inserted in bulk by the log manager of the database,
+    `flush_size` records or `flush_interval` seconds at a time; see
+    :class:`BatchingHandler`. A slow database fills up the queue, and then
+    logging waits for it.
+
+    If an insert fails, the batch is appended to the `spill` file and the
+    connection is dropped. Spilled records are inserted first, in order, once
+    the database is reachable again. So that every batch does not wait for a
+    database that is down, it is only tried again `retry_interval` seconds
+    after a failure.
+
+    `connect` is called in the writer thread whenever a connection is needed,
+    and should return a :class:`piper.db.core.LogManager`.
+
+    """
+
+    def __init__(self, connect, build_id, spill, level=logbook.NOTSET,
+                 filter=None, bubble=True, max_queue=10000, flush_size=500,
+                 flush_interval=1.0, policy='block', retry_interval=10.0):
+        super(DatabaseHandler, self).__init__(
+            level, filter, bubble, max_queue, flush_size, flush_interval,
+            policy,
+        )
+
+        self.connect = connect
+        self.build_id = build_id
+        self.spill = spill
+        self.retry_interval = retry_interval
+
+        self.manager = None
+        self.retry = None
+        self.sequence = itertools.count()
+
+        self.start('log shipper: {0}'.format(build_id))
+
+    def prepare(self, record):
+        return {
+            'build': self.build_id,
+            # Records are numbered, since many of them share a timestamp.
+            'seq': next(self.sequence),
+            # logbook uses naive UTC timestamps.
+            'time': record.time.replace(tzinfo=datetime.timezone.utc),
+            'level': record.level_name,
+            'channel': record.channel,
+            'message': record.message,
+        }
+
+    def dropped_item(self, count):
+        return {
+            'build': self.build_id,
+            'seq': next(self.sequence),
+            'time': utils.now(),
+            'level': 'WARNING',
+            'channel': self.__class__.__name__,
+            'message': '{0} log records dropped'.format(count),
+        }
+
+    def write(self, batch):
+        if self.retry is not None and time.monotonic() < self.retry:
+            self.spill_records(batch)
+            return
+
+        try:
+            if self.manager is None:
+                self.manager = self.connect()
+
+            self.unspill()
+            self.manager.add(batch)
+            self.retry = None
+
+        except Exception as exc:
+            # Records of the writer thread never reach the database; see
+            # should_handle().
+            sys.stderr.write(
+                'Could not ship logs to the database, spilling to {0}: '
+                '{1}\n'.format(self.spill, exc)
+            )
+            self.manager = None
+            self.retry = time.monotonic() + self.retry_interval
+            self.spill_records(batch)
+
+    def spill_records(self, records):
+        utils.mkdir(os.path.dirname(self.spill) or '.')
+        with open(self.spill, 'ab') as f:
+            pickle.dump(records, f)
+
+    def unspill(self):
+        """
+        Insert the records from the spill file, if there is one.
+
+        If the database fails halfway through, whatever was not inserted is
+        left in the file.
+
+        """
+
+        try:
+            records = []
+            with open(self.spill, 'rb') as f:
+                while True:
+                    try:
+                        records.extend(pickle.load(f))
+                    except EOFError:
+                        break
+
+        except FileNotFoundError:
+            return
+
+        sent = 0
+        try:
+            while sent < len(records):
+                chunk = records[sent:sent + self.flush_size]
+                self.manager.add(chunk)
+                sent += len(chunk)
+
+        finally:
+            if sent == len(records):
+                os.remove(self.spill)
+
+            elif sent:
+                tmp = self.spill + '.tmp'
+                with open(tmp, 'wb') as f:
+                    pickle.dump(records[sent:], f)
+                os.rename(tmp, self.spill)
+
+
+def get_handlers(debug=False, session=None):  # pragma: nocover
+    """
+    Get the console handler and the session log handler.
+
+    The session log is named after `session`, or the current time if None.
+
+    """
 
-def get_handlers(debug=False):  # pragma: nocover
     # Remove the default logbook.StderrHandler so that we can actually hide
     # debug output when debug is False. If we don't remove it, it will
     # always print to stderr anyway.
@@ -233,24 +928,59 @@ def get_handlers(debug=False):  # pragma: nocover
         level = logbook.DEBUG
 
     stream = logbook.StreamHandler(sys.stdout, level=level, bubble=True)
-    stream.formatter = BlessingsStringFormatter(colorizers=COLORIZERS)
+    stream.formatter = get_formatter(sys.stdout)
 
-    date = utils.now().strftime('%Y-%m-%dT%H:%M:%S')
-    logfile = get_file_logger('logs/piper/session/{0}.log'.format(date), debug)
+    if session is None:
+        session = utils.now().strftime('%Y-%m-%dT%H:%M:%S')
+    logfile = get_file_logger(
+        'logs/piper/session/{0}.log'.format(session), debug
+    )
 
     return stream, logfile
 
 
-def get_file_logger(filename, debug=False):  # pragma: nocover
+def get_formatter(stream):
+    """
+    Get the formatter for console output to `stream`.
+
+    Colors are only of use on a terminal. When the output goes anywhere else,
+    the escape codes would just be thrown away, so colorizing is skipped
+    altogether.
+
+    """
+
+    if stream.isatty():
+        return BlessingsStringFormatter(colorizers=COLORIZERS)
+
+    return PlainFormatter()
+
+
+def get_file_logger(filename, debug=False, compression=None,
+                    format='text', build_id=None):  # pragma: nocover
+    """
+    Get a handler that logs to `filename`.
+
+    With compression, the name of the file gets the extension of the codec.
+    `format` is either 'text' or 'json' for JSON lines; see
+    :class:`JSONFormatter`.
+
+    """
+
     level = logbook.INFO
     if debug:
         level = logbook.DEBUG
 
     utils.mkdir(os.path.dirname(filename))
 
-    return logbook.FileHandler(
-        filename,
-        format_string=DEFAULT_LOGFILE_FORMAT_STRING,
+    handler = BatchedFileHandler(
+        logfile.get_filename(filename, compression),
         level=level,
-        bubble=True
+        bubble=True,
+        compression=compression,
     )
+    if format == 'json':
+        handler.formatter = JSONFormatter(build_id)
+    else:
+        handler.formatter = PlainFormatter()
+
+    return handler
@@ -0,0 +1,224 @@
+import fcntl
+import hashlib
+import logbook
+import os
+import shutil
+import time
+
+from xdg import BaseDirectory
+
+
+class VirtualEnvPool:
+    """
+    Agent-local pool of virtualenvs, shared between builds.
+
+    Every virtualenv in the pool is keyed by a hash of the interpreter and the
+    requirements files it was made from, so builds with the same dependencies
+    reuse the same env instead of installing everything again.
+
+    Concurrent builds, in the same process or not, coordinate with flock():
+
+    * A build holds a shared lock on `<key>.lock` for as long as it uses the
+      env. Eviction only removes envs it can get an exclusive lock on.
+    * Creating an env happens under an exclusive lock on `<key>.create`, so
+      only one build ever installs a given env. A finished env gets a marker
+      file holding its size; an env without one is a leftover from a crash and
+      is created again.
+
+    When the pool grows past `max_size` bytes, the least recently used envs
+    that are not in use are removed.
+
+    """
+
+    MARKER = '.piper-pool'
+
+    def __init__(self, max_size, path=None):
+        self.max_size = max_size
+        self._path = path
+        self.locks = {}
+
+        self.log = logbook.Logger(self.__class__.__name__)
+
+    @property
+    def path(self):
+        """
+        The directory the pool lives in. Created on first access.
+
+        """
+
+        if self._path is None:
+            self._path = BaseDirectory.save_cache_path('piper', 'venvs')
+
+        return self._path
+
+    def key(self, python, requirements):
+        """
+        Calculate the pool key for an interpreter and requirements files.
+
+        The interpreter is identified by its resolved path, size and
+        modification time, which changes whenever it is upgraded.
+
+        """
+
+        sha = hashlib.sha256()
+
+        python = shutil.which(python) or python
+        real = os.path.realpath(python)
+        stat = os.stat(real)
+        sha.update('{0}\0{1}\0{2}\0'.format(
+            real, stat.st_size, stat.st_mtime
+        ).encode())
+
+        for filename in requirements:
+            sha.update('{0}\0'.format(filename).encode())
+            with open(filename, 'rb') as f:
+                sha.update(hashlib.sha256(f.read()).digest())
+
+        return sha.hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.path, key)
+
+    def acquire(self, key, create):
+        """
+        Get the path of the env for `key`, making it with `create` if needed.
+
+        `create` is called with the path the env should be created in. The env
+        is marked as in use until :func:`release` is called, unless getting it
+        fails.
+
+        """
+
+        lock = self.lock(key, 'lock', fcntl.LOCK_SH)
+        self.locks[key] = lock
+
+        path = self.get_path(key)
+        marker = os.path.join(path, self.MARKER)
+        acquired = False
+
+        try:
+            if not os.path.isfile(marker):
+                creating = self.lock(key, 'create', fcntl.LOCK_EX)
+                try:
+                    # Someone else might have finished it while we were
+                    # waiting.
+                    if not os.path.isfile(marker):
+                        self.create(path, marker, create)
+                finally:
+                    creating.close()
+
+            else:
+                self.log.info('Reusing virtualenv {0}'.format(key[:7]))
+
+            # The modification time of the marker is the last use of the env.
+            os.utime(marker, None)
+            acquired = True
+
+        finally:
+            if not acquired:
+                self.release(key)
+
+        return path
+
+    def create(self, path, marker, create):
+        if os.path.exists(path):
+            self.log.warning(
+                'Removing unfinished virtualenv {0}'.format(path)
+            )
+            shutil.rmtree(path)
+
+        self.log.info("Creating virtualenv in '{0}'...".format(path))
+        start = time.monotonic()
+        create(path)
+
+        size = disk_usage(path)
+        with open(marker, 'w') as f:
+            f.write(str(size))
+
+        self.log.info('Virtualenv created in {0:.3f}s ({1} MiB)'.format(
+            time.monotonic() - start, size // 2 ** 20
+        ))
+
+    def release(self, key):
+        """
+        Mark the env for `key` as no longer in use by this build.
+
+        """
+
+        lock = self.locks.pop(key, None)
+        if lock is not None:
+            lock.close()
+
+    def lock(self, key, kind, operation):
+        f = open(os.path.join(self.path, '{0}.{1}'.format(key, kind)), 'a')
+        try:
+            fcntl.flock(f, operation)
+        except Exception:
+            f.close()
+            raise
+
+        return f
+
+    def entries(self):
+        """
+        Return a list of (last use, size, key) for all finished envs.
+
+        """
+
+        ret = []
+        for key in os.listdir(self.path):
+            marker = os.path.join(self.path, key, self.MARKER)
+            try:
+                with open(marker) as f:
+                    size = int(f.read())
+                ret.append((os.stat(marker).st_mtime, size, key))
+
+            except (OSError, ValueError):
+                continue
+
+        return ret
+
+    def evict(self):
+        """
+        Remove least recently used envs until the pool fits in `max_size`.
+
+        Envs that are in use by any build are skipped.
+
+        """
+
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+
+        for _, size, key in entries:
+            if total <= self.max_size:
+                break
+
+            try:
+                lock = self.lock(key, 'lock', fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self.log.debug('Virtualenv {0} in use'.format(key[:7]))
+                continue
+
+            try:
+                self.log.info('Evicting virtualenv {0} ({1} MiB)'.format(
+                    key[:7], size // 2 ** 20
+                ))
+                shutil.rmtree(self.get_path(key))
+                total -= size
+
+            finally:
+                lock.close()
+
+
+def disk_usage(path):
+    """
+    Return the number of bytes used by all files below `path`.
+
+    """
+
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            total += os.lstat(os.path.join(root, name)).st_size
+
+    return total
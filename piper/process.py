@@ -1,45 +1,656 @@
+import asyncio
+import collections
 import logbook
-import sh
+import os
+import resource
+import shlex
+import signal
+import subprocess
+import sys
+import time
 
+from piper.logging import CONSOLE_ONLY
 from piper.logging import SEPARATOR
+from piper.logging import context
+
+# Extra fields of the samples and tails of output that is in the build log
+# already, so that they only go to the console.
+SAMPLE = {CONSOLE_ONLY: True}
 
 
 class Process:
     """
     Helper class for running processes
 
+    The output of the process is read with asyncio from both stdout and
+    stderr at the same time, so lines are logged in the order they arrive
+    without any threads reading the pipes. The buffers are bounded; a full
+    buffer stops reading from the pipe until it has been logged, and lines
+    longer than `line_limit` are logged in pieces.
+
+    With `output` of a step set to bulk or direct mode and the `handler` of
+    the build log given, the output is handled by a :class:`BulkOutput` or a
+    :class:`DirectOutput` instead.
+
+    The `limits` of a step set rlimits on the process, and a timeout for the
+    whole run and one for going without output. The rlimits are set by a
+    wrapper that the process is started through; see :func:`wrap_rlimits`.
+    A process with a timeout gets a session of its own, so that once it is
+    over a timeout, it can be killed along with every process it has
+    started. Being out of the process group of the terminal, it does not get
+    the SIGINT of a Ctrl-C; :func:`interrupt_sessions` forwards it.
+
+    `environ` is the environment of the process, if not that of piper.
+
     """
 
-    def __init__(self, config, cmd, parent_key):
+    chunk_size = 2 ** 14
+    line_limit = 2 ** 16
+    check_interval = 0.1
+
+    def __init__(self, config, cmd, parent_key, output=None, handler=None,
+                 limits=None, environ=None):
         self.config = config
         self.cmd = cmd
+        self.environ = environ
 
-        self.sh = None
+        self.popen = None
         self.success = None
+        self.started = None
+        self.ended = None
+        self.rusage = None
         self.log = logbook.Logger(parent_key + SEPARATOR + self.cmd)
 
+        self.limits = limits or {}
+        self.timeout = self.limits.get('timeout')
+        self.idle_timeout = self.limits.get('idle_timeout')
+        self.last_output = None
+        self.killed = None
+
+        # Both modes need a build log to put the output in. Logs that cannot
+        # take the output directly get it in bulk.
+        self.output = None
+        mode = output.get('mode') if output else None
+        if mode in ('bulk', 'direct') and handler is not None:
+            cls = BulkOutput
+            if mode == 'direct' and handler.takes_output:
+                cls = DirectOutput
+
+            self.output = cls(
+                self.log, handler, output.get('rate', 10),
+                output.get('tail', 100),
+            )
+
+    @property
+    def direct(self):
+        return self.output is not None and self.output.direct
+
+    @property
+    def timed(self):
+        return self.timeout is not None or self.idle_timeout is not None
+
     def setup(self):
         """
-        Setup the Popen object used in execution
+        Spawn the process, with pipes for its output
 
         """
 
         self.log.debug('Spawning process handler')
 
-        cmd, *args = self.cmd.split()
-        self.sh = sh.Command(cmd)(args, _iter=True)
+        stdout = stderr = subprocess.PIPE
+        if self.direct:
+            stdout, stderr = self.output.open(), subprocess.STDOUT
+
+        kwargs = {}
+        if self.environ is not None:
+            kwargs['env'] = self.environ
+
+        if self.timed:
+            kwargs['start_new_session'] = True
+
+        args = shlex.split(self.cmd)
+        rlimits = get_rlimits(self.limits)
+        if rlimits:
+            args = wrap_rlimits(args, rlimits)
+
+        self.started = self.last_output = time.monotonic()
+        try:
+            self.popen = subprocess.Popen(
+                args,
+                stdin=subprocess.DEVNULL,
+                stdout=stdout,
+                stderr=stderr,
+                **kwargs
+            )
+
+        except (OSError, subprocess.SubprocessError) as exc:
+            self.log.error('Could not start process: {0}'.format(exc))
+            self.success = False
+
+            if self.direct:
+                self.output.file.close()
+
+            return
+
+        PROCESSES.add(self.popen.pid)
+        if self.timed:
+            SESSIONS.add(self.popen.pid)
 
     def run(self):
+        """
+        Log the output of the process until it exits.
+
+        """
+
+        if self.popen is None:
+            return
+
         self.log.debug('Executing')
 
+        loop = asyncio.new_event_loop()
         try:
-            for line in self.sh:
-                self.log.info(line.strip())
-
-        except sh.ErrorReturnCode:
-            self.log.error(self.sh.stderr)
+            with context(command=self.cmd).threadbound():
+                if self.direct:
+                    self.watch()
+                else:
+                    loop.run_until_complete(self.communicate(loop))
 
         finally:
-            exit = self.sh.exit_code
+            loop.close()
+
+            self.wait()
+            PROCESSES.discard(self.popen.pid)
+            SESSIONS.discard(self.popen.pid)
+            exit = self.popen.returncode
+            self.ended = time.monotonic()
             self.success = exit == 0
+
+            if self.output is not None:
+                with context(command=self.cmd).threadbound():
+                    self.output.close(self.success)
+
             self.log.debug('Exitcode {0}'.format(exit))
+
+    def wait(self, timeout=None):
+        """
+        Wait up to `timeout` seconds for the process to exit, and return
+        whether it has.
+
+        The process is reaped with os.wait4() rather than by Popen, since
+        that is the only chance to get its resource usage; see
+        :func:`get_rusage`. The exit code is set on the Popen object the way
+        it would set it itself.
+
+        """
+
+        if self.popen.returncode is not None:
+            return True
+
+        end = None if timeout is None else time.monotonic() + timeout
+        delay = 0.0005
+
+        while True:
+            flags = 0 if end is None else os.WNOHANG
+            try:
+                pid, status, rusage = os.wait4(self.popen.pid, flags)
+            except ChildProcessError:
+                # Reaped by someone else; the usage is gone.
+                self.popen.wait()
+                return True
+
+            if pid:
+                self.popen.returncode = get_exitcode(status)
+                self.rusage = get_rusage(rusage)
+                return True
+
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return False
+
+            delay = min(delay * 2, remaining, 0.05)
+            time.sleep(delay)
+
+    def watch(self):
+        """
+        Wait for a process with direct output to exit, sampling the output
+        and checking the timeouts in the meantime.
+
+        """
+
+        intervals = [self.output.interval]
+        if self.timed:
+            intervals.append(self.check_interval)
+
+        intervals = [i for i in intervals if i is not None]
+        interval = min(intervals) if intervals else None
+
+        while not self.wait(interval):
+            if self.output.sample():
+                self.last_output = time.monotonic()
+            self.check()
+
+    def check(self):
+        """
+        Kill the process if it is over one of its timeouts.
+
+        """
+
+        if self.killed is not None:
+            return
+
+        now = time.monotonic()
+        if self.timeout is not None and now - self.started >= self.timeout:
+            self.kill('Timed out after {0} seconds'.format(self.timeout))
+
+        elif self.idle_timeout is not None and \
+                now - self.last_output >= self.idle_timeout:
+            self.kill('No output for {0} seconds'.format(self.idle_timeout))
+
+    def kill(self, reason):
+        """
+        Kill the process group of the process, which is its own since it was
+        started in a session of its own.
+
+        """
+
+        self.log.error('{0}. Killing it.'.format(reason))
+        self.killed = reason
+
+        try:
+            os.killpg(self.popen.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    @asyncio.coroutine
+    def communicate(self, loop):
+        """
+        Read stdout and stderr of the process at the same time until both
+        of them are closed, checking the timeouts in the meantime.
+
+        """
+
+        reading = asyncio.gather(
+            loop.create_task(self.read(loop, self.popen.stdout)),
+            loop.create_task(self.read(loop, self.popen.stderr)),
+            loop=loop,
+        )
+
+        if self.timed:
+            while not reading.done():
+                yield from asyncio.wait(
+                    [reading], loop=loop, timeout=self.check_interval
+                )
+                self.check()
+
+        yield from reading
+
+    @asyncio.coroutine
+    def read(self, loop, pipe):
+        """
+        Read a pipe in chunks and log every line in it.
+
+        """
+
+        reader = asyncio.StreamReader(limit=self.chunk_size, loop=loop)
+        protocol = asyncio.StreamReaderProtocol(reader, loop=loop)
+        transport, _ = yield from loop.connect_read_pipe(
+            lambda: protocol, pipe
+        )
+
+        pending = b''
+        try:
+            while True:
+                chunk = yield from reader.read(self.chunk_size)
+                if not chunk:
+                    break
+
+                self.last_output = time.monotonic()
+
+                *lines, pending = (pending + chunk).split(b'\n')
+                if lines:
+                    self.handle_lines(lines)
+
+                if len(pending) > self.line_limit:
+                    self.handle_lines([pending])
+                    pending = b''
+
+            if pending:
+                self.handle_lines([pending])
+
+        finally:
+            transport.close()
+
+    def handle_lines(self, lines):
+        if self.output is not None:
+            self.output.write(lines)
+            return
+
+        for line in lines:
+            self.handle_line(line)
+
+    def handle_line(self, line):
+        self.log.info(decode(line))
+
+
+class BulkOutput:
+    """
+    Output handling of steps that print too much to log line by line.
+
+    Every batch of lines read from the process is written to the build log
+    as a single record, through
+    :func:`piper.logging.BatchedFileHandler.emit_output`; text logs get the
+    output as it is. Only one line every `1 / rate` seconds is logged like
+    normal output, to the console and every other handler but the log files.
+    The last `tail` lines are kept in a ring buffer and logged the same way
+    if the process fails.
+
+    """
+
+    direct = False
+
+    def __init__(self, log, handler, rate=10, tail=100):
+        self.log = log
+        self.handler = handler
+        self.interval = 1 / rate if rate else None
+        self.tail = collections.deque(maxlen=tail)
+
+        self.lines = 0
+        self.next_sample = 0
+
+    def write(self, lines):
+        text = b'\n'.join(lines).decode(errors='replace')
+        record = logbook.LogRecord(self.log.name, logbook.INFO, text)
+        self.log.process_record(record)
+        self.handler.emit_output(record)
+
+        self.tail.extend(lines)
+        self.lines += len(lines)
+
+        if self.interval is not None:
+            now = time.monotonic()
+            if now >= self.next_sample:
+                self.next_sample = now + self.interval
+                self.log.info(decode(lines[-1]), extra=SAMPLE)
+
+    def close(self, success):
+        """
+        Log a summary of the output, with its tail if the process failed.
+
+        """
+
+        if success or not self.tail:
+            self.log.info(
+                '{0} lines of output written to the build log'.format(
+                    self.lines
+                )
+            )
+            return
+
+        self.log.error('Last {0} of {1} lines of output:'.format(
+            len(self.tail), self.lines
+        ), extra=SAMPLE)
+        for line in self.tail:
+            self.log.info(decode(line), extra=SAMPLE)
+
+
+class DirectOutput:
+    """
+    Output handling of steps whose output goes straight into the build log.
+
+    stdout and stderr of the process are the build log file itself, opened
+    for appending, so the output never passes through Python at all. Only
+    plain text logs can take it; see
+    :func:`piper.logging.BatchedFileHandler.takes_output`.
+
+    The file is tapped instead of the output: every `1 / rate` seconds, the
+    last line in it is logged like normal output, and if the process fails,
+    the last `tail` lines written since it started are read back and logged.
+    These records are left out of the log files, so that they never end up
+    in the file they were read from. The output of other steps would end up
+    in the tap, and in between the lines of the output, so builds that run
+    steps at the same time use :class:`BulkOutput` instead; see
+    :func:`piper.build.Build.share_build_log`.
+
+    """
+
+    direct = True
+    block_size = 2 ** 16
+
+    def __init__(self, log, handler, rate=10, tail=100):
+        self.log = log
+        self.handler = handler
+        self.interval = 1 / rate if rate else None
+        self.tail = tail
+
+        self.file = None
+        self.start = None
+        self.size = None
+        self.next_sample = 0
+
+    def open(self):
+        """
+        Return the build log file for the process to write to, once
+        everything logged so far is in it.
+
+        """
+
+        self.handler.flush()
+        self.file = open(self.handler.filename, 'a+b')
+        self.start = self.size = self.file.seek(0, os.SEEK_END)
+
+        return self.file
+
+    def sample(self):
+        """
+        Log the last line in the file, if it is time for a sample. Returns
+        whether the file has grown since the last call.
+
+        """
+
+        size = os.fstat(self.file.fileno()).st_size
+        if size == self.size:
+            return False
+
+        self.size = size
+        now = time.monotonic()
+        if self.interval is not None and now >= self.next_sample:
+            self.next_sample = now + self.interval
+            lines = self.read_tail(1)
+            if lines:
+                self.log.info(decode(lines[-1]), extra=SAMPLE)
+
+        return True
+
+    def read_tail(self, count):
+        """
+        Return the last `count` lines written since the process started.
+
+        The file is read backwards a block at a time, until enough lines
+        have been found.
+
+        """
+
+        pos = self.file.seek(0, os.SEEK_END)
+        data = b''
+        while pos > self.start and data.count(b'\n') <= count:
+            size = min(self.block_size, pos - self.start)
+            pos -= size
+            self.file.seek(pos)
+            data = self.file.read(size) + data
+
+        lines = data.split(b'\n')
+        if lines[-1] == b'':
+            lines.pop()
+
+        return lines[-count:] if count else []
+
+    def close(self, success):
+        """
+        Log a summary of the output, with its tail if the process failed.
+
+        """
+
+        try:
+            tail = [] if success else self.read_tail(self.tail)
+            written = os.fstat(self.file.fileno()).st_size - self.start
+        finally:
+            self.file.close()
+
+        if not tail:
+            self.log.info(
+                '{0} bytes of output written to the build log'.format(
+                    written
+                )
+            )
+            return
+
+        self.log.error(
+            'Last {0} lines of output:'.format(len(tail)), extra=SAMPLE
+        )
+        for line in tail:
+            self.log.info(decode(line), extra=SAMPLE)
+
+
+def decode(line):
+    return line.decode(errors='replace').strip()
+
+
+# Keys of the limits of a step and the resources they limit
+RLIMITS = (
+    ('memory', resource.RLIMIT_AS),
+    ('cpu', resource.RLIMIT_CPU),
+    ('files', resource.RLIMIT_NOFILE),
+)
+
+
+def get_rlimits(limits):
+    """
+    Return (resource, (soft, hard)) of the rlimits set in the limits of a
+    step. Both are set to the limit, but never above the current hard limit,
+    which a process cannot raise.
+
+    """
+
+    ret = []
+    for key, res in RLIMITS:
+        value = limits.get(key)
+        if value is None:
+            continue
+
+        _, hard = resource.getrlimit(res)
+        if hard != resource.RLIM_INFINITY:
+            value = min(value, hard)
+
+        ret.append((res, (value, value)))
+
+    return ret
+
+
+# Sets the rlimits given as `resource:soft:hard` arguments up to `--`, and
+# execs the command after it.
+RLIMIT_WRAPPER = '''
+import os, resource, sys
+end = sys.argv.index('--')
+for arg in sys.argv[1:end]:
+    res, soft, hard = map(int, arg.split(':'))
+    resource.setrlimit(res, (soft, hard))
+try:
+    os.execvp(sys.argv[end + 1], sys.argv[end + 1:])
+except OSError as exc:
+    sys.exit('Could not start process: {0}'.format(exc))
+'''
+
+
+def wrap_rlimits(args, rlimits):
+    """
+    Return the arguments to run `args` with rlimits from :func:`get_rlimits`.
+
+    The limits are set by a Python of its own that then execs the command,
+    rather than by piper between fork and exec. Nothing may run there that
+    could wait on the other threads of piper, like the steps running at the
+    same time and the log writers.
+
+    """
+
+    limits = [
+        '{0}:{1}:{2}'.format(res, soft, hard)
+        for res, (soft, hard) in rlimits
+    ]
+
+    return [sys.executable, '-I', '-S', '-c', RLIMIT_WRAPPER] + limits + \
+        ['--'] + args
+
+
+# Pids of the processes running, and of those of them that are in sessions
+# of their own, where they lead the process group.
+PROCESSES = set()
+SESSIONS = set()
+
+
+def interrupt_sessions():
+    """
+    Send SIGINT to the process groups of all processes running in sessions
+    of their own, which a Ctrl-C in the terminal does not reach.
+
+    """
+
+    for pid in list(SESSIONS):
+        try:
+            os.killpg(pid, signal.SIGINT)
+        except ProcessLookupError:
+            pass
+
+
+def interrupt_processes():
+    """
+    Send SIGINT to all running processes; to the whole process group of
+    those in sessions of their own.
+
+    """
+
+    for pid in list(PROCESSES):
+        try:
+            if pid in SESSIONS:
+                os.killpg(pid, signal.SIGINT)
+            else:
+                os.kill(pid, signal.SIGINT)
+        except ProcessLookupError:
+            pass
+
+
+def get_exitcode(status):
+    """
+    Return the exit code of a wait status, negative for a signal, like
+    Popen.returncode.
+
+    """
+
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+
+    return os.WEXITSTATUS(status)
+
+
+def get_rusage(rusage):
+    """
+    Return the interesting parts of a struct_rusage as a dict: CPU seconds
+    in user and system mode, the maximum resident set size in bytes, blocks
+    read and written and voluntary and involuntary context switches.
+
+    Linux carries the maximum RSS of a process over exec, so for processes
+    forked from piper it is never below what piper itself had at the time.
+
+    """
+
+    # Linux counts the maximum RSS in kilobytes, OS X in bytes.
+    rss_unit = 1 if sys.platform == 'darwin' else 1024
+
+    return {
+        'user': rusage.ru_utime,
+        'system': rusage.ru_stime,
+        'max_rss': rusage.ru_maxrss * rss_unit,
+        'blocks_in': rusage.ru_inblock,
+        'blocks_out': rusage.ru_oublock,
+        'voluntary_switches': rusage.ru_nvcsw,
+        'involuntary_switches': rusage.ru_nivcsw,
+    }
@@ -16,6 +16,7 @@ class Step(DynamicItem):
         self.index = ('x', 'y')
         self.key = key
         self.success = None
+        self.rusage = None
         self.log = logbook.Logger(key)
 
     def __repr__(self):  # pragma: nocover
@@ -27,9 +28,129 @@ class Step(DynamicItem):
             self._schema = super(Step, self).schema
             self._schema['required'].append('requirements')
             self._schema['properties']['requirements'] = REQUIREMENT_SCHEMA
+            self._schema['properties']['needs'] = {
+                'description':
+                    'Keys of steps that need to finish before this step can '
+                    'run. If not set, the step runs after the step before it '
+                    'in the pipeline.',
+                'type': ['array', 'null'],
+                'items': {'type': 'string'},
+            }
+            self._schema['properties']['cache'] = {
+                'description':
+                    'If set, a successful result of the step is cached and '
+                    'reused for as long as the step, its env and its inputs '
+                    'stay the same. Steps with bulk or direct output are '
+                    'never cached.',
+                'type': ['object', 'null'],
+                'additionalProperties': False,
+                'properties': {
+                    'inputs': {
+                        'description':
+                            'Files, directories or glob patterns that the '
+                            'step reads.',
+                        'type': 'array',
+                        'items': {'type': 'string'},
+                    },
+                },
+            }
+            self._schema['properties']['output'] = {
+                'description':
+                    "How the output of the step is logged. 'bulk' is for "
+                    'steps that print a lot: the output goes straight to the '
+                    'build log, and only a sample of it to the console. The '
+                    "last lines are shown if the step fails. 'direct' is "
+                    'like bulk, but the step writes to the build log file '
+                    'itself, without the output passing through piper. Only '
+                    'uncompressed text logs can take that, and only when '
+                    'the steps run one at a time; others get bulk.',
+                'type': ['object', 'null'],
+                'additionalProperties': False,
+                'properties': {
+                    'mode': {
+                        'description':
+                            "'log' logs every line. The default.",
+                        'enum': ['log', 'bulk', 'direct'],
+                    },
+                    'rate': {
+                        'description':
+                            'Lines per second that bulk and direct mode '
+                            'show on the console. Defaults to 10.',
+                        'type': 'number',
+                        'minimum': 0,
+                    },
+                    'tail': {
+                        'description':
+                            'Number of last lines that bulk and direct mode '
+                            'show if the step fails. Defaults to 100.',
+                        'type': 'integer',
+                        'minimum': 0,
+                    },
+                },
+            }
+
+            self._schema['properties']['limits'] = {
+                'description':
+                    'Limits of the process of the step. A process that '
+                    'goes over a timeout is killed, along with every '
+                    'process it started. Such a process runs in a session '
+                    'of its own, and piper passes Ctrl-C on to it.',
+                'type': ['object', 'null'],
+                'additionalProperties': False,
+                'properties': {
+                    'timeout': {
+                        'description': 'Seconds the step may run for.',
+                        'type': 'number',
+                        'exclusiveMinimum': True,
+                        'minimum': 0,
+                    },
+                    'idle_timeout': {
+                        'description':
+                            'Seconds the step may run for without any '
+                            'output.',
+                        'type': 'number',
+                        'exclusiveMinimum': True,
+                        'minimum': 0,
+                    },
+                    'memory': {
+                        'description':
+                            'Bytes of address space the process may use.',
+                        'type': 'integer',
+                        'minimum': 1,
+                    },
+                    'cpu': {
+                        'description':
+                            'Seconds of CPU time the process may use.',
+                        'type': 'integer',
+                        'minimum': 1,
+                    },
+                    'files': {
+                        'description':
+                            'Number of files the process may have open.',
+                        'type': 'integer',
+                        'minimum': 1,
+                    },
+                },
+            }
 
         return self._schema
 
+    @property
+    def needs(self):
+        return self.config.get('needs')
+
+    @property
+    def cache(self):
+        return self.config.get('cache')
+
+    @property
+    def output(self):
+        return self.config.get('output')
+
+    @property
+    def limits(self):
+        return self.config.get('limits')
+
     def set_index(self, cur, tot):
         """
         Store the order of the step running and set up the logger accordingly.
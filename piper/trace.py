@@ -0,0 +1,96 @@
+import json
+import logbook
+import os
+import threading
+
+
+class Tracer:
+    """
+    Collector of Chrome trace events.
+
+    The written file follows the Chrome Trace Event Format and can be loaded
+    into chrome://tracing or https://ui.perfetto.dev to see what a build spent
+    its time on. Everything is recorded as complete events, with timestamps
+    taken from the monotonic clock.
+
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.pid = os.getpid()
+        self.events = []
+        self.names = {}
+        self.lock = threading.Lock()
+
+        self.log = logbook.Logger(self.__class__.__name__)
+        self.name_process(self.pid, 'piper')
+
+    def complete(self, name, cat, start, duration, pid=None, tid=None,
+                 args=None):
+        """
+        Record an event that started at monotonic time `start` and lasted for
+        `duration` seconds.
+
+        If no pid and tid are given, the event is placed on the current thread
+        of this process.
+
+        """
+
+        if pid is None:
+            pid = self.pid
+        if tid is None:
+            thread = threading.current_thread()
+            tid = thread.ident
+            self.name_thread(pid, tid, thread.name)
+
+        event = {
+            'name': name,
+            'cat': cat,
+            'ph': 'X',
+            'ts': start * 1e6,
+            'dur': duration * 1e6,
+            'pid': pid,
+            'tid': tid,
+        }
+        if args:
+            event['args'] = args
+
+        with self.lock:
+            self.events.append(event)
+
+    def name_process(self, pid, name):
+        self.metadata('process_name', pid, pid, name)
+
+    def name_thread(self, pid, tid, name):
+        self.metadata('thread_name', pid, tid, name)
+
+    def metadata(self, kind, pid, tid, name):
+        with self.lock:
+            if self.names.get((kind, pid, tid)) == name:
+                return
+
+            self.names[(kind, pid, tid)] = name
+            self.events.append({
+                'name': kind,
+                'ph': 'M',
+                'pid': pid,
+                'tid': tid,
+                'args': {'name': name},
+            })
+
+    def write(self):
+        """
+        Write the collected events to the trace file.
+
+        """
+
+        with self.lock:
+            data = {
+                'traceEvents': list(self.events),
+                'displayTimeUnit': 'ms',
+            }
+
+        with open(self.filename, 'w') as f:
+            json.dump(data, f)
+
+        self.log.info("Trace written to '{0}'".format(self.filename))
@@ -19,6 +19,10 @@ install_requires = (
     'requests>=2.7.0,<3.0.0a0',
 )
 
+extras_require = {
+    'zstd': ['zstandard'],
+}
+
 tests_require = (
     'mock',
     'pytest-cov',
@@ -75,6 +79,7 @@ setup(
     license='MIT',
     packages=['piper'],
     install_requires=install_requires,
+    extras_require=extras_require,
     tests_require=tests_require,
     zip_safe=False,
     entry_points={
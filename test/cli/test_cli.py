@@ -37,6 +37,7 @@ class TestCLIEntry:
 
         for handler in self.cli.log_handlers:
             handler.push_application.assert_called_once_with()
+            handler.close.assert_called_once_with()
 
     def test_no_command_runs_help(self):
         self.ns.command = False
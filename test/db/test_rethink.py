@@ -1,11 +1,19 @@
+import datetime
+import itertools
 import os
+import threading
 import time
 import rethinkdb as rdb
 
 from piper.db.rethink import AgentManager
 from piper.db.rethink import BuildManager
+from piper.db.rethink import LogManager
 from piper.db.rethink import RethinkDB
+from piper.db.rethink import inserted
+from piper.db.rethink import unclaimed
+from piper.agent import Agent
 from piper.build import Build
+from piper.config import AgentConfig
 
 from mock import Mock
 from mock import call
@@ -36,6 +44,14 @@ def build_manager():
     return manager
 
 
+@pytest.fixture
+def log_manager():
+    db = Mock()
+    manager = LogManager(db)
+    manager.table = Mock()
+    return manager
+
+
 @pytest.fixture
 def rethinkdb():
     """
@@ -52,6 +68,7 @@ def rethinkdb():
     for key in ('a', 'b', 'c'):
         m = Mock()
         m.return_value.table_name = key
+        m.return_value.attribute = key
         rethink.managers.append(m)
     return rethink
 
@@ -182,6 +199,7 @@ class TestRethinkDbCreateTables(RethinkDbTest):
 
         self.rethinkdb.setup_managers = Mock(return_value=managers)
         self.rethinkdb.create_table = Mock()
+        self.rethinkdb.create_indexes = Mock()
         self.rethinkdb.create_tables(self.conn)
 
         calls = [
@@ -190,6 +208,10 @@ class TestRethinkDbCreateTables(RethinkDbTest):
         ]
 
         self.rethinkdb.create_table.assert_has_calls(calls)
+        self.rethinkdb.create_indexes.assert_has_calls([
+            call(managers[0], self.conn),
+            call(managers[1], self.conn),
+        ])
 
 
 class TestRethinkDbCreateTable(RethinkDbTest):
@@ -220,6 +242,24 @@ class TestRethinkDbCreateTable(RethinkDbTest):
         table_create.assert_called_once_with(self.manager.table_name)
 
 
+class TestRethinkDbCreateIndexes(RethinkDbTest):
+    def setup_method(self, method):
+        super(TestRethinkDbCreateIndexes, self).setup_method(method)
+        self.manager = Mock(table_name='build', indexes=('created', 'agent'))
+
+    @patch('rethinkdb.table')
+    def test_creation(self, table):
+        table.return_value.index_list.return_value.run.return_value = [
+            'agent',
+        ]
+
+        self.rethinkdb.create_indexes(self.manager, self.conn)
+
+        table.assert_called_once_with('build')
+        table.return_value.index_create.assert_called_once_with('created')
+        assert table.return_value.index_wait.return_value.run.call_count == 1
+
+
 class TestRethinkDbSetupManagers:
     def test_in_return_value(self, rethinkdb):
         ret = rethinkdb.setup_managers()
@@ -265,6 +305,130 @@ class TestRethinkDbIntegration:
         item = ret.next()
         assert item['success'] is True
 
+    def test_build_claim(self, rethink, piper):
+        """
+        Assert that out of many agents claiming a build at the same time,
+        exactly one wins.
+
+        """
+
+        build = Build(piper)
+        id = rethink.build.add(build)
+
+        barrier = threading.Barrier(20)
+        results = {}
+
+        def claim(agent_id):
+            # Every agent has a connection of its own.
+            conn = rdb.connect(
+                host=os.getenv('RETHINKDB_TEST_HOST', "localhost"),
+                port=os.getenv('RETHINKDB_TEST_PORT', 28015),
+                db=rethink.conn.db,
+            )
+            manager = BuildManager(Mock(conn=conn))
+
+            barrier.wait()
+            results[agent_id] = manager.claim(id, agent_id)
+            conn.close()
+
+        threads = [
+            threading.Thread(target=claim, args=('agent-{0}'.format(x),))
+            for x in range(20)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        winners = [agent for agent, won in results.items() if won]
+        assert len(results) == 20
+        assert len(winners) == 1
+
+        item = rethink.build.get(id)
+        assert item['agent'] == winners[0]
+        assert item['started'] is not None
+
+    def test_build_feed(self, rethink, piper):
+        """
+        Assert that the feed yields the pending builds in creation order,
+        and then new ones.
+
+        """
+
+        def add(minute, claimed=False):
+            build = Build(piper)
+            build.created = datetime.datetime(
+                2015, 6, 1, 12, minute, tzinfo=rdb.make_timezone('00:00')
+            )
+            id = rethink.build.add(build)
+            if claimed:
+                rethink.build.claim(id, 'other')
+            return id
+
+        second = add(2)
+        add(1, claimed=True)
+        first = add(0)
+
+        feed = rethink.build.feed()
+        assert next(feed)['new_val']['id'] == first
+        assert next(feed)['new_val']['id'] == second
+
+        third = add(3)
+        change = next(feed)
+        assert change['old_val'] is None
+        assert change['new_val']['id'] == third
+
+    def test_build_feed_filter(self, rethink, piper):
+        """
+        Assert that a filtered feed only yields the builds that match, and
+        no other changes.
+
+        """
+
+        def add(pipeline):
+            build = Build(piper)
+            build.config = {'pipeline': pipeline}
+            return rethink.build.add(build)
+
+        def filter(build):
+            return build['config']['pipeline'].eq('test')
+
+        add('deploy')
+        first = add('test')
+
+        feed = rethink.build.feed(filter=filter)
+        assert next(feed)['new_val']['id'] == first
+
+        rethink.build.claim(first, 'other')
+        add('deploy')
+        second = add('test')
+        assert next(feed)['new_val']['id'] == second
+
+    def test_agent_eligible(self, rethink, piper):
+        """
+        Assert that the build filter of an agent lets through the builds
+        for any agent and those that list it, but not those for others.
+
+        """
+
+        def add(config):
+            build = Build(piper)
+            build.config = config
+            return rethink.build.add(build)
+
+        anyone = add({})
+        unset = add({'eligible_agents': None})
+        listed = add({'eligible_agents': ['other', 'a1']})
+        add({'eligible_agents': ['other']})
+        add({'eligible_agents': []})
+
+        agent = Agent(AgentConfig().load())
+        agent.id = 'a1'
+
+        ret = rethink.build.table.filter(agent.eligible).run(rethink.conn)
+        assert sorted(build['id'] for build in ret) == \
+            sorted((anyone, unset, listed))
+
 
 class TestAgentManagerGet:
     def test_get(self, agent_manager):
@@ -322,6 +486,162 @@ class TestBuildManagerUpdate:
         assert build_manager.table.update.return_value.run.call_count == 1
 
 
+class TestBuildManagerClaim:
+    def run(self, build_manager):
+        return build_manager.table.get.return_value.update.return_value.run
+
+    def test_won(self, build_manager):
+        self.run(build_manager).return_value = {'replaced': 1}
+
+        assert build_manager.claim('build', 'agent') is True
+        build_manager.table.get.assert_called_once_with('build')
+
+    def test_lost(self, build_manager):
+        self.run(build_manager).return_value = {
+            'replaced': 0, 'unchanged': 1,
+        }
+
+        assert build_manager.claim('build', 'agent') is False
+
+
+class TestBuildManagerResume:
+    def setup_method(self, method):
+        self.manager = BuildManager(Mock())
+        self.manager.table = Mock()
+
+    def set_feed(self, pending, changes):
+        table = self.manager.table
+        table.changes.return_value.run.return_value = iter(changes)
+        query = table.order_by.return_value.filter.return_value
+        query.run.return_value = iter(pending)
+
+    def test_pending_first_without_duplicates(self):
+        b1, b2, b3 = ({'id': id} for id in ('b1', 'b2', 'b3'))
+        self.set_feed([b1, b2], [
+            {'old_val': None, 'new_val': b2},
+            {'old_val': None, 'new_val': b3},
+            {'old_val': b1, 'new_val': b1},
+            {'old_val': b3, 'new_val': None},
+        ])
+
+        ret = list(self.manager.resume())
+
+        assert ret == [
+            {'old_val': None, 'new_val': b1},
+            {'old_val': None, 'new_val': b2},
+            {'old_val': None, 'new_val': b3},
+            {'old_val': b1, 'new_val': b1},
+            {'old_val': b3, 'new_val': None},
+        ]
+
+    def test_feed_is_opened_first(self):
+        self.set_feed([], [])
+        order = []
+        table = self.manager.table
+        table.changes.side_effect = lambda: order.append('changes') or \
+            table.changes.return_value
+        table.order_by.side_effect = lambda **kw: order.append('pending') or \
+            table.order_by.return_value
+
+        list(self.manager.resume())
+
+        assert order == ['changes', 'pending']
+        table.order_by.assert_called_once_with(index='created')
+        table.order_by.return_value.filter.assert_called_once_with(unclaimed)
+
+    def test_filter(self):
+        table = self.manager.table
+        filter = Mock()
+        changes = table.changes.return_value.filter.return_value
+        b1, b2 = {'id': 'b1'}, {'id': 'b2'}
+        changes.run.return_value = iter([{'old_val': None, 'new_val': b2}])
+        pending = table.order_by.return_value.filter.return_value
+        pending.filter.return_value.run.return_value = iter([b1])
+
+        ret = list(self.manager.resume(filter))
+
+        assert [c['new_val'] for c in ret] == [b1, b2]
+        pending.filter.assert_called_once_with(filter)
+        assert table.changes.return_value.filter.call_count == 1
+        assert table.changes.return_value.run.call_count == 0
+
+    def test_feed_passes_filter(self):
+        filter = Mock()
+        self.manager.resume = Mock(return_value=iter(['c1']))
+
+        next(self.manager.feed(filter))
+
+        self.manager.resume.assert_called_once_with(filter)
+
+
+class TestInserted:
+    def test_predicate(self):
+        filter = Mock(return_value=rdb.expr(True))
+        change = {
+            'old_val': rdb.expr(None),
+            'new_val': rdb.expr({'id': 'b1'}),
+        }
+
+        ret = inserted(filter)(change)
+
+        assert isinstance(ret, rdb.ast.RqlQuery)
+        filter.assert_called_once_with(change['new_val'])
+
+
+class TestBuildManagerFeed:
+    def setup_method(self, method):
+        self.manager = BuildManager(Mock())
+        self.manager.resume = Mock()
+
+    def resume(self, *results):
+        """
+        Make every call of resume() yield the items of the next result,
+        raising the exceptions among them.
+
+        """
+
+        def resume(filter=None):
+            for item in next(results):
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+
+        results = iter(results)
+        self.manager.resume.side_effect = resume
+
+    @patch('time.sleep')
+    def test_reconnects_with_backoff(self, sleep):
+        lost = rdb.ReqlDriverError('Connection is closed.')
+        self.resume([lost], [lost], [lost], ['c1', 'c2', lost], ['c3'])
+
+        ret = list(itertools.islice(self.manager.feed(), 3))
+
+        assert ret == ['c1', 'c2', 'c3']
+        assert [c[0][0] for c in sleep.call_args_list] == [1, 2, 4, 1]
+        assert self.manager.conn.reconnect.call_count == 4
+
+    @patch('time.sleep')
+    def test_backoff_is_capped(self, sleep):
+        lost = rdb.ReqlAvailabilityError('Changefeed aborted.')
+        self.manager.max_retry_delay = 3
+        self.resume([lost], [lost], [lost], ['c1'])
+
+        list(itertools.islice(self.manager.feed(), 1))
+
+        assert [c[0][0] for c in sleep.call_args_list] == [1, 2, 3]
+
+    @patch('time.sleep')
+    def test_failed_reconnect(self, sleep):
+        lost = rdb.ReqlDriverError('Connection is closed.')
+        self.resume([lost], ['c1'])
+        self.manager.conn.reconnect.side_effect = [lost, None]
+
+        ret = list(itertools.islice(self.manager.feed(), 1))
+
+        assert ret == ['c1']
+        assert [c[0][0] for c in sleep.call_args_list] == [1, 2]
+
+
 class TestBuildManagerGet:
     def test_get(self, build_manager):
         id = 'guilty.of.loving.you'
@@ -333,11 +653,17 @@ class TestBuildManagerGet:
         assert ret is run.return_value
 
 
-class TestBuildManagerFeed:
-    def test_feed(self, build_manager):
-        ret = build_manager.feed()
+class TestLogManagerAdd:
+    def test_add(self, log_manager):
+        records = [Mock(), Mock()]
+        ret = log_manager.add(records)
 
-        run = build_manager.table.changes.return_value.run
-        build_manager.table.changes.assert_called_once_with()
+        run = log_manager.table.insert.return_value.run
+        log_manager.table.insert.assert_called_once_with(records)
         assert run.call_count == 1
         assert ret is run.return_value
+
+    def test_attribute(self, log_manager, agent_manager):
+        # The `log` attribute is the logger of the database.
+        assert log_manager.attribute == 'logs'
+        assert agent_manager.attribute == 'agent'
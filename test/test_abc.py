@@ -1,5 +1,6 @@
 from piper.abc import DynamicItem
 
+import jsonschema
 import mock
 import pytest
 
@@ -72,3 +73,52 @@ class TestDynamicItemValidateRequirements:
 
         calls = [mock.call(self.first), mock.call(self.second)]
         self.cls.return_value.validate.assert_has_calls(calls, any_order=True)
+
+
+class TestDynamicItemCompile:
+    def setup_method(self, method):
+        # A fresh class for every test, so that nothing is cached for it yet.
+        class Item(DynamicItem):
+            @property
+            def schema(self):
+                if not hasattr(self, '_schema'):
+                    self._schema = super(Item, self).schema
+                    self._schema['properties']['heaven'] = {
+                        'type': 'string',
+                        'default': 'tonight',
+                    }
+
+                return self._schema
+
+        self.cls = Item
+
+    def test_schema_built_once_per_class(self):
+        first = self.cls(mock.Mock(), {'class': 'a'})
+        second = self.cls(mock.Mock(), {'class': 'b'})
+
+        assert first.schema is second.schema
+        assert first.validator is second.validator
+        assert 'heaven' in second.schema['properties']
+
+    @mock.patch('jsonschema.validators.validator_for')
+    def test_validator_compiled_once_per_class(self, validator_for):
+        self.cls(mock.Mock(), {'class': 'a'})
+        self.cls(mock.Mock(), {'class': 'b'})
+
+        validator = validator_for.return_value
+        assert validator_for.call_count == 1
+        validator.check_schema.assert_called_once_with(
+            validator.call_args[0][0]
+        )
+
+    def test_defaults_still_set(self):
+        self.cls(mock.Mock(), {'class': 'a'})
+        item = self.cls(mock.Mock(), {'class': 'b'})
+
+        assert item.config['heaven'] == 'tonight'
+
+    def test_validate(self):
+        item = self.cls(mock.Mock(), {'class': 'a', 'heaven': 1})
+
+        with pytest.raises(jsonschema.exceptions.ValidationError):
+            item.validate()
@@ -1,5 +1,12 @@
+import json
+import logbook
+import os
+import threading
+import time
 import uuid
 import pytest
+import rethinkdb as rdb
+from rethinkdb import ql2_pb2
 from mock import Mock
 from mock import patch
 
@@ -7,7 +14,10 @@ from piper import utils
 from piper.agent import Agent
 from piper.agent import AgentAPI
 from piper.agent import AgentCLI
+from piper.agent import Facts
+from piper.agent import run_build
 from piper.config import AgentConfig
+from piper.logging import BatchedFileHandler
 
 
 @pytest.fixture
@@ -16,6 +26,7 @@ def agent():
     agent = Agent(config)
     agent.id = 'maiden-voyage'
     agent.db = Mock()
+    agent.facts = Mock()
 
     return agent
 
@@ -44,8 +55,8 @@ def started_change():
         'old_val': None,
         'new_val': {
             'id': 'alice-in-videoland',
+            'started': utils.now(),
             'config': {
-                'started': utils.now(),
                 'eligible_agents': ['maiden-voyage']
             },
         },
@@ -141,6 +152,46 @@ class TestAgentListen:
 
         assert agent.handle.call_count == length
 
+    def test_feed_is_filtered(self, agent):
+        agent.db.build.feed = Mock(return_value=[])
+
+        agent.listen()
+
+        agent.db.build.feed.assert_called_once_with(filter=agent.eligible)
+
+
+def build_term(term):
+    """
+    Build a ReQL term into the nested lists that are sent to the server.
+
+    """
+
+    if isinstance(term, rdb.ast.RqlQuery):
+        return build_term(term.build())
+    if isinstance(term, list):
+        return [build_term(arg) for arg in term]
+
+    return term
+
+
+class TestAgentEligible:
+    def test_eligible(self, agent):
+        T = ql2_pb2.Term.TermType
+        agents = [T.DEFAULT, [
+            [T.BRACKET, [
+                [T.BRACKET, [[T.IMPLICIT_VAR, []], 'config']],
+                'eligible_agents',
+            ]],
+            None,
+        ]]
+
+        ret = agent.eligible(rdb.row)
+
+        assert build_term(ret) == [T.OR, [
+            [T.EQ, [agents, None]],
+            [T.CONTAINS, [agents, 'maiden-voyage']],
+        ]]
+
 
 class TestAgentHandle:
     def test_deleted_item(self, nobuild_agent, deleted_change):
@@ -152,6 +203,17 @@ class TestAgentHandle:
         ret = nobuild_agent.handle(started_change)
 
         assert ret is None
+        assert nobuild_agent.db.build.claim.call_count == 0
+
+    def test_claimed_by_another_agent(self, nobuild_agent, applicable_change):
+        nobuild_agent.db.build.claim.return_value = False
+        ret = nobuild_agent.handle(applicable_change)
+
+        assert ret is None
+        nobuild_agent.db.build.claim.assert_called_once_with(
+            'alice-in-videoland', 'maiden-voyage'
+        )
+        assert nobuild_agent.build.call_count == 0
 
     @pytest.mark.skipif(True, reason='eligibility disabled')
     def test_not_eligible_to_build(self, nobuild_agent, nonapplicable_change):
@@ -161,6 +223,7 @@ class TestAgentHandle:
 
     def test_passing(self, nobuild_agent, applicable_change):
         nobuild_agent.build = Mock()
+        nobuild_agent.db.build.claim.return_value = True
         ret = nobuild_agent.handle(applicable_change)
 
         assert ret is nobuild_agent.build.return_value
@@ -170,64 +233,577 @@ class TestAgentHandle:
         )
 
 
+def touch(id, config, debug=False):
+    open(os.path.join(config['path'], id), 'w').close()
+
+
+def run_stub_build(id, config, debug=False):
+    """
+    Run a build like run_build does, without the build itself. Patches do not
+    reach spawned workers, so they are made in the worker.
+
+    """
+
+    with patch('piper.agent.BuildConfig'), patch('piper.agent.Build'):
+        return run_build(id, config, debug)
+
+
+class ClaimingBuildManager:
+    """
+    Build manager that claims builds the way the database does: with a
+    conditional update that nothing can come in between of.
+
+    """
+
+    def __init__(self):
+        self.builds = {}
+        self.lock = threading.Lock()
+
+    def claim(self, build_id, agent_id):
+        with self.lock:
+            build = self.builds.setdefault(build_id, {})
+            if build.get('agent') is not None or \
+                    build.get('started') is not None:
+                return False
+
+            build['agent'] = agent_id
+            build['started'] = utils.now()
+            return True
+
+
+class TestAgentClaimContention:
+    def test_one_agent_builds(self, applicable_change):
+        config = AgentConfig().load()
+        manager = ClaimingBuildManager()
+        barrier = threading.Barrier(50)
+        agents = []
+
+        for x in range(50):
+            a = Agent(config)
+            a.id = 'agent-{0}'.format(x)
+            a.db = Mock()
+            a.db.build = manager
+            a.build = Mock()
+            agents.append(a)
+
+        def handle(a):
+            barrier.wait()
+            a.handle(applicable_change)
+
+        threads = [threading.Thread(target=handle, args=(a,)) for a in agents]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+
+        builders = [a for a in agents if a.build.called]
+        assert len(builders) == 1
+        assert manager.builds['alice-in-videoland']['agent'] == \
+            builders[0].id
+
+
 class TestAgentBuild:
-    @patch('piper.agent.Build')
-    def test_busy_setting(self, build, agent, build_id, config):
+    @patch('piper.agent.multiprocessing.get_context')
+    def test_build_starts_worker(self, get_context, agent, config):
+        Process = get_context.return_value.Process
         agent.update = Mock()
-        agent.build(build_id, config)
+        agent.reap = Mock()
+        Process.return_value.join = Mock()
 
-        # One to lock, one to unlock.
-        assert agent.update.call_count == 2
+        worker = agent.build('b1', config)
 
-    @patch('piper.agent.Build')
-    def test_busy_exception_handling(self, build, agent, config):
+        assert worker is Process.return_value
+        config = dict(config, db=agent.config.raw['db'])
+        Process.assert_called_once_with(
+            target=run_build, args=('b1', config, False), name='build b1',
+        )
+        get_context.assert_called_once_with('spawn')
+        worker.start.assert_called_once_with()
+        assert agent.building == {'b1'}
+        assert agent.update.call_count == 1
+
+    @patch('piper.agent.run_build', touch)
+    def test_build_in_worker_process(self, agent, tmpdir):
+        agent.update = Mock()
+        worker = agent.build('b1', {'path': str(tmpdir)})
+        worker.join(5)
+
+        assert worker.exitcode == 0
+        assert worker.pid != os.getpid()
+        assert tmpdir.join('b1').check()
+
+        end = time.monotonic() + 5
+        while agent.building and time.monotonic() < end:
+            time.sleep(0.01)
+        assert agent.building == set()
+
+    @patch('piper.agent.run_build', run_stub_build)
+    def test_worker_does_not_log_to_agent_handlers(self, agent, config,
+                                                   tmpdir, monkeypatch):
+        monkeypatch.chdir(str(tmpdir))
+        agent.update = Mock()
+
+        # A forked worker would have this handler, but not its writer
+        # thread, and the second record would wait for room in the queue
+        # forever.
+        handler = BatchedFileHandler(str(tmpdir.join('agent.log')),
+                                     max_queue=1)
+        with handler.applicationbound():
+            worker = agent.build('b1', config)
+            worker.join(5)
+            if worker.is_alive():  # pragma: nocover
+                worker.terminate()
+        handler.close()
+
+        assert worker.exitcode == 0
+        assert 'Starting build' not in tmpdir.join('agent.log').read()
+        session = tmpdir.join('logs', 'piper', 'session', 'build-b1.log')
+        assert 'Starting build' in session.read()
+
+    def test_reap_frees_slot(self, agent):
+        agent.update = Mock()
+        agent.building = {'b1', 'b2'}
+
+        agent.reap('b1', Mock(exitcode=0))
+
+        assert agent.building == {'b2'}
+        assert agent.update.call_count == 1
+
+    def test_reap_failed_worker(self, agent):
         agent.update = Mock()
         agent.log = Mock()
+        agent.building = {'b1'}
+
+        agent.reap('b1', Mock(exitcode=1))
+
+        agent.log.error.assert_called_once_with(
+            'Build worker b1 exited with 1'
+        )
+        assert agent.building == set()
+
+
+class TestAgentSlots:
+    def test_slots_from_config(self, agent):
+        assert agent.slots == 1
+
+        agent.config.raw['agent']['slots'] = 4
+        assert Agent(agent.config).slots == 4
+
+    def test_busy(self, agent):
+        agent.slots = 2
+        assert agent.busy() is False
+
+        agent.building = {'b1'}
+        assert agent.busy() is False
+
+        agent.building = {'b1', 'b2'}
+        assert agent.busy() is True
+
+    def test_wait_for_slot(self, agent):
+        agent.update = Mock()
+        agent.slots = 1
+        agent.lock('b1')
+
+        timer = threading.Timer(0.05, agent.unlock, ('b1',))
+        timer.start()
+        agent.wait_for_slot()
+        timer.join()
+
+        assert agent.busy() is False
+
+    def test_listen_waits_for_slot(self, agent):
+        agent.handle = Mock()
+        agent.wait_for_slot = Mock()
+        agent.db.build.feed = Mock(return_value=[Mock()])
+
+        agent.listen()
+
+        agent.wait_for_slot.assert_called_once_with()
+
+    def test_building_in_db_fields(self, agent):
+        agent.building = {'b2', 'b1'}
+
+        assert agent.as_dict()['building'] == ['b1', 'b2']
+
+
+class TestRunBuild:
+    def setup_method(self, method):
+        self.handler = logbook.TestHandler()
+        self.patcher = patch(
+            'piper.agent.logging.get_handlers', return_value=(self.handler,)
+        )
+        self.get_handlers = self.patcher.start()
+
+    def teardown_method(self, method):
+        self.patcher.stop()
+
+    @patch('piper.agent.BuildConfig')
+    @patch('piper.agent.Build')
+    def test_build_calls(self, build, buildconfig, config):
+        load = buildconfig.return_value.load.return_value
+        load.raw = config
+        ret = run_build('b1', config)
+
+        build.assert_called_once_with(load)
+        assert build.return_value.id == 'b1'
+        build.return_value.run.assert_called_once_with('build', 'local')
+        assert ret is build.return_value.run.return_value
+
+    @patch('piper.agent.BuildConfig')
+    @patch('piper.agent.Build')
+    def test_pipeline_and_env_from_config(self, build, buildconfig, config):
+        config.update(pipeline='test', env='venv')
+        buildconfig.return_value.load.return_value.raw = config
+        run_build('b1', config)
+
+        build.return_value.run.assert_called_once_with('test', 'venv')
+
+    @patch('piper.env.Env.execute')
+    @patch('piper.config.Config.get_database')
+    def test_logs_are_shipped(self, get_database, execute, tmpdir,
+                              monkeypatch):
+        execute.return_value = Mock(success=True, rusage=None)
+        monkeypatch.chdir(str(tmpdir))
+        config = {
+            'version': {
+                'class': 'piper.version.StaticVersion',
+                'version': '1.0',
+            },
+            'envs': {
+                'local': {'class': 'piper.env.Env', 'requirements': None},
+            },
+            'steps': {
+                'true': {
+                    'class': 'piper.step.CommandLineStep',
+                    'command': 'true',
+                    'requirements': None,
+                },
+            },
+            'pipelines': {'build': ['true']},
+            'db': {'class': 'piper.db.rethink.RethinkDB'},
+        }
+
+        assert run_build('b1', config) is True
+
+        logs = get_database.return_value.logs
+        assert logs.add.call_count >= 1
+        records = [r for call in logs.add.call_args_list for r in call[0][0]]
+        assert {r['build'] for r in records} == {'b1'}
+        assert tmpdir.join('logs', 'piper', 'b1.log').check()
+
+    @patch('piper.agent.BuildConfig')
+    @patch('piper.agent.Build')
+    def test_logs_to_handlers_of_its_own(self, build, buildconfig, config):
+        outer = logbook.TestHandler()
+        with outer.applicationbound():
+            run_build('b1', config, True)
+
+        self.get_handlers.assert_called_once_with(True, 'build-b1')
+        assert self.handler.has_info('Starting build...')
+        assert outer.records == []
+
+        # The handlers are popped again.
+        with outer.applicationbound():
+            logbook.Logger('after').info('Done')
+        assert outer.has_info('Done')
+
+    @patch('piper.agent.logbook.Logger')
+    @patch('piper.agent.Build')
+    def test_exception_handling(self, build, Logger, config):
         build.side_effect = Exception()
 
-        agent.build(build_id, config)
+        with pytest.raises(SystemExit):
+            run_build('b1', config)
 
         # It's inherently silly to mock logging, but in this case we actually
         # want to make sure that the logging is logging the exception.
-        agent.log.exception.assert_called_once_with(
+        Logger.return_value.exception.assert_called_once_with(
             'Build threw internal exception'
         )
 
-        assert agent.update.call_count == 2
-        assert agent.building is None
 
-    @patch('piper.agent.BuildConfig')
-    @patch('piper.agent.Build')
-    def test_build_calls(self, build, buildconfig, agent, config):
+class TestAgentProperties:
+    def test_facts(self, agent):
+        agent.facts.get.return_value = {'kernel': 'Linux'}
+        assert agent.properties == {'kernel': 'Linux'}
+
+    def test_no_facts_yet(self, agent):
+        agent.facts.get.return_value = None
+        assert agent.properties == {}
+
+    def test_ttl_from_config(self, agent):
+        agent.config.raw['agent']['facts_ttl'] = 60
+        assert Agent(agent.config).facts.ttl == 60
+
+    def test_refreshed_updates(self, agent):
         agent.update = Mock()
-        agent.build(build_id, config)
+        agent.refreshed({'kernel': 'Linux'})
 
-        load = buildconfig.return_value.load.return_value
-        build.assert_called_once_with(load)
-        build.return_value.run.assert_called_once_with()
+        agent.update.assert_called_once_with()
 
+    @patch('piper.agent.oneshot')
+    def test_refreshed_facts_sent_by_updater(self, oneshot, agent, tmpdir):
+        oneshot.return_value = '{"a": 1}'
+        sent = threading.Event()
+        threads = []
+
+        def update(data):
+            threads.append((threading.current_thread(), data['properties']))
+            sent.set()
+
+        manager = Mock()
+        manager.update.side_effect = update
+        agent.connect_agent_db = Mock(return_value=manager)
+        agent.facts = Facts(path=str(tmpdir.join('facts.json')),
+                            on_refresh=agent.refreshed)
+
+        agent.facts.get()
+        assert sent.wait(5)
+
+        assert threads == [(agent.updater, {'a': 1})]
+        assert agent.db.agent.update.call_count == 0
+
+    @patch('piper.agent.oneshot')
+    def test_register_does_not_wait_for_facter(self, oneshot, agent, tmpdir):
+        done = threading.Event()
+        oneshot.side_effect = lambda cmd: done.wait(5) and '{"a": 1}'
+        agent.facts = Facts(path=str(tmpdir.join('facts.json')))
+        agent.db.agent.get.return_value = None
+
+        agent.register()
+        thread = agent.facts.refreshing
+        done.set()
+        thread.join(5)
+
+        assert agent.db.agent.add.call_args[0][0]['properties'] == {}
+        assert agent.properties == {'a': 1}
+
+
+class TestFacts:
+    def setup_method(self, method):
+        self.on_refresh = Mock()
+
+    def facts(self, tmpdir, ttl=60):
+        return Facts(
+            ttl, path=str(tmpdir.join('piper', 'facts.json')),
+            on_refresh=self.on_refresh,
+        )
+
+    def cache(self, tmpdir, data, age=0):
+        path = tmpdir.mkdir('piper').join('facts.json')
+        path.write(json.dumps(data))
+        mtime = time.time() - age
+        os.utime(str(path), (mtime, mtime))
+
+    def get(self, facts):
+        """
+        Get the facts and wait for any refresh it started.
+
+        """
+
+        ret = facts.get()
+        thread = facts.refreshing
+        if thread is not None:
+            thread.join(5)
+
+        return ret, thread
 
-class TestAgentProperties:
-    @patch('json.loads')
     @patch('piper.agent.oneshot')
-    def test_calls(self, oneshot, loads, agent):
-        ret = agent.properties
+    def test_fresh_cache(self, oneshot, tmpdir):
+        self.cache(tmpdir, {'a': 1}, age=10)
 
+        ret, thread = self.get(self.facts(tmpdir))
+
+        assert ret == {'a': 1}
+        assert thread is None
+        assert oneshot.call_count == 0
+
+    @patch('piper.agent.oneshot')
+    def test_stale_cache(self, oneshot, tmpdir):
+        oneshot.return_value = '{"a": 2}'
+        self.cache(tmpdir, {'a': 1}, age=120)
+        facts = self.facts(tmpdir)
+
+        ret, thread = self.get(facts)
+
+        assert ret == {'a': 1}
+        assert thread is not None
         oneshot.assert_called_once_with('facter --json')
-        loads.assert_called_once_with(oneshot.return_value)
+        self.on_refresh.assert_called_once_with({'a': 2})
+        assert facts.get() == {'a': 2}
+        assert facts.refreshing is None
+
+    @patch('piper.agent.oneshot')
+    def test_no_cache(self, oneshot, tmpdir):
+        oneshot.return_value = '{"a": 1}'
+        facts = self.facts(tmpdir)
+
+        ret, thread = self.get(facts)
+
+        assert ret is None
+        assert thread is not None
+        assert json.loads(tmpdir.join('piper', 'facts.json').read()) == \
+            {'a': 1}
+        assert self.facts(tmpdir).get() == {'a': 1}
+
+    @patch('piper.agent.oneshot')
+    def test_broken_cache(self, oneshot, tmpdir):
+        oneshot.return_value = '{"a": 1}'
+        tmpdir.mkdir('piper').join('facts.json').write('{"a":')
+
+        ret, thread = self.get(self.facts(tmpdir))
+
+        assert ret is None
+        assert thread is not None
+
+    @patch('piper.agent.oneshot')
+    def test_one_refresh_at_a_time(self, oneshot, tmpdir):
+        done = threading.Event()
+        oneshot.side_effect = lambda cmd: done.wait(5) and '{"a": 1}'
+        facts = self.facts(tmpdir)
+
+        facts.get()
+        thread = facts.refreshing
+        facts.get()
+        done.set()
+        thread.join(5)
+
+        assert oneshot.call_count == 1
+
+    @patch('piper.agent.oneshot')
+    def test_failed_refresh(self, oneshot, tmpdir):
+        oneshot.side_effect = Exception('facter: command not found')
+        self.cache(tmpdir, {'a': 1}, age=120)
+        facts = self.facts(tmpdir)
+        facts.log = Mock()
+
+        ret, thread = self.get(facts)
+
+        assert ret == {'a': 1}
+        assert facts.refreshing is None
+        assert self.on_refresh.call_count == 0
+        facts.log.exception.assert_called_once_with(
+            'Grabbing facter facts failed'
+        )
+
+        # The stale facts are still served, and facter is left alone for a
+        # while.
+        ret, thread = self.get(facts)
+        assert ret == {'a': 1}
+        assert thread is None
+        assert oneshot.call_count == 1
+
+    @patch('piper.agent.oneshot')
+    def test_retry_after_failed_refresh(self, oneshot, tmpdir):
+        oneshot.side_effect = [Exception(), '{"a": 2}']
+        facts = self.facts(tmpdir)
+        facts.log = Mock()
+        facts.retry = 30
+
+        self.get(facts)
+        facts.failed -= 31
+        ret, thread = self.get(facts)
+
+        assert thread is not None
+        assert oneshot.call_count == 2
+        assert facts.failed is None
+        assert facts.get() == {'a': 2}
+
+    @patch('piper.agent.oneshot')
+    def test_retry_at_most_ttl(self, oneshot, tmpdir):
+        oneshot.side_effect = Exception()
+        facts = self.facts(tmpdir, ttl=10)
+        facts.log = Mock()
+
+        self.get(facts)
+        facts.failed -= 11
+        ret, thread = self.get(facts)
+
+        assert thread is not None
+        assert oneshot.call_count == 2
+
+    @patch('piper.agent.oneshot')
+    def test_unwritable_cache(self, oneshot, tmpdir):
+        oneshot.return_value = '{"a": 1}'
+        tmpdir.join('piper').write('not a directory')
+        facts = self.facts(tmpdir)
+        facts.log = Mock()
 
-        assert ret is loads.return_value
-        assert agent._properties is ret
+        self.get(facts)
+
+        assert facts.log.warn.call_count == 1
+        assert facts.get() == {'a': 1}
 
 
 class TestAgentUpdate:
+    def setup_method(self, method):
+        self.manager = Mock()
+
+    def wait_for_sends(self, count):
+        end = time.monotonic() + 5
+        while self.manager.update.call_count < count and \
+                time.monotonic() < end:
+            time.sleep(0.01)
+
+        # Give the updater a moment to send anything it should not.
+        time.sleep(0.05)
+
     def test_send(self, agent):
+        agent.connect_agent_db = Mock(return_value=self.manager)
         agent.as_dict = Mock()
         agent.update()
+        self.wait_for_sends(1)
 
-        agent.db.agent.update.assert_called_once_with(
+        self.manager.update.assert_called_once_with(
             agent.as_dict.return_value
         )
+        assert agent.db.agent.update.call_count == 0
+
+    def test_sent_by_updater_thread(self, agent):
+        threads = []
+        self.manager.update.side_effect = \
+            lambda data: threads.append(threading.current_thread())
+        agent.connect_agent_db = Mock(return_value=self.manager)
+
+        reaper = threading.Thread(target=agent.unlock, args=('b1',))
+        reaper.start()
+        reaper.join(5)
+        self.wait_for_sends(1)
+
+        assert threads == [agent.updater]
+        agent.connect_agent_db.assert_called_once_with()
+
+    def test_pending_updates_are_sent_as_one(self, agent):
+        done = threading.Event()
+        self.manager.update.side_effect = lambda data: done.wait(5)
+        agent.connect_agent_db = Mock(return_value=self.manager)
+
+        agent.update()
+        self.wait_for_sends(1)
+
+        agent.building = {'b1'}
+        agent.update()
+        agent.update()
+        done.set()
+        self.wait_for_sends(2)
+
+        assert self.manager.update.call_count == 2
+        assert self.manager.update.call_args[0][0]['building'] == ['b1']
+
+    def test_failed_update(self, agent):
+        self.manager.update.side_effect = [Exception(), None]
+        agent.connect_agent_db = Mock(return_value=self.manager)
+        agent.log = Mock()
+
+        agent.update()
+        self.wait_for_sends(1)
+        agent.update()
+        self.wait_for_sends(2)
+
+        assert self.manager.update.call_count == 2
+        agent.log.exception.assert_called_once_with(
+            'Could not update the agent'
+        )
 
 
 class TestAgentRegister(object):
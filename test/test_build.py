@@ -1,5 +1,10 @@
+import logbook
 import mock
 import pytest
+import signal
+import subprocess
+import threading
+import time
 
 from mock import Mock
 from mock import MagicMock
@@ -10,6 +15,8 @@ from piper.build import BuildCLI
 from piper.build import ExecCLI
 from piper.config import AgentConfig
 from piper.config import BuildConfig
+from piper.config import ConfigError
+from piper.env import EnvError
 
 from test.utils import BASE_CONFIG
 
@@ -89,7 +96,7 @@ class TestBuildSetup(BuildTest):
 
 class TestBuildRun(BuildTest):
     def setup_method(self, method):
-        self.methods = ('setup', 'execute', 'teardown', 'finish')
+        self.methods = ('setup', 'execute', 'teardown', 'finish', 'close_logs')
 
         super(TestBuildRun, self).setup_method(method)
         self.build.version = mock.Mock()
@@ -112,6 +119,39 @@ class TestBuildRun(BuildTest):
         ret = self.build.run('other', 'illusion')
         assert ret is True
 
+    def test_logs_are_closed_on_crash(self):
+        self.build.execute.side_effect = EnvError('No room in the pool')
+
+        with pytest.raises(EnvError):
+            self.build.run('pipeline', 'env')
+
+        assert self.build.crashed is True
+        assert self.build.teardown.call_count == 0
+        assert self.build.finish.call_count == 0
+        self.build.close_logs.assert_called_once_with()
+
+
+class TestBuildRunCrash:
+    def test_last_record_is_in_the_file(self, tmpdir, monkeypatch):
+        monkeypatch.chdir(str(tmpdir))
+        build = Build(BuildConfig(raw={'jobs': 1}))
+        build.id = 'b1'
+        build.setup = build.set_logfile
+
+        def execute():
+            build.log.error('The env is broken')
+            raise EnvError('No room in the pool')
+
+        build.execute = execute
+
+        with pytest.raises(EnvError):
+            build.run('pipeline', 'env')
+
+        log = tmpdir.join('logs', 'piper', 'b1.log').read()
+        assert 'The env is broken' in log
+        assert 'Build crashed.' in log
+        assert 'No room in the pool' in log
+
 
 class TestBuildSetVersion:
     def setup_method(self, method):
@@ -178,7 +218,13 @@ class TestBuildConfigureSteps:
                 },
                 'boom': {
                     'class': 'bethhart.light.LiftsUUp',
-                }
+                },
+                'pow': {
+                    'class': 'sonata.arctica.FullMoon',
+                },
+            },
+            'pipelines': {
+                self.step_key: ['bang', 'boom'],
             },
         }
 
@@ -186,6 +232,7 @@ class TestBuildConfigureSteps:
         self.build.config = mock.Mock()
         self.build.config.classes = {}
         self.build.config.raw = self.raw
+        self.build.pipeline = self.step_key
 
         for key in self.raw['steps']:
             cls = self.raw['steps'][key]['class']
@@ -194,7 +241,7 @@ class TestBuildConfigureSteps:
     def test_configure_steps(self):
         self.build.configure_steps()
 
-        for key in self.raw['steps']:
+        for key in self.raw['pipelines'][self.step_key]:
             cls_key = self.raw['steps'][key]['class']
 
             cls = self.build.config.classes[cls_key]
@@ -205,6 +252,13 @@ class TestBuildConfigureSteps:
             )
             cls.return_value.validate.assert_called_once_with()
 
+    def test_steps_outside_of_pipeline_are_skipped(self):
+        self.build.configure_steps()
+
+        cls = self.build.config.classes['sonata.arctica.FullMoon']
+        assert cls.call_count == 0
+        assert 'pow' not in self.build.steps
+
 
 class TestBuildConfigurePipeline:
     def setup_method(self, method):
@@ -219,8 +273,10 @@ class TestBuildConfigurePipeline:
         }
         self.steps = (mock.Mock(), mock.Mock(), mock.Mock())
 
-        for step in self.steps:
+        for key, step in zip(self.step_keys, self.steps):
             step.config.depends = None
+            step.key = key
+            step.needs = None
 
     def get_build(self, config):
         build = Build(self.config)
@@ -235,11 +291,55 @@ class TestBuildConfigurePipeline:
         for x, _ in enumerate(self.step_keys):
             assert self.build.order[x] is self.steps[x]
 
+    def test_unknown_needs_raises_config_error(self):
+        self.steps[1].needs = ['dubop', 'shangalang']
+        self.build = self.get_build(self.config)
+
+        with pytest.raises(ConfigError):
+            self.build.configure_pipeline()
+
+
+class TestBuildGetGraph:
+    def setup_method(self, method):
+        self.build = Build(mock.Mock())
+        self.build.order = [
+            mock.Mock(key=key, needs=None, cache=None)
+            for key in ('a', 'b', 'c')
+        ]
+        self.a, self.b, self.c = self.build.order
+
+    def test_without_needs_is_sequential(self):
+        graph = self.build.get_graph()
+
+        assert list(graph) == self.build.order
+        assert graph[self.a] == ()
+        assert graph[self.b] == (self.a,)
+        assert graph[self.c] == (self.b,)
+
+    def test_with_needs(self):
+        self.b.needs = []
+        self.c.needs = ['a', 'b']
+
+        graph = self.build.get_graph()
+
+        assert graph[self.a] == ()
+        assert graph[self.b] == ()
+        assert graph[self.c] == (self.a, self.b)
+
+    def test_circular_needs_raises_config_error(self):
+        self.a.needs = ['c']
+
+        with pytest.raises(ConfigError):
+            self.build.get_graph()
+
 
 class TestBuildExecute:
     def setup_method(self, method):
         self.build = Build(mock.Mock())
-        self.build.order = [mock.Mock() for _ in range(3)]
+        self.build.order = [
+            mock.Mock(key=key, index=(x, 3), needs=None, cache=None)
+            for x, key in enumerate(('a', 'b', 'c'), start=1)
+        ]
         self.build.env = mock.Mock()
         self.build.config.raw = {
             'pipeline': 'gemma',
@@ -264,6 +364,239 @@ class TestBuildExecute:
         assert self.build.env.execute.call_args_list == calls
         assert self.build.success is False
 
+    def test_independent_steps_run_in_parallel(self):
+        self.build.config.raw['jobs'] = 2
+        self.build.order[1].needs = []
+        self.build.order[2].needs = ['a', 'b']
+
+        # Both of the first steps have to be running at the same time for the
+        # barrier to let them through.
+        barrier = threading.Barrier(2, timeout=5)
+
+        def execute(step):
+            if step is not self.build.order[2]:
+                barrier.wait()
+            return mock.Mock(success=True)
+
+        self.build.env.execute.side_effect = execute
+        self.build.execute()
+
+        assert self.build.env.execute.call_count == 3
+        assert self.build.env.execute.call_args_list[-1] == mock.call(
+            self.build.order[2]
+        )
+        assert self.build.success is True
+
+    @mock.patch('piper.process.PROCESSES', new_callable=set)
+    def test_failure_stops_running_steps(self, processes):
+        self.build.config.raw['jobs'] = 2
+        self.build.order = self.build.order[:2]
+        self.build.order[1].needs = []
+        started = threading.Event()
+        slow = {}
+
+        def execute(step):
+            if step is self.build.order[1]:
+                started.wait(5)
+                return mock.Mock(success=False, rusage=None)
+
+            popen = slow['popen'] = subprocess.Popen(['sleep', '10'])
+            processes.add(popen.pid)
+            started.set()
+            popen.wait()
+            processes.discard(popen.pid)
+            return mock.Mock(success=popen.returncode == 0, rusage=None)
+
+        self.build.env.execute.side_effect = execute
+        start = time.monotonic()
+        self.build.execute()
+
+        assert time.monotonic() - start < 5
+        assert slow['popen'].returncode == -signal.SIGINT
+        assert self.build.success is False
+
+    def test_failure_stops_dependent_steps(self):
+        self.build.config.raw['jobs'] = 1
+        self.build.order[1].needs = []
+        self.build.order[2].needs = ['b']
+        self.build.env.execute.return_value = mock.Mock(success=False)
+
+        self.build.execute()
+
+        calls = [mock.call(self.build.order[0])]
+        assert self.build.env.execute.call_args_list == calls
+        assert self.build.success is False
+
+    @mock.patch('piper.build.process.interrupt_sessions')
+    @mock.patch('concurrent.futures.wait')
+    def test_interrupt_is_forwarded(self, wait, interrupt):
+        wait.side_effect = KeyboardInterrupt()
+
+        with pytest.raises(KeyboardInterrupt):
+            self.build.execute()
+
+        interrupt.assert_called_once_with()
+        assert self.build.success is False
+
+
+class TestBuildShareBuildLog:
+    def setup_method(self, method):
+        self.build = Build(mock.Mock())
+        self.build.order = []
+        for mode in ('direct', 'bulk', None):
+            output = {'mode': mode, 'rate': 5} if mode else None
+            self.build.order.append(
+                mock.Mock(output=output, config={'output': output})
+            )
+
+    def test_direct_falls_back_to_bulk(self):
+        self.build.share_build_log()
+
+        direct, bulk, log = self.build.order
+        assert direct.config['output'] == {'mode': 'bulk', 'rate': 5}
+        direct.log.warning.assert_called_once_with(
+            'Steps may run at the same time. Using bulk output instead of '
+            'direct.'
+        )
+        assert bulk.config['output'] == {'mode': 'bulk', 'rate': 5}
+        assert bulk.log.warning.call_count == 0
+        assert log.config['output'] is None
+
+    def test_only_with_jobs(self):
+        self.build.execute_step = mock.Mock(return_value=True)
+        self.build.share_build_log = mock.Mock()
+        for step in self.build.order:
+            step.needs = None
+
+        self.build.config.raw = {'jobs': 1}
+        self.build.execute()
+        assert self.build.share_build_log.call_count == 0
+
+        self.build.success = None
+        self.build.config.raw = {'jobs': 2}
+        self.build.execute()
+        self.build.share_build_log.assert_called_once_with()
+
+
+class TestBuildExecuteStep(BuildTest):
+    def setup_method(self, method):
+        super(TestBuildExecuteStep, self).setup_method(method)
+        self.build.env = mock.Mock()
+        self.build.cache = mock.MagicMock()
+        self.step = mock.Mock(key='lint', index=(1, 2), cache=None)
+
+    def test_uncached(self):
+        self.build.env.execute.return_value.success = True
+
+        assert self.build.execute_step(self.step) is True
+        self.build.env.execute.assert_called_once_with(self.step)
+        assert self.build.cache.key.call_count == 0
+
+    def test_rusage_is_stored(self):
+        proc = self.build.env.execute.return_value
+        proc.rusage = {'user': 1.0}
+
+        self.build.execute_step(self.step)
+
+        assert self.step.rusage is proc.rusage
+        assert self.build.rusage == {'lint': proc.rusage}
+
+    def test_no_rusage(self):
+        self.build.env.execute.return_value.rusage = None
+
+        self.build.execute_step(self.step)
+
+        assert self.step.rusage is None
+        assert self.build.rusage == {}
+
+    def test_records_have_step_context(self):
+        def execute(step):
+            logbook.Logger('proc').info('output')
+            return mock.Mock(success=True)
+
+        self.build.env.execute.side_effect = execute
+        with logbook.TestHandler() as handler:
+            self.build.execute_step(self.step)
+
+        record = handler.records[0]
+        assert record.extra['step'] == 'lint'
+        assert record.extra['step_index'] == 1
+
+    def test_cache_hit_skips_execution(self):
+        self.step.cache = {}
+        records = self.build.cache.get.return_value
+
+        assert self.build.execute_step(self.step) is True
+        assert self.build.env.execute.call_count == 0
+        self.build.cache.get.assert_called_once_with(
+            self.build.cache.key.return_value
+        )
+        self.build.cache.replay.assert_called_once_with(self.step, records)
+
+    def test_cache_miss_stores_result(self):
+        self.step.cache = {}
+        self.build.cache.get.return_value = None
+        self.build.env.execute.return_value.success = True
+        records = self.build.cache.capture.return_value.__enter__.return_value
+
+        assert self.build.execute_step(self.step) is True
+        self.build.env.execute.assert_called_once_with(self.step)
+        self.build.cache.put.assert_called_once_with(
+            self.build.cache.key.return_value,
+            records,
+        )
+
+    def test_sampled_output_is_not_cached(self):
+        self.step.cache = {}
+        self.build.env.execute.return_value.success = True
+
+        for mode in ('bulk', 'direct'):
+            self.step.output = {'mode': mode}
+            self.build.env.execute.reset_mock()
+
+            assert self.build.execute_step(self.step) is True
+            self.build.env.execute.assert_called_once_with(self.step)
+            assert self.build.cache.key.call_count == 0
+            assert self.build.cache.put.call_count == 0
+
+    def test_failure_is_not_stored(self):
+        self.step.cache = {}
+        self.build.cache.get.return_value = None
+        self.build.env.execute.return_value.success = False
+
+        assert self.build.execute_step(self.step) is False
+        assert self.build.cache.put.call_count == 0
+
+
+class TestBuildTraceProcess(BuildTest):
+    def setup_method(self, method):
+        super(TestBuildTraceProcess, self).setup_method(method)
+        self.proc = mock.Mock(cmd='flake8', started=1.0, ended=3.0)
+        self.proc.popen.pid = 1234
+
+    def test_without_tracer(self):
+        self.build.trace_process(self.proc, step='lint')
+
+    def test_with_tracer(self):
+        self.build.tracer = mock.Mock()
+        self.build.trace_process(self.proc, step='lint')
+
+        self.build.tracer.name_process.assert_called_once_with(
+            1234, '1234 flake8'
+        )
+        self.build.tracer.complete.assert_called_once_with(
+            'flake8',
+            'process',
+            1.0,
+            2.0,
+            pid=1234,
+            tid=1234,
+            args={
+                'step': 'lint',
+                'exitcode': self.proc.popen.returncode,
+            },
+        )
+
 
 class TestBuildSetupEnv(BuildTest):
     def setup_method(self, method):
@@ -300,24 +633,145 @@ class TestBuildQueue(BuildTest):
         self.build.queue('pipeline', 'env')
         post.assert_called_once_with(
             'protocol://hehe:1000/builds/',
-            json=self.build.config.raw,
+            json=dict(self.build.config.raw, pipeline='pipeline', env='env'),
         )
 
 
 class TestBuildFinish(BuildTest):
-    def setup_method(self, method):
-        super(TestBuildFinish, self).setup_method(method)
-        self.build.db = mock.Mock()
-        self.build.log_handler = mock.Mock()
-
     @mock.patch('ago.human')
     @mock.patch('piper.utils.now')
-    def test_log_handler_is_popped(self, now, human):
+    def test_ended_is_set(self, now, human):
         self.build.finish()
 
         assert self.build.ended is now.return_value
         now.assert_called_once_with()
+
+
+class TestBuildCloseLogs(BuildTest):
+    def setup_method(self, method):
+        super(TestBuildCloseLogs, self).setup_method(method)
+        self.build.log_handler = mock.Mock()
+
+    def test_log_handler_is_popped(self):
+        self.build.close_logs()
+
         self.build.log_handler.pop_application.assert_called_once_with()
+        self.build.log_handler.close.assert_called_once_with()
+
+    def test_db_log_handler_is_closed(self):
+        self.build.db_log_handler = mock.Mock()
+        self.build.close_logs()
+
+        self.build.db_log_handler.pop_application.assert_called_once_with()
+        self.build.db_log_handler.close.assert_called_once_with()
+
+    def test_without_log_handlers(self):
+        self.build.log_handler = None
+        self.build.close_logs()
+
+
+class TestBuildTimer(BuildTest):
+    @mock.patch('time.monotonic')
+    def test_timing_is_recorded(self, monotonic):
+        monotonic.side_effect = (10.0, 12.5)
+        self.build.clock = 4.0
+
+        with self.build.timer('setup_env'):
+            pass
+
+        assert self.build.timings == [{
+            'name': 'setup_env',
+            'type': 'phase',
+            'start': 6.0,
+            'duration': 2.5,
+        }]
+
+    def test_timing_is_recorded_on_exception(self):
+        with pytest.raises(ValueError):
+            with self.build.timer('lint', 'step'):
+                raise ValueError()
+
+        assert len(self.build.timings) == 1
+        assert self.build.timings[0]['type'] == 'step'
+
+    def test_setup_phases_are_timed(self):
+        for method in ('set_logfile', 'set_version', 'configure_env',
+                       'configure_steps', 'configure_pipeline', 'setup_env'):
+            setattr(self.build, method, mock.Mock())
+
+        self.build.setup()
+
+        names = [t['name'] for t in self.build.timings]
+        assert names == [
+            'set_version',
+            'configure_env',
+            'configure_steps',
+            'configure_pipeline',
+            'setup_env',
+        ]
+
+    def test_timings_in_db_fields(self):
+        self.build.timings = [{'name': 'setup_env'}]
+        assert self.build.as_dict()['timings'] is self.build.timings
+
+    @mock.patch('time.monotonic')
+    def test_timing_is_traced(self, monotonic):
+        monotonic.side_effect = (10.0, 12.5)
+        self.build.tracer = mock.Mock()
+
+        with self.build.timer('lint', 'step'):
+            pass
+
+        self.build.tracer.complete.assert_called_once_with(
+            'lint', 'step', 10.0, 2.5
+        )
+
+    def test_rusage_in_db_fields(self):
+        self.build.rusage = {'lint': {'user': 1.0}}
+        assert self.build.as_dict()['rusage'] is self.build.rusage
+
+    def test_log_rusage(self):
+        self.build.log = mock.Mock()
+        self.build.order = [mock.Mock(key='lint'), mock.Mock(key='cached')]
+        self.build.rusage = {
+            'lint': {
+                'user': 1.25,
+                'system': 0.5,
+                'max_rss': 2 ** 21,
+                'blocks_in': 10,
+                'blocks_out': 20,
+                'voluntary_switches': 30,
+                'involuntary_switches': 40,
+            },
+        }
+
+        self.build.log_rusage()
+
+        lines = [c[0][0] for c in self.build.log.info.call_args_list]
+        assert len(lines) == 3
+        assert lines[2].split() == [
+            'lint', '1.250s', '0.500s', '2.0M', '10', '20', '30', '40',
+        ]
+
+    def test_log_rusage_without_processes(self):
+        self.build.log = mock.Mock()
+        self.build.log_rusage()
+
+        assert self.build.log.info.call_count == 0
+
+    def test_log_timings(self):
+        self.build.log = mock.Mock()
+        self.build.timings = [
+            {'name': 'lint', 'type': 'step', 'start': 2, 'duration': 1},
+            {'name': 'setup_env', 'type': 'phase', 'start': 0, 'duration': 2},
+        ]
+
+        self.build.log_timings()
+
+        lines = [c[0][0] for c in self.build.log.info.call_args_list]
+        assert len(lines) == 4
+        assert 'setup_env' in lines[2]
+        assert 'lint' in lines[3]
 
 
 class TestBuildSetLogfile(BuildTest):
@@ -345,6 +799,52 @@ class TestBuildSetLogfile(BuildTest):
         assert gfl.return_value is self.build.log_handler
         self.build.log_handler.push_application.assert_called_once_with()
 
+    @mock.patch('piper.logging.get_file_logger')
+    def test_log_compression(self, gfl):
+        self.build.id = 'abc'
+        self.build.config.raw = {'log_compression': 'gzip'}
+        self.build.set_logfile()
+
+        gfl.assert_called_once_with(
+            'logs/piper/abc.log', compression='gzip', format='text',
+            build_id='abc',
+        )
+        assert self.build.logfile is gfl.return_value.filename
+        assert self.build.db_log_handler is None
+
+    @mock.patch('piper.logging.get_file_logger')
+    def test_json_log_format(self, gfl):
+        self.build.id = 'abc'
+        self.build.config.raw = {'log_format': 'json'}
+        self.build.set_logfile()
+
+        gfl.assert_called_once_with(
+            'logs/piper/abc.jsonl', compression=None, format='json',
+            build_id='abc',
+        )
+
+    @mock.patch('piper.logging.DatabaseHandler')
+    @mock.patch('piper.logging.get_file_logger')
+    def test_db_log_handler(self, gfl, handler):
+        self.build.id = 'abc'
+        self.build.config.raw = {'db': {}}
+        self.build.set_logfile()
+
+        handler.assert_called_once_with(
+            self.build.connect_log_db,
+            'abc',
+            'logs/piper/abc.spill',
+            level=gfl.return_value.level,
+        )
+        assert self.build.db_log_handler is handler.return_value
+        handler.return_value.push_application.assert_called_once_with()
+
+    def test_connect_log_db(self):
+        db = self.build.config.get_database.return_value
+
+        assert self.build.connect_log_db() is db.logs
+        db.setup.assert_called_once_with(self.build.config)
+
 
 class TestExecCLIRun:
     def setup_method(self, method):
@@ -353,6 +853,7 @@ class TestExecCLIRun:
 
     @mock.patch('piper.build.Build')
     def test_calls(self, b, ns):
+        ns.trace = None
         ret = self.cli.run(ns)
 
         assert ret == 0
@@ -366,6 +867,27 @@ class TestExecCLIRun:
 
         assert ret == 1
 
+    @mock.patch('piper.build.Tracer')
+    @mock.patch('piper.build.Build')
+    def test_trace(self, b, tracer, ns):
+        ns.trace = 'trace.json'
+        self.cli.run(ns)
+
+        tracer.assert_called_once_with('trace.json')
+        assert b.return_value.tracer is tracer.return_value
+        tracer.return_value.write.assert_called_once_with()
+
+    @mock.patch('piper.build.Tracer')
+    @mock.patch('piper.build.Build')
+    def test_trace_written_on_crash(self, b, tracer, ns):
+        ns.trace = 'trace.json'
+        b.return_value.run.side_effect = KeyError()
+
+        with pytest.raises(KeyError):
+            self.cli.run(ns)
+
+        tracer.return_value.write.assert_called_once_with()
+
 
 class TestBuildApiGet(object):
     def test_existing_build(self, api, request):
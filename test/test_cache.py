@@ -0,0 +1,145 @@
+import logbook
+import mock
+import os
+import pytest
+
+from piper.cache import StepCache
+from piper.env import Env
+from piper.env import TempDirEnv
+from piper.logging import SEPARATOR
+
+
+@pytest.fixture
+def cache(tmpdir):
+    return StepCache(str(tmpdir.mkdir('cache')))
+
+
+@pytest.fixture
+def step():
+    step = mock.Mock()
+    step.log_key = 'Build : lint (1/3)'
+    step.config = {
+        'class': 'piper.step.CommandLineStep',
+        'command': 'flake8',
+        'cache': {'inputs': []},
+    }
+    step.cache = step.config['cache']
+    step.get_command.return_value = step.config['command']
+    return step
+
+
+class TestStepCacheKey:
+    def setup_method(self, method):
+        self.env = Env(mock.Mock(), {'class': 'piper.env.Env'})
+
+    def test_stable(self, cache, step):
+        assert cache.key(step, self.env) == cache.key(step, self.env)
+
+    def test_config_changes_key(self, cache, step):
+        before = cache.key(step, self.env)
+        step.config['command'] = 'flake8 -v'
+
+        assert cache.key(step, self.env) != before
+
+    def test_env_class_changes_key(self, cache, step):
+        other = TempDirEnv(mock.Mock(), mock.MagicMock())
+
+        assert cache.key(step, self.env) != cache.key(step, other)
+
+    def test_input_content_changes_key(self, cache, step, tmpdir):
+        src = tmpdir.mkdir('src')
+        src.join('a.py').write('a = 1\n')
+        step.cache['inputs'] = [str(src)]
+
+        before = cache.key(step, self.env)
+        assert cache.key(step, self.env) == before
+
+        src.join('a.py').write('a = 2\n')
+        assert cache.key(step, self.env) != before
+
+    def test_missing_input_changes_key(self, cache, step, tmpdir):
+        target = tmpdir.join('later.txt')
+        step.cache['inputs'] = [str(target)]
+
+        before = cache.key(step, self.env)
+        target.write('here now')
+
+        assert cache.key(step, self.env) != before
+
+    @pytest.fixture
+    def tempdir_env(self, tmpdir, request):
+        repo = tmpdir.mkdir('repo')
+        repo.mkdir('src').join('a.py').write('a = 1\n')
+
+        cwd = os.getcwd()
+        request.addfinalizer(lambda: os.chdir(cwd))
+
+        def setup():
+            # Setting up an env leaves the process in its temporary dir.
+            os.chdir(str(repo))
+            env = TempDirEnv(mock.Mock(), {
+                'class': 'piper.env.TempDirEnv',
+                'requirements': None,
+            })
+            env.setup()
+            request.addfinalizer(env.teardown)
+            return env
+
+        return setup
+
+    def test_inputs_are_relative_to_env_cwd(self, cache, step, tempdir_env):
+        step.cache['inputs'] = ['src/*.py']
+        env = tempdir_env()
+
+        before = cache.key(step, env)
+        with open(os.path.join(env.cwd, 'src', 'a.py'), 'w') as f:
+            f.write('a = 2\n')
+
+        assert cache.key(step, env) != before
+
+    def test_inputs_key_is_same_in_every_tempdir(self, cache, step,
+                                                 tempdir_env):
+        step.cache['inputs'] = ['src']
+
+        assert cache.key(step, tempdir_env()) == \
+            cache.key(step, tempdir_env())
+
+
+class TestStepCacheStorage:
+    def test_miss(self, cache):
+        assert cache.get('nope') is None
+
+    def test_roundtrip(self, cache):
+        records = [{'channel': ': ls', 'level': 13, 'message': 'a {0} b'}]
+        cache.put('key', records)
+
+        assert cache.get('key') == records
+        assert os.listdir(cache.path) == ['key.jsonl']
+
+
+class TestStepCacheCapture:
+    def test_only_step_channels_are_captured(self, cache, step):
+        with logbook.TestHandler():
+            with cache.capture(step) as records:
+                logbook.Logger(step.log_key + SEPARATOR + 'flake8').info('x')
+                logbook.Logger(step.log_key + SEPARATOR + 'flake8').debug('y')
+                logbook.Logger('Build : test (2/3): py.test').info('z')
+
+        assert records == [
+            {'channel': SEPARATOR + 'flake8', 'level': logbook.INFO,
+             'message': 'x'},
+        ]
+
+    def test_replay(self, cache, step):
+        records = [
+            {'channel': SEPARATOR + 'flake8', 'level': logbook.INFO,
+             'message': 'x {0}'},
+        ]
+
+        with logbook.TestHandler() as handler:
+            cache.replay(step, records)
+
+        assert len(handler.records) == 1
+        record = handler.records[0]
+        assert record.channel == step.log_key + SEPARATOR + 'flake8'
+        assert record.message == 'x {0}'
@@ -3,7 +3,11 @@ import pytest
 
 import mock
 import copy
+import os
+import subprocess
+import sys
 
+from piper.config import ClassRegistry
 from piper.config import Config
 from piper.config import ConfigError
 from piper.config import BuildConfig
@@ -49,13 +53,11 @@ class TestConfigLoad:
     def test_filename_configuration(self):
         self.config = Config('piper.yml')
         self.config.load_config = mock.Mock()
-        self.config.load_classes = mock.Mock()
         self.config.validate_config = mock.Mock()
 
         self.config.load()
 
         self.config.load_config.assert_called_once_with()
-        self.config.load_classes.assert_called_once_with()
 
 
 class TestConfigCollectClasses:
@@ -147,12 +149,12 @@ class TestBuildConfigLoadClasses(BuildConfigTest):
         self.version = 'piper.version.GitVersion'
         self.step = 'piper.step.CommandLineStep'
         self.env = 'piper.env.Env'
-        self.db = 'piper.db.RethinkDB'
+        self.db = 'piper.db.rethink.RethinkDB'
 
-    @pytest.mark.skipif(True, reason="refactor skip")
     @mock.patch('piper.config.dynamic_load')
     def test_load_classes(self, dl):
-        self.config.load_classes()
+        for key in (self.version, self.step, self.env, self.db):
+            assert self.config.classes[key] is dl.return_value
 
         calls = (
             mock.call(self.version),
@@ -160,42 +162,85 @@ class TestBuildConfigLoadClasses(BuildConfigTest):
             mock.call(self.env),
             mock.call(self.db),
         )
-        assert dl.has_calls(calls)
-        assert self.config.classes[self.version] is dl.return_value
-        assert self.config.classes[self.step] is dl.return_value
-        assert self.config.classes[self.env] is dl.return_value
-        assert self.config.classes[self.db] is dl.return_value
+        dl.assert_has_calls(calls)
+        assert dl.call_count == 4
 
 
 class TestBuildConfigLoad(BuildConfigTest):
-    @pytest.mark.skipif(True, reason="refactor skip")
-    def test_calls(self):
+    @mock.patch('piper.config.dynamic_load')
+    def test_calls(self, dl):
         self.config.load_config = mock.Mock()
-        self.config.validate_config = mock.Mock()
-        self.config.load_classes = mock.Mock()
 
         ret = self.config.load()
         assert ret is self.config
 
         self.config.load_config.assert_called_once_with()
-        self.config.validate_config.assert_called_once_with()
-        self.config.load_classes.assert_called_once_with()
+        assert dl.call_count == 0
+
+
+class TestBuildConfigCheckLogCompression(BuildConfigTest):
+    def setup_method(self, method):
+        super(TestBuildConfigCheckLogCompression, self).setup_method(method)
+        self.config.raw = self.base_config
+
+    def test_no_compression(self):
+        self.config.check_log_compression()
+
+    def test_gzip(self):
+        self.config.raw['log_compression'] = 'gzip'
+        self.config.check_log_compression()
+
+    @mock.patch.dict('sys.modules', {'zstandard': mock.Mock()})
+    def test_zstd(self):
+        self.config.raw['log_compression'] = 'zstd'
+        self.config.check_log_compression()
+
+    @mock.patch.dict('sys.modules', {'zstandard': None})
+    def test_zstd_not_installed(self):
+        self.config.raw['log_compression'] = 'zstd'
+
+        with pytest.raises(ConfigError) as exc:
+            self.config.check_log_compression()
+
+        assert 'zstandard' in str(exc.value)
+        assert "'zstd' extra" in str(exc.value)
+
+    @mock.patch.dict('sys.modules', {'zstandard': None})
+    def test_checked_on_load(self):
+        self.config.raw['log_compression'] = 'zstd'
+        self.config.load_config = mock.Mock()
+
+        with pytest.raises(ConfigError):
+            self.config.load()
 
 
 class TestBuildConfigGetDatabase(BuildConfigTest):
+    db = 'piper.db.rethink.RethinkDB'
+
     def setup_method(self, method):
         super(TestBuildConfigGetDatabase, self).setup_method(method)
-        self.config.raw = self.base_config
-        self.db = 'piper.db.RethinkDB'
+        self.config.raw = dict(self.base_config, db={'class': self.db})
         self.mock = mock.Mock()
-        self.config.classes[self.db] = self.mock
+        self.config.classes['piper.db.rethink.RethinkDB'] = self.mock
 
-    @pytest.mark.skipif(True, reason="refactor skip")
     def test_plain_run(self):
         ret = self.config.get_database()
         assert ret is self.mock.return_value
 
 
+class TestBuildConfigGetMovedDatabase(TestBuildConfigGetDatabase):
+    db = 'piper.db.RethinkDB'
+
+    def test_warning(self):
+        self.config.classes.log = mock.Mock()
+        self.config.get_database()
+
+        self.config.classes.log.warning.assert_called_once_with(
+            "'piper.db.RethinkDB' has moved to 'piper.db.rethink.RethinkDB'. "
+            "Please update your configuration."
+        )
+
+
 class TestBuildConfigMergeNamespace(BuildConfigTest):
     def setup_method(self, method):
         super(TestBuildConfigMergeNamespace, self).setup_method(method)
@@ -235,33 +280,44 @@ class TestAgentConfigValidateConfig(AgentConfigTest):
 class TestAgentConfigCollectClasses(AgentConfigTest):
     def test_collection(self):
         ret = self.config.collect_classes()
-        assert ret == set(['piper.db.RethinkDB'])
+        assert ret == set(['piper.db.rethink.RethinkDB'])
 
 
 class TestConfigLoadClasses(object):
     @mock.patch('piper.config.dynamic_load')
-    def test_dynamic_load(self, dl, config):
-        first, second = mock.Mock(), mock.Mock()
-        config.collect_classes = mock.Mock(return_value=[first, second])
+    def test_nothing_is_imported(self, dl):
+        config = Config(raw={'db': {'class': 'piper.db.rethink.RethinkDB'}})
 
-        config.load_classes()
+        config.load()
 
-        dl.assert_has_calls([
-            mock.call(first),
-            mock.call(second),
-        ])
+        assert dl.call_count == 0
+        assert config.classes == {}
 
     @mock.patch('piper.config.dynamic_load')
-    def test_class_setting(self, dl, config):
-        first, second = mock.Mock(), mock.Mock()
-        config.collect_classes = mock.Mock(return_value=[first, second])
+    def test_class_loaded_on_first_access(self, dl, config):
+        first = mock.Mock()
 
-        config.load_classes()
+        assert config.classes[first] is dl.return_value
+        assert config.classes[first] is dl.return_value
+        dl.assert_called_once_with(first)
+        assert config.classes == {first: dl.return_value}
 
-        assert config.classes == {
-            first: dl.return_value,
-            second: dl.return_value,
-        }
+    def test_moved_class(self):
+        from piper.db.rethink import RethinkDB
+
+        classes = ClassRegistry()
+        assert classes['piper.db.RethinkDB'] is RethinkDB
+
+    def test_build_does_not_import_database_driver(self):
+        # A fresh interpreter, since the tests of the database import it.
+        code = (
+            'import sys, piper.build; '
+            "sys.exit('rethinkdb' in sys.modules)"
+        )
+
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+        assert subprocess.call([sys.executable, '-c', code], cwd=root) == 0
 
 
 class TestConfigGetDatabase(object):
@@ -1,8 +1,13 @@
 import jsonschema
+import os
 import pytest
 import mock
 
+from piper import utils
+
 from piper.env import Env
+from piper.env import EnvError
+from piper.env import PythonVirtualEnv
 from piper.env import TempDirEnv
 
 from test.utils import BASE_CONFIG
@@ -36,16 +41,117 @@ class TestEnvExecute(EnvTest):
         proc.assert_called_once_with(
             self.env.config,
             gc.return_value,
-            self.step.log_key
+            self.step.log_key,
+            self.step.output,
+            self.step.build.log_handler,
+            self.step.limits,
+            None,
         )
         procobj.run.assert_called_once_with()
         assert ret is procobj
 
 
+class TestPythonVirtualEnv:
+    def setup_method(self, method):
+        self.env = PythonVirtualEnv(mock.Mock(), {
+            'class': 'piper.env.PythonVirtualEnv',
+            'requirements': None,
+        })
+
+    @pytest.fixture
+    def workdir(self, tmpdir, request):
+        cwd = os.getcwd()
+        environ = dict(os.environ)
+        os.chdir(str(tmpdir))
+
+        def fin():
+            os.chdir(cwd)
+            os.environ.clear()
+            os.environ.update(environ)
+
+        request.addfinalizer(fin)
+        return tmpdir
+
+    @mock.patch('piper.env.VirtualEnvPool')
+    def test_setup_and_teardown(self, pool, workdir):
+        venv = workdir.mkdir('pooled')
+        pool.return_value.acquire.return_value = str(venv)
+        environ = dict(os.environ)
+
+        self.env.setup()
+
+        pool.assert_called_once_with(4096 * 2 ** 20)
+        pool.return_value.key.assert_called_once_with('python3', [])
+        link = str(workdir.join('venv'))
+        assert os.readlink(link) == str(venv)
+        assert self.env.environ['VIRTUAL_ENV'] == link
+        assert self.env.environ['PATH'].startswith(os.path.join(link, 'bin'))
+        assert os.environ == environ
+
+        self.env.teardown()
+
+        key = pool.return_value.key.return_value
+        assert not os.path.lexists(link)
+        assert os.environ == environ
+        pool.return_value.release.assert_called_once_with(key)
+        pool.return_value.evict.assert_called_once_with()
+
+    @mock.patch('piper.env.VirtualEnvPool')
+    def test_default_requirements_file(self, pool, workdir):
+        workdir.join('requirements.txt').write('six\n')
+        pool.return_value.acquire.return_value = str(workdir.mkdir('pooled'))
+
+        self.env.setup()
+
+        pool.return_value.key.assert_called_once_with(
+            'python3', ['requirements.txt']
+        )
+
+    @mock.patch('piper.env.Process')
+    def test_execute_in_env(self, proc):
+        self.env.activate('/pool/key')
+
+        self.env.execute(mock.Mock())
+
+        assert proc.call_args[0][6] is self.env.environ
+
+    @mock.patch('piper.env.Process')
+    def test_create(self, proc):
+        proc.return_value.success = True
+        self.env.requirements_files = ['requirements.txt']
+        self.env.create('/pool/key')
+
+        cmds = [c[0][1] for c in proc.call_args_list]
+        assert cmds == [
+            'virtualenv -p python3 /pool/key',
+            '/pool/key/bin/pip install -r requirements.txt',
+        ]
+
+    @mock.patch('piper.env.Process')
+    def test_create_is_traced(self, proc):
+        proc.return_value.success = True
+        self.env.requirements_files = ['requirements.txt']
+        self.env.create('/pool/key')
+
+        call = mock.call(proc.return_value, env='PythonVirtualEnv')
+        assert self.env.build.trace_process.call_args_list == [call, call]
+
+    @mock.patch('piper.env.Process')
+    def test_create_failure(self, proc):
+        proc.return_value.success = False
+        self.env.requirements_files = []
+
+        with pytest.raises(EnvError):
+            self.env.create('/pool/key')
+
+
 class TestTempDirEnvSetup:
     def setup_method(self, method):
         self.build = mock.Mock()
-        self.env = TempDirEnv(self.build, mock.MagicMock())
+        self.env = TempDirEnv(self.build, {
+            'class': 'piper.env.TempDirEnv',
+            'requirements': None,
+        })
 
     @mock.patch('shutil.copytree')
     @mock.patch('os.chdir')
@@ -57,6 +163,24 @@ class TestTempDirEnvSetup:
         mkdtemp.assert_called_once_with(prefix='piper-')
         chdir.assert_called_once_with(mkdtemp.return_value)
         assert self.env.dir == mkdtemp.return_value
+        copy.assert_called_once_with(self.env.source, self.env.cwd)
+
+    @mock.patch('os.chdir')
+    @mock.patch('tempfile.mkdtemp')
+    def test_setup_strategy(self, mkdtemp, chdir):
+        mkdtemp.return_value = '/'
+        self.env.config['workspace'] = 'hardlink'
+        self.env.workspace_hardlink = mock.Mock()
+
+        self.env.setup()
+
+        self.env.workspace_hardlink.assert_called_once_with()
+
+    def test_validation_unknown_workspace(self):
+        self.env.config['workspace'] = 'teleport'
+
+        with pytest.raises(jsonschema.exceptions.ValidationError):
+            self.env.validate()
 
     def test_validation_extra_field(self):
         self.env = TempDirEnv(self.build, mock.MagicMock(**{
@@ -68,23 +192,113 @@ class TestTempDirEnvSetup:
             self.env.validate()
 
 
+class TestTempDirEnvWorkspaces:
+    def setup_method(self, method):
+        self.env = TempDirEnv(mock.Mock(), {
+            'class': 'piper.env.TempDirEnv',
+            'requirements': None,
+        })
+
+    @pytest.fixture
+    def repo(self, tmpdir, request):
+        source = tmpdir.mkdir('repo')
+        source.join('.gitignore').write('build/\n')
+        source.join('tracked.txt').write('tracked')
+        source.mkdir('src').join('a.py').write('a = 1')
+        source.mkdir('build').join('out.o').write('junk')
+
+        git = 'git -C {0} '.format(source)
+        for cmd in ('init -q', 'add .gitignore tracked.txt src',
+                    '-c user.name=a -c user.email=a@a commit -q -m init'):
+            utils.oneshot(git + cmd)
+
+        source.join('untracked.txt').write('untracked')
+
+        self.env.source = str(source)
+        self.env.cwd = str(tmpdir.join('work', 'repo'))
+
+        cwd = os.getcwd()
+        os.chdir(self.env.source)
+        request.addfinalizer(lambda: os.chdir(cwd))
+
+        return source
+
+    def files(self):
+        ret = set()
+        for root, dirs, files in os.walk(self.env.cwd):
+            if '.git' in dirs:
+                dirs.remove('.git')
+            for name in set(files) - set(['.git']):
+                path = os.path.join(root, name)
+                ret.add(os.path.relpath(path, self.env.cwd))
+        return ret
+
+    def test_copy(self, repo):
+        self.env.workspace_copy()
+
+        assert 'build/out.o' in self.files()
+        assert os.path.isdir(os.path.join(self.env.cwd, '.git'))
+
+    def test_ignore(self, repo):
+        self.env.workspace_ignore()
+
+        assert self.files() == set([
+            '.gitignore', 'tracked.txt', 'src/a.py', 'untracked.txt',
+        ])
+
+    def test_hardlink(self, repo):
+        self.env.workspace_hardlink()
+
+        src = repo.join('tracked.txt')
+        dst = os.path.join(self.env.cwd, 'tracked.txt')
+        assert os.stat(dst).st_ino == src.stat().ino
+
+    def test_reflink(self, repo):
+        self.env.workspace_reflink()
+
+        dst = os.path.join(self.env.cwd, 'src', 'a.py')
+        with open(dst) as f:
+            assert f.read() == 'a = 1'
+        assert os.stat(dst).st_ino != repo.join('src', 'a.py').stat().ino
+
+    def test_worktree(self, repo):
+        self.env.workspace_worktree()
+
+        assert self.files() == set(['.gitignore', 'tracked.txt', 'src/a.py'])
+
+
 class TestTempDirEnvTeardown:
     def setup_method(self, method):
         self.build = mock.Mock()
-        self.env = TempDirEnv(self.build, mock.MagicMock())
+        self.env = TempDirEnv(self.build, {
+            'class': 'piper.env.TempDirEnv',
+            'requirements': None,
+        })
         self.env.dir = '/dir'
 
     @mock.patch('shutil.rmtree')
     def test_teardown_default(self, rmtree):
         self.env.dir = mock.Mock()
-        self.env.config.delete_when_done = True
+        self.env.config['delete_when_done'] = True
+        self.env.teardown()
+
+        rmtree.assert_called_once_with(self.env.dir)
+
+    @mock.patch('piper.utils.oneshot')
+    @mock.patch('os.chdir')
+    @mock.patch('shutil.rmtree')
+    def test_teardown_worktree(self, rmtree, chdir, oneshot):
+        self.env.source = '/repo'
+        self.env.config['workspace'] = 'worktree'
         self.env.teardown()
 
         rmtree.assert_called_once_with(self.env.dir)
+        chdir.assert_called_once_with('/repo')
+        oneshot.assert_called_once_with('git worktree prune')
 
     @mock.patch('shutil.rmtree')
     def test_teardown_not_permitted(self, rmtree):
-        self.env.config.delete_when_done = False
+        self.env.config['delete_when_done'] = False
         self.env.teardown()
 
         assert rmtree.call_count == 0
@@ -112,7 +326,11 @@ class TestTempDirEnvExecute:
         proc.assert_called_once_with(
             self.env.config,
             gc.return_value,
-            self.step.log_key
+            self.step.log_key,
+            self.step.output,
+            self.step.build.log_handler,
+            self.step.limits,
+            None,
         )
         procobj.run.assert_called_once_with()
         assert ret is procobj
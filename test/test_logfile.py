@@ -0,0 +1,118 @@
+import gzip
+import mock
+import pytest
+
+from piper.logfile import FrameReader
+from piper.logfile import FrameWriter
+from piper.logfile import get_filename
+from piper.logfile import get_index_filename
+
+
+def get_lines(count, start=0):
+    return ['line {0}'.format(x) for x in range(start, start + count)]
+
+
+def write(filename, lines, frame_size=100, compression='gzip'):
+    writer = FrameWriter(filename, compression, frame_size=frame_size)
+    for line in lines:
+        writer.write(line + '\n')
+    writer.close()
+
+
+@pytest.fixture
+def filename(tmpdir):
+    return str(tmpdir.join('build.log.gz'))
+
+
+class TestGetFilename:
+    def test_uncompressed(self):
+        assert get_filename('x.log') == 'x.log'
+
+    def test_compressed(self):
+        assert get_filename('x.log', 'gzip') == 'x.log.gz'
+        assert get_filename('x.log', 'zstd') == 'x.log.zst'
+
+
+class TestFrameWriter:
+    def test_frames_are_indexed(self, filename):
+        write(filename, get_lines(100))
+
+        reader = FrameReader(filename)
+        assert len(reader.offsets) > 1
+        assert reader.offsets[0] == 0
+        assert reader.starts[0] == 0
+        assert reader.offsets == sorted(reader.offsets)
+
+    def test_file_is_plain_gzip(self, filename):
+        write(filename, get_lines(100))
+
+        with gzip.open(filename, 'rt') as f:
+            assert f.read().splitlines() == get_lines(100)
+
+    def test_partial_lines_wait_for_next_frame(self, filename):
+        writer = FrameWriter(filename, frame_size=4)
+        writer.write('first\nsec')
+        writer.write('ond\n')
+        writer.close()
+
+        reader = FrameReader(filename)
+        assert reader.starts == [0, 1]
+        assert list(reader.lines()) == ['first', 'second']
+
+    def test_nothing_written(self, filename):
+        FrameWriter(filename).close()
+
+        assert list(FrameReader(filename).lines()) == []
+        with open(get_index_filename(filename)) as f:
+            assert f.read() == ''
+
+    def test_append_continues_line_numbers(self, filename):
+        write(filename, get_lines(50))
+        write(filename, get_lines(50, 50))
+
+        reader = FrameReader(filename)
+        assert reader.count() == 100
+        assert list(reader.lines(45))[:10] == get_lines(10, 45)
+
+
+class TestFrameReader:
+    def test_all_lines(self, filename):
+        write(filename, get_lines(100))
+
+        assert list(FrameReader(filename).lines()) == get_lines(100)
+
+    def test_from_line(self, filename):
+        write(filename, get_lines(100))
+        reader = FrameReader(filename)
+
+        for start in (0, 1, 37, 99, 100, 150):
+            assert list(reader.lines(start)) == get_lines(100)[start:]
+
+    def test_only_needed_frames_are_decompressed(self, filename):
+        write(filename, get_lines(100))
+        reader = FrameReader(filename)
+        reader.decompress = mock.Mock(side_effect=reader.decompress)
+
+        assert next(reader.lines(99)) == 'line 99'
+        assert reader.decompress.call_count == 1
+
+    def test_count(self, filename):
+        write(filename, get_lines(100))
+
+        assert FrameReader(filename).count() == 100
+
+    def test_missing_log(self, filename):
+        reader = FrameReader(filename)
+
+        assert reader.count() == 0
+        assert list(reader.lines()) == []
+
+
+class TestZstd:
+    def test_roundtrip(self, tmpdir):
+        pytest.importorskip('zstandard')
+        filename = str(tmpdir.join('build.log.zst'))
+        write(filename, get_lines(100), compression='zstd')
+
+        reader = FrameReader(filename, 'zstd')
+        assert list(reader.lines(42)) == get_lines(100)[42:]
@@ -1,8 +1,29 @@
+from piper.logfile import FrameReader
+from piper.logging import BatchedFileHandler
 from piper.logging import BlessingsStringFormatter as BSF
+from piper.logging import COLORIZERS
 from piper.logging import Colorizer
+from piper.logging import ColorizerEngine
+from piper.logging import DEFAULT_LOGFILE_FORMAT_STRING
+from piper.logging import DatabaseHandler
+from piper.logging import JSONFormatter
+from piper.logging import PlainFormatter
+from piper.logging import get_formatter
 from piper.logging import SEPARATOR
+from piper.logging import context
+from piper.logging import find_literal
 
+import blessings
+import datetime
+import json
+import logbook
 import mock
+import os
+import pytest
+import re
+import sys
+import threading
+import time
 
 
 class TestBlessingsStringFormatterColorize:
@@ -86,19 +107,15 @@ class TestBlessingsStringFormatterFormatRecord:
 
 class TestBlessingsStringFormatterPrepareRecord:
     def setup_method(self, method):
-        self.rc = mock.Mock()
-        self.colorizer = mock.Mock()
-        self.colorizer.colorize.return_value = True, self.rc
-        self.bsf = BSF(colorizers=(self.colorizer, self.colorizer))
+        self.rc = mock.Mock(message='message')
+        self.bsf = BSF(colorizers=COLORIZERS)
+        self.bsf.engine = mock.Mock()
 
     def test_colorization(self):
-        self.bsf.prepare_record(self.rc)
-        assert self.colorizer.colorize.call_count == 2
+        ret = self.bsf.prepare_record(self.rc)
 
-    def test_abort(self):
-        self.colorizer.aborting = True
-        self.bsf.prepare_record(self.rc)
-        assert self.colorizer.colorize.call_count == 1
+        self.bsf.engine.colorize.assert_called_once_with('message')
+        assert ret.message is self.bsf.engine.colorize.return_value
 
 
 class TestColorizerColorize:
@@ -134,3 +151,515 @@ class TestColorizerColorize:
 
         assert done is True
         assert ret == '<bold>new<normal> york, <bold>new<normal> york'
+
+
+def colorize_sequentially(colorizers, message):
+    # The colorizers applied one by one, the way the engine has to match.
+    for colorizer in colorizers:
+        done, message = colorizer.colorize(message)
+        if done and colorizer.aborting is True:
+            break
+
+    return message
+
+
+@pytest.fixture
+def colorizers():
+    terminal = blessings.Terminal(kind='xterm-256color', force_styling=True)
+    ret = []
+    for colorizer in COLORIZERS:
+        colorizer = Colorizer(
+            colorizer.regexp.pattern,
+            colorizer.formatting[:-len('{t.normal}')],
+            colorizer.aborting,
+            colorizer.regexp.flags,
+        )
+        colorizer.terminal = terminal
+        ret.append(colorizer)
+
+    return tuple(ret)
+
+
+class TestColorizerEngine:
+    MESSAGES = (
+        '',
+        'nothing to see here',
+        'Collecting requests==2.7.0',
+        'test/test_build.py::TestBuild::test_run PASSED',
+        'test/test_env.py::TestEnv::test_setup FAILED',
+        'PATH=/usr/bin:/bin HOME=/root make',
+        'XFOO=a/b PASSED=1 FAILED',
+        'Error: /tmp/x.py failed',
+        'error: build 3f2504e0-4f89-11d3-9a0c-0305e82c3301 failed',
+        'Warning: deprecated /usr/lib/python3',
+        'warn',
+        'see /tmp/3F2504E0-4F89-11D3-9A0C-0305E82C3301/out.log',
+        'gcc -O2 -Wall -Iinclude -c src/main.c -o build/main.o',
+        'errors\nin two lines',
+        'a/b c/d e/f PASSED PASSED',
+        '{0} {t.normal} }{ not a format string',
+    )
+
+    @pytest.mark.parametrize('message', MESSAGES)
+    def test_identical_output(self, colorizers, message):
+        engine = ColorizerEngine(colorizers)
+
+        expected = colorize_sequentially(colorizers, message)
+        assert engine.colorize(message) == expected
+
+    def test_no_match_returns_message(self, colorizers):
+        engine = ColorizerEngine(colorizers)
+        message = 'nothing to see here'
+
+        assert engine.colorize(message) is message
+
+    def test_non_strings_pass_through(self, colorizers):
+        engine = ColorizerEngine(colorizers)
+        message = object()
+
+        assert engine.colorize(message) is message
+
+    def test_template_is_resolved_once(self):
+        color = Colorizer(r'(voice) (in)', 'silent {t.bold}{0}{{{1}}}')
+        color.terminal = mock.Mock(bold='<bold>', normal='<normal>')
+        engine = ColorizerEngine((color,))
+        color.terminal = None
+
+        assert engine.colorize('a voice in the dark') == (
+            'a silent <bold>voice{in}<normal> the dark'
+        )
+
+    def test_abort(self):
+        first = Colorizer(r'(a)', '<{0}>', True)
+        second = Colorizer(r'(b)', '[{0}]')
+        engine = ColorizerEngine((first, second))
+
+        assert engine.colorize('a b') == '<a> b'
+        assert engine.colorize('b b') == '[b] [b]'
+
+    def test_later_colorizers_see_earlier_output(self):
+        first = Colorizer(r'(x)', 'y{0}')
+        second = Colorizer(r'(y)', '<{0}>')
+        engine = ColorizerEngine((first, second))
+
+        assert engine.colorize('x') == '<y>x'
+
+    def test_literal_skips_search(self):
+        color = Colorizer(r'(a)/', '<{0}>')
+        color.regexp = mock.Mock(pattern=color.regexp.pattern, flags=0)
+        engine = ColorizerEngine((color,))
+
+        assert engine.colorize('nothing') == 'nothing'
+        assert color.regexp.subn.call_count == 0
+
+
+class TestFindLiteral:
+    @pytest.mark.parametrize('pattern,flags,literal', (
+        (r'(\S*/[\S/]+)', 0, '/'),
+        (r'([A-Z]+)(=)', 0, '='),
+        (r'(PASSED)', 0, 'PASSED'),
+        (r'a(?:bc)+d', 0, 'bc'),
+        (r'x(?:yz)?', 0, 'x'),
+        (r'foo|bar', 0, None),
+        (r'^(err(?:or)?)(.*)$', re.I, None),
+        (r'(\w{8}-\w{4})', re.I, '-'),
+        (r'ab-cd', re.I, '-'),
+        (r'[=-]', 0, None),
+    ))
+    def test_find_literal(self, pattern, flags, literal):
+        assert find_literal(re.compile(pattern, flags)) == literal
+
+
+def wait_for(condition, timeout=5):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end, 'timed out'
+        time.sleep(0.001)
+
+
+class TestBatchedFileHandler:
+    def setup_method(self, method):
+        self.log = logbook.Logger('test')
+
+    def get_handler(self, tmpdir, **kwargs):
+        self.filename = str(tmpdir.join('build.log'))
+        return BatchedFileHandler(
+            self.filename, format_string='{record.message}', **kwargs
+        )
+
+    def read(self):
+        with open(self.filename) as f:
+            return f.read().splitlines()
+
+    def test_close_writes_everything_in_order(self, tmpdir):
+        handler = self.get_handler(tmpdir, flush_interval=60)
+
+        with handler.applicationbound():
+            for x in range(1000):
+                self.log.info(str(x))
+        handler.close()
+
+        assert self.read() == [str(x) for x in range(1000)]
+        assert not handler.thread.is_alive()
+
+    def test_flush_by_size(self, tmpdir):
+        handler = self.get_handler(tmpdir, flush_size=4, flush_interval=60)
+
+        with handler.applicationbound():
+            self.log.info('one')
+            self.log.info('two')
+
+        wait_for(lambda: self.read() == ['one', 'two'])
+        handler.close()
+
+    def test_flush_by_time(self, tmpdir):
+        handler = self.get_handler(tmpdir, flush_interval=0.01)
+
+        with handler.applicationbound():
+            self.log.info('one')
+
+        wait_for(lambda: self.read() == ['one'])
+        handler.close()
+
+    def test_flush_waits_for_write(self, tmpdir):
+        handler = self.get_handler(tmpdir, flush_interval=60)
+
+        with handler.applicationbound():
+            self.log.info('one')
+            handler.flush()
+
+            assert self.read() == ['one']
+        handler.close()
+
+    def test_drop_policy(self, tmpdir):
+        handler = self.get_handler(
+            tmpdir, max_queue=1, flush_size=1, policy='drop'
+        )
+
+        # Hold up the writer thread in the middle of its first write.
+        gate = threading.Event()
+        write = handler.write
+
+        def slow_write(batch):
+            gate.wait()
+            write(batch)
+
+        handler.write = slow_write
+
+        with handler.applicationbound():
+            self.log.info('first')
+            wait_for(handler.queue.empty)
+            self.log.info('queued')
+            for x in range(3):
+                self.log.info('dropped')
+
+        gate.set()
+        handler.close()
+
+        assert self.read() == ['first', 'queued', '3 log records dropped']
+
+    def test_records_after_close_are_ignored(self, tmpdir):
+        handler = self.get_handler(tmpdir)
+        handler.close()
+
+        with handler.applicationbound():
+            self.log.info('late')
+        handler.close()
+
+        assert self.read() == []
+
+    def test_compression(self, tmpdir):
+        handler = self.get_handler(tmpdir, compression='gzip')
+
+        with handler.applicationbound():
+            self.log.info('one')
+            self.log.info('two')
+        handler.close()
+
+        assert list(FrameReader(self.filename).lines()) == ['one', 'two']
+
+    def test_emit_output_with_plain_formatter(self, tmpdir):
+        handler = self.get_handler(tmpdir)
+        handler.formatter = PlainFormatter()
+
+        handler.emit_output(logbook.LogRecord('test', logbook.INFO, '1\n2'))
+        handler.close()
+
+        assert self.read() == ['1', '2']
+
+    def test_emit_output_with_other_formatter(self, tmpdir):
+        handler = self.get_handler(tmpdir)
+        handler.format_string = '> {record.message}'
+
+        handler.emit_output(logbook.LogRecord('test', logbook.DEBUG, 'out'))
+        handler.close()
+
+        assert self.read() == ['> out']
+
+    def test_takes_output(self, tmpdir):
+        handler = self.get_handler(tmpdir)
+        assert not handler.takes_output
+
+        handler.formatter = PlainFormatter()
+        assert handler.takes_output
+        handler.close()
+
+    def test_compressed_does_not_take_output(self, tmpdir):
+        handler = self.get_handler(tmpdir, compression='gzip')
+        handler.formatter = PlainFormatter()
+
+        assert not handler.takes_output
+        handler.close()
+
+    def test_unknown_policy(self, tmpdir):
+        with pytest.raises(ValueError):
+            self.get_handler(tmpdir, policy='shrug')
+
+
+class TestDatabaseHandler:
+    def setup_method(self, method):
+        self.log = logbook.Logger('test')
+        self.manager = mock.Mock()
+        self.connect = mock.Mock(return_value=self.manager)
+
+    def get_handler(self, tmpdir, **kwargs):
+        self.spill = str(tmpdir.join('build.spill'))
+        kwargs.setdefault('flush_interval', 60)
+        return DatabaseHandler(self.connect, 'build-id', self.spill, **kwargs)
+
+    def log_lines(self, handler, *messages):
+        with handler.applicationbound():
+            for message in messages:
+                self.log.info(message)
+
+    def inserted(self):
+        return [
+            [record['message'] for record in call[0][0]]
+            for call in self.manager.add.call_args_list
+        ]
+
+    def test_record(self, tmpdir):
+        handler = self.get_handler(tmpdir)
+        self.log_lines(handler, 'one')
+        handler.close()
+
+        record, = self.manager.add.call_args[0][0]
+        assert record['build'] == 'build-id'
+        assert record['seq'] == 0
+        assert record['level'] == 'INFO'
+        assert record['channel'] == 'test'
+        assert record['message'] == 'one'
+        assert record['time'].tzinfo is not None
+
+    def test_batched_by_count(self, tmpdir):
+        handler = self.get_handler(tmpdir, flush_size=2)
+        self.log_lines(handler, 'a', 'b', 'c', 'd', 'e')
+        handler.close()
+
+        assert self.inserted() == [['a', 'b'], ['c', 'd'], ['e']]
+        assert self.connect.call_count == 1
+
+    def test_batched_by_time(self, tmpdir):
+        handler = self.get_handler(tmpdir, flush_interval=0.01)
+        self.log_lines(handler, 'a')
+
+        wait_for(lambda: self.manager.add.call_count == 1)
+        handler.close()
+
+    def test_spill_and_resend_in_order(self, tmpdir):
+        handler = self.get_handler(tmpdir, flush_size=1, retry_interval=0)
+        self.manager.add.side_effect = [ConnectionError(), None, None]
+
+        self.log_lines(handler, 'a')
+        handler.flush()
+        assert os.path.isfile(self.spill)
+
+        self.log_lines(handler, 'b')
+        handler.close()
+
+        assert self.inserted() == [['a'], ['a'], ['b']]
+        assert self.connect.call_count == 2
+        assert not os.path.exists(self.spill)
+
+    def test_no_retry_until_interval(self, tmpdir):
+        handler = self.get_handler(tmpdir, flush_size=1, retry_interval=60)
+        self.connect.side_effect = ConnectionError()
+
+        self.log_lines(handler, 'a', 'b', 'c')
+        handler.close()
+
+        assert self.connect.call_count == 1
+
+        # Everything is left in the spill file for the next try.
+        handler = self.get_handler(tmpdir)
+        self.connect.side_effect = None
+        handler.close()
+        handler.manager = self.manager
+        handler.unspill()
+
+        assert self.inserted() == [['a', 'b', 'c']]
+
+    def test_writer_thread_records_are_not_queued(self, tmpdir):
+        def connect():
+            for _ in range(3):
+                logbook.Logger('driver').info('connecting')
+            return self.manager
+
+        self.connect.side_effect = connect
+        handler = self.get_handler(tmpdir, flush_size=1, max_queue=1)
+
+        with handler.applicationbound():
+            self.log.info('a')
+            wait_for(lambda: self.manager.add.call_count == 1)
+        handler.close()
+
+        assert self.inserted() == [['a']]
+
+    def test_unspill_failing_halfway(self, tmpdir):
+        handler = self.get_handler(tmpdir, flush_size=2)
+        handler.close()
+        handler.spill_records([{'message': 'a'}, {'message': 'b'}])
+        handler.spill_records([{'message': 'c'}])
+
+        handler.manager = self.manager
+        self.manager.add.side_effect = [None, ConnectionError()]
+        with pytest.raises(ConnectionError):
+            handler.unspill()
+
+        self.manager.add.side_effect = None
+        handler.unspill()
+
+        assert self.inserted() == [['a', 'b'], ['c'], ['c']]
+        assert not os.path.exists(self.spill)
+
+
+def make_record(time, level=logbook.INFO, message='hello {0}'):
+    record = logbook.LogRecord('Build : test (1/2)', level, message, ['x'])
+    record.time = time
+    return record
+
+
+class TestPlainFormatter:
+    TIMES = (
+        datetime.datetime(2015, 6, 1, 12, 0, 0, 0),
+        datetime.datetime(2015, 6, 1, 12, 0, 0, 1),
+        datetime.datetime(2015, 6, 1, 12, 0, 0, 999999),
+        datetime.datetime(2015, 6, 1, 12, 0, 1, 500),
+    )
+
+    @pytest.mark.parametrize('time', TIMES)
+    @pytest.mark.parametrize('level', (
+        logbook.DEBUG, logbook.INFO, logbook.WARNING, logbook.CRITICAL,
+    ))
+    def test_same_as_format_string(self, time, level):
+        handler = mock.Mock()
+        record = make_record(time, level)
+        expected = logbook.StringFormatter(DEFAULT_LOGFILE_FORMAT_STRING)
+
+        assert PlainFormatter()(record, handler) == expected(record, handler)
+
+    def test_stamp_is_reused_within_a_second(self):
+        formatter = PlainFormatter()
+        handler = mock.Mock()
+
+        lines = [formatter(make_record(time), handler) for time in self.TIMES]
+
+        assert lines[1].startswith('[2015-06-01 12:00:00.000001] ')
+        assert lines[3].startswith('[2015-06-01 12:00:01.000500] ')
+        assert formatter.stamp[1] == '2015-06-01 12:00:01'
+
+    def test_exception_is_appended(self):
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            record = logbook.LogRecord(
+                'x', logbook.ERROR, 'oops', exc_info=sys.exc_info()
+            )
+            record.time = self.TIMES[0]
+
+        line = PlainFormatter()(record, mock.Mock())
+        assert line.endswith('ZeroDivisionError: division by zero')
+
+    def test_format_output(self):
+        record = make_record(self.TIMES[0], message='raw\noutput')
+        assert PlainFormatter().format_output(record) == 'raw\noutput'
+
+
+class TestGetFormatter:
+    def test_terminal(self):
+        stream = mock.Mock()
+        stream.isatty.return_value = True
+
+        assert isinstance(get_formatter(stream), BSF)
+
+    def test_not_a_terminal(self):
+        stream = mock.Mock()
+        stream.isatty.return_value = False
+
+        assert isinstance(get_formatter(stream), PlainFormatter)
+
+
+class TestJSONFormatter:
+    def setup_method(self, method):
+        self.formatter = JSONFormatter('build-id')
+
+    def format(self, record):
+        return json.loads(self.formatter(record, mock.Mock()))
+
+    def test_fields(self):
+        record = make_record(datetime.datetime.utcnow())
+        record.extra.update(step='lint', step_index=1, command='flake8')
+
+        with mock.patch('time.monotonic', return_value=12.5):
+            data = self.format(record)
+
+        assert data == {
+            'build': 'build-id',
+            'step': 'lint',
+            'step_index': 1,
+            'command': 'flake8',
+            'level': 'INFO',
+            'channel': 'Build : test (1/2)',
+            'monotonic': 12.5,
+            'message': 'hello x',
+        }
+
+    def test_outside_of_steps(self):
+        data = self.format(make_record(datetime.datetime.utcnow()))
+
+        assert data['step'] is None
+        assert data['step_index'] is None
+        assert data['command'] is None
+
+    def test_one_line(self):
+        record = make_record(datetime.datetime.utcnow(), message='a\nb "ö"')
+        line = self.formatter(record, mock.Mock())
+
+        assert '\n' not in line
+        assert json.loads(line)['message'] == 'a\nb "ö"'
+
+    def test_exception(self):
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            record = logbook.LogRecord(
+                'x', logbook.ERROR, 'oops', exc_info=sys.exc_info()
+            )
+
+        data = self.format(record)
+        assert data['exception'].endswith('division by zero')
+
+
+class TestContext:
+    def test_extra_is_added_in_thread(self):
+        log = logbook.Logger('test')
+
+        with logbook.TestHandler() as handler:
+            with context(step='lint', step_index=2).threadbound():
+                log.info('inside')
+            log.info('outside')
+
+        inside, outside = handler.records
+        assert inside.extra['step'] == 'lint'
+        assert inside.extra['step_index'] == 2
+        assert 'step' not in outside.extra
@@ -0,0 +1,137 @@
+import fcntl
+import os
+import sys
+import threading
+
+from piper.pool import VirtualEnvPool
+
+import mock
+import pytest
+
+
+@pytest.fixture
+def pool(tmpdir):
+    return VirtualEnvPool(100, str(tmpdir.mkdir('pool')))
+
+
+def fake_create(size=10):
+    def create(path):
+        os.makedirs(os.path.join(path, 'bin'))
+        with open(os.path.join(path, 'bin', 'python'), 'w') as f:
+            f.write('x' * size)
+
+    return mock.Mock(side_effect=create)
+
+
+class TestVirtualEnvPoolKey:
+    def test_requirements_change_key(self, pool, tmpdir):
+        reqs = tmpdir.join('requirements.txt')
+        reqs.write('six\n')
+
+        before = pool.key(sys.executable, [str(reqs)])
+        assert pool.key(sys.executable, [str(reqs)]) == before
+
+        reqs.write('six\nsh\n')
+        assert pool.key(sys.executable, [str(reqs)]) != before
+
+    def test_interpreter_changes_key(self, pool, tmpdir):
+        other = tmpdir.join('python')
+        other.write('#!/bin/sh\n')
+
+        assert pool.key(sys.executable, []) != pool.key(str(other), [])
+
+
+class TestVirtualEnvPoolAcquire:
+    def test_created_once(self, pool):
+        create = fake_create()
+
+        first = pool.acquire('k', create)
+        pool.release('k')
+        second = pool.acquire('k', create)
+
+        assert first == second == pool.get_path('k')
+        create.assert_called_once_with(first)
+        assert os.path.isfile(os.path.join(first, 'bin', 'python'))
+
+    def test_unfinished_env_is_recreated(self, pool):
+        os.makedirs(os.path.join(pool.get_path('k'), 'junk'))
+        create = fake_create()
+
+        path = pool.acquire('k', create)
+
+        assert create.call_count == 1
+        assert not os.path.exists(os.path.join(path, 'junk'))
+
+    def test_failed_create_releases_lock(self, pool):
+        create = mock.Mock(side_effect=OSError('no space left'))
+
+        with pytest.raises(OSError):
+            pool.acquire('k', create)
+
+        assert pool.locks == {}
+        # Nobody else holds the lock either.
+        lock = pool.lock('k', 'lock', fcntl.LOCK_EX | fcntl.LOCK_NB)
+        lock.close()
+
+    def test_concurrent_acquire_creates_once(self, pool):
+        create = fake_create()
+        paths = []
+
+        def acquire():
+            # A pool per thread, just like one per build.
+            other = VirtualEnvPool(pool.max_size, pool.path)
+            paths.append(other.acquire('k', create))
+
+        threads = [threading.Thread(target=acquire) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+
+        assert create.call_count == 1
+        assert len(set(paths)) == 1
+        assert len(paths) == 8
+
+    def test_failed_create_is_not_finished(self, pool):
+        create = mock.Mock(side_effect=RuntimeError())
+
+        with pytest.raises(RuntimeError):
+            pool.acquire('k', create)
+
+        assert pool.entries() == []
+
+
+class TestVirtualEnvPoolEvict:
+    def fill(self, pool, keys):
+        for x, key in enumerate(keys):
+            marker = os.path.join(
+                pool.acquire(key, fake_create(40)), pool.MARKER
+            )
+            pool.release(key)
+            os.utime(marker, (x, x))
+
+    def test_under_limit(self, pool):
+        self.fill(pool, ('a', 'b'))
+        pool.evict()
+
+        assert sorted(k for _, _, k in pool.entries()) == ['a', 'b']
+
+    def test_least_recently_used_evicted(self, pool):
+        self.fill(pool, ('a', 'b', 'c', 'd'))
+        pool.evict()
+
+        assert sorted(k for _, _, k in pool.entries()) == ['c', 'd']
+        assert not os.path.exists(pool.get_path('a'))
+
+    def test_envs_in_use_are_kept(self, pool):
+        self.fill(pool, ('a', 'b', 'c', 'd'))
+
+        # Another build using 'a'
+        lock = open(os.path.join(pool.path, 'a.lock'), 'a')
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        try:
+            pool.evict()
+        finally:
+            lock.close()
+
+        assert sorted(k for _, _, k in pool.entries()) == ['a', 'd']
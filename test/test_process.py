@@ -1,9 +1,27 @@
-import sh
+import logbook
+import resource
+import signal
+import subprocess
+import threading
+import time
 
+from piper.logging import BatchedFileHandler
+from piper.logging import PlainFormatter
+from piper.logging import context
+from piper.logging import get_file_logger
+from piper.process import SAMPLE
+from piper.process import PROCESSES
+from piper.process import SESSIONS
+from piper.process import BulkOutput
+from piper.process import DirectOutput
 from piper.process import Process
+from piper.process import get_rlimits
+from piper.process import get_rusage
+from piper.process import interrupt_processes
+from piper.process import interrupt_sessions
+from piper.process import wrap_rlimits
 
 from mock import Mock
-from mock import MagicMock
 from mock import patch
 import pytest
 
@@ -11,40 +29,547 @@ import pytest
 @pytest.fixture
 def proc():
     proc = Process(Mock(), '/path/to/cmd', 'logkey')
-    proc.sh = MagicMock()
+    proc.log = Mock()
 
     return proc
 
 
+def spawn(proc, cmd):
+    proc.cmd = cmd
+    proc.setup()
+    return proc
+
+
+def logged(proc):
+    return [call[0][0] for call in proc.log.info.call_args_list]
+
+
 class TestProcessSetup:
     def setup_method(self, method):
-        self.proc = Process(Mock(), '/usr/bin/empathy world hide', 'key')
+        self.proc = Process(Mock(), '/usr/bin/empathy "world hide"', 'key')
+
+    @patch('subprocess.Popen')
+    def test_setup(self, Popen):
+        self.proc.setup()
+
+        Popen.assert_called_once_with(
+            ['/usr/bin/empathy', 'world hide'],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        assert self.proc.popen is Popen.return_value
+
+    @patch('subprocess.Popen')
+    def test_setup_environ(self, Popen):
+        self.proc.environ = {'PATH': '/venv/bin'}
+        self.proc.setup()
 
-    @patch('sh.Command')
-    def test_setup(self, Command):
+        assert Popen.call_args[1]['env'] is self.proc.environ
+
+    @patch('subprocess.Popen')
+    def test_setup_missing_command(self, Popen):
+        Popen.side_effect = FileNotFoundError()
         self.proc.setup()
+        self.proc.run()
 
-        Command.assert_called_once_with('/usr/bin/empathy')
+        assert self.proc.popen is None
+        assert self.proc.success is False
 
 
 class TestProcessRun:
     def test_run_failure(self, proc):
-        proc.sh.__iter__.side_effect = sh.ErrorReturnCode(
-            '/cmd', MagicMock(), MagicMock()
+        spawn(proc, 'false').run()
+
+        assert proc.success is False
+
+    def test_run_success(self, proc):
+        spawn(proc, 'true').run()
+
+        assert proc.success is True
+
+    def test_run_with_output(self, proc):
+        spawn(proc, 'printf "1\\n a \\nlast"').run()
+
+        assert proc.success is True
+        assert logged(proc) == ['1', 'a', 'last']
+
+    def test_stderr_is_logged_as_it_arrives(self, proc):
+        spawn(proc, 'sh -c "echo out; echo err >&2; exit 3"').run()
+
+        assert proc.success is False
+        assert sorted(logged(proc)) == ['err', 'out']
+
+    def test_long_lines_are_split(self, proc):
+        proc.line_limit = 10
+        proc.chunk_size = 4
+        spawn(proc, 'printf "%050d\\nok"').run()
+
+        lines = logged(proc)
+        assert ''.join(lines[:-1]) == '0' * 50
+        assert all(len(line) <= 14 for line in lines)
+        assert lines[-1] == 'ok'
+
+    def test_run_in_thread(self, proc):
+        thread = threading.Thread(target=spawn(proc, 'echo hi').run)
+        thread.start()
+        thread.join(5)
+
+        assert proc.success is True
+        assert logged(proc) == ['hi']
+
+
+class TestProcessWait:
+    def test_exitcode_and_rusage(self, proc):
+        spawn(proc, 'sh -c "exit 3"').run()
+
+        assert proc.popen.returncode == 3
+        assert proc.success is False
+        assert proc.rusage['max_rss'] > 0
+        assert set(proc.rusage) == {
+            'user', 'system', 'max_rss', 'blocks_in', 'blocks_out',
+            'voluntary_switches', 'involuntary_switches',
+        }
+
+    def test_killed(self, proc):
+        spawn(proc, 'sh -c "kill -9 $$"').run()
+
+        assert proc.popen.returncode == -9
+
+    def test_timeout(self, proc):
+        spawn(proc, 'sleep 5')
+
+        assert proc.wait(0.01) is False
+        assert proc.rusage is None
+
+        proc.popen.kill()
+        assert proc.wait() is True
+        assert proc.rusage is not None
+
+    def test_reaped_elsewhere(self, proc):
+        spawn(proc, 'true').popen.wait()
+        proc.popen.returncode = None
+
+        assert proc.wait() is True
+        assert proc.rusage is None
+
+
+class TestGetRusage:
+    @patch('sys.platform', 'linux')
+    def test_get_rusage(self):
+        rusage = Mock(
+            ru_utime=1.5, ru_stime=0.5, ru_maxrss=2048, ru_inblock=10,
+            ru_oublock=20, ru_nvcsw=30, ru_nivcsw=40,
         )
+
+        assert get_rusage(rusage) == {
+            'user': 1.5,
+            'system': 0.5,
+            'max_rss': 2 ** 21,
+            'blocks_in': 10,
+            'blocks_out': 20,
+            'voluntary_switches': 30,
+            'involuntary_switches': 40,
+        }
+
+
+class TestProcessLimits:
+    def get_proc(self, cmd, **limits):
+        proc = Process(Mock(), cmd, 'logkey', limits=limits)
+        proc.log = Mock()
+        return spawn(proc, cmd)
+
+    def test_timeout_kills_the_process_group(self):
+        # The background sleep keeps the pipes open unless it is killed too.
+        proc = self.get_proc('sh -c "sleep 10 & sleep 10"', timeout=0.2)
+
+        start = time.monotonic()
         proc.run()
 
+        assert time.monotonic() - start < 5
         assert proc.success is False
+        assert proc.killed == 'Timed out after 0.2 seconds'
+        proc.log.error.assert_called_once_with(
+            'Timed out after 0.2 seconds. Killing it.'
+        )
 
-    def test_run_success(self, proc):
-        proc.sh.exit_code = 0
+    def test_idle_timeout(self):
+        proc = self.get_proc('sh -c "echo 1; sleep 10"', idle_timeout=0.2)
+        proc.run()
+
+        assert proc.success is False
+        assert proc.killed == 'No output for 0.2 seconds'
+        assert logged(proc) == ['1']
+
+    def test_output_resets_idle_timeout(self):
+        proc = self.get_proc(
+            'sh -c "for i in 1 2 3 4 5; do echo $i; sleep 0.1; done"',
+            idle_timeout=0.5,
+        )
         proc.run()
 
         assert proc.success is True
+        assert proc.killed is None
 
-    def test_run_with_output(self, proc):
-        proc.sh.__iter__ = Mock(return_value=iter(['1', 'a']))
-        proc.sh.exit_code = 0
+    def test_timeout_with_direct_output(self, tmpdir):
+        handler = BatchedFileHandler(str(tmpdir.join('build.log')))
+        handler.formatter = PlainFormatter()
+
+        proc = Process(
+            Mock(), 'sleep 10', 'logkey', {'mode': 'direct'}, handler,
+            {'timeout': 0.2},
+        )
+        spawn(proc, 'sleep 10').run()
+        handler.close()
+
+        assert proc.success is False
+        assert proc.killed == 'Timed out after 0.2 seconds'
+
+    def test_rlimits(self):
+        proc = self.get_proc(
+            'sh -c "ulimit -n; ulimit -t; ulimit -v"',
+            files=64, cpu=5, memory=2 ** 30,
+        )
         proc.run()
 
         assert proc.success is True
+        assert logged(proc) == ['64', '5', str(2 ** 20)]
+
+    def test_rlimits_missing_command(self, tmpdir):
+        handler = BatchedFileHandler(str(tmpdir.join('build.log')))
+        handler.formatter = PlainFormatter()
+
+        proc = Process(
+            Mock(), 'nope', 'logkey', {'mode': 'direct'}, handler,
+            {'files': 64},
+        )
+        spawn(proc, 'nope-not-a-command').run()
+        handler.close()
+
+        assert proc.success is False
+        with open(handler.filename) as f:
+            assert 'Could not start process' in f.read()
+
+    @patch('subprocess.Popen')
+    def test_setup(self, Popen):
+        proc = self.get_proc('true', timeout=1, files=64)
+
+        args, kwargs = Popen.call_args
+        assert kwargs['start_new_session'] is True
+        assert 'preexec_fn' not in kwargs
+        assert args[0] == wrap_rlimits(
+            ['true'], [(resource.RLIMIT_NOFILE, (64, 64))]
+        )
+        assert proc.popen.pid in SESSIONS
+        assert proc.popen.pid in PROCESSES
+        SESSIONS.discard(proc.popen.pid)
+        PROCESSES.discard(proc.popen.pid)
+
+    @patch('subprocess.Popen')
+    def test_setup_failing(self, Popen):
+        Popen.side_effect = subprocess.SubprocessError()
+        proc = self.get_proc('true', files=64)
+
+        assert proc.popen is None
+        assert proc.success is False
+
+    def test_interrupt_reaches_session(self, tmpdir):
+        handler = BatchedFileHandler(str(tmpdir.join('build.log')))
+        handler.formatter = PlainFormatter()
+
+        proc = Process(
+            Mock(), 'sleep 10', 'logkey', {'mode': 'direct'}, handler,
+            {'timeout': 10},
+        )
+        spawn(proc, 'sleep 10')
+        timer = threading.Timer(0.2, interrupt_sessions)
+        timer.start()
+
+        start = time.monotonic()
+        proc.run()
+        handler.close()
+
+        assert time.monotonic() - start < 5
+        assert proc.popen.returncode == -signal.SIGINT
+        assert proc.popen.pid not in SESSIONS
+
+    @patch('piper.process.PROCESSES', new_callable=set)
+    def test_interrupt_reaches_process(self, processes, tmpdir):
+        handler = BatchedFileHandler(str(tmpdir.join('build.log')))
+        handler.formatter = PlainFormatter()
+
+        proc = Process(
+            Mock(), 'sleep 10', 'logkey', {'mode': 'direct'}, handler,
+        )
+        spawn(proc, 'sleep 10')
+        assert processes == {proc.popen.pid}
+        timer = threading.Timer(0.2, interrupt_processes)
+        timer.start()
+
+        start = time.monotonic()
+        proc.run()
+        handler.close()
+
+        assert time.monotonic() - start < 5
+        assert proc.popen.returncode == -signal.SIGINT
+        assert processes == set()
+
+
+class TestGetRlimits:
+    def test_empty(self):
+        assert get_rlimits({}) == []
+
+    @patch('resource.getrlimit')
+    def test_capped_at_hard_limit(self, getrlimit):
+        getrlimit.return_value = (10, 100)
+        assert get_rlimits({'files': 1000}) == [
+            (resource.RLIMIT_NOFILE, (100, 100)),
+        ]
+
+    @patch('resource.getrlimit')
+    def test_unlimited(self, getrlimit):
+        getrlimit.return_value = (10, resource.RLIM_INFINITY)
+        assert get_rlimits({'cpu': 1000}) == [
+            (resource.RLIMIT_CPU, (1000, 1000)),
+        ]
+
+
+class TestProcessContext:
+    def test_command_is_added_to_output(self):
+        proc = Process(Mock(), 'echo hi', 'logkey')
+
+        with logbook.TestHandler() as handler:
+            spawn(proc, 'echo hi').run()
+
+        output, = [r for r in handler.records if r.message == 'hi']
+        assert output.extra['command'] == 'echo hi'
+
+
+class TestProcessBulkOutput:
+    def setup_method(self, method):
+        self.handler = Mock()
+        self.output = {'mode': 'bulk', 'rate': 0, 'tail': 2}
+
+    def written(self):
+        return [
+            call[0][0].message
+            for call in self.handler.emit_output.call_args_list
+        ]
+
+    def test_output_goes_to_the_handler(self):
+        proc = Process(Mock(), 'echo', 'logkey', self.output, self.handler)
+        proc.log = proc.output.log = Mock()
+        spawn(proc, 'printf "1\\n2\\n3"').run()
+
+        assert '\n'.join(self.written()) == '1\n2\n3'
+        assert logged(proc) == ['3 lines of output written to the build log']
+
+    def test_tail_is_logged_on_failure(self):
+        proc = Process(Mock(), 'echo', 'logkey', self.output, self.handler)
+        proc.log = proc.output.log = Mock()
+        spawn(proc, 'sh -c "printf \'1\\n2\\n3\\n\'; exit 1"').run()
+
+        assert proc.success is False
+        proc.log.error.assert_called_once_with(
+            'Last 2 of 3 lines of output:', extra=SAMPLE
+        )
+        assert logged(proc) == ['2', '3']
+
+    def test_log_mode(self):
+        self.output['mode'] = 'log'
+        proc = Process(Mock(), 'echo', 'logkey', self.output, self.handler)
+
+        assert proc.output is None
+
+    def test_no_handler(self):
+        proc = Process(Mock(), 'echo', 'logkey', self.output)
+
+        assert proc.output is None
+
+    def test_direct_mode_falls_back_to_bulk(self):
+        self.output['mode'] = 'direct'
+        self.handler.takes_output = False
+        proc = Process(Mock(), 'echo', 'logkey', self.output, self.handler)
+
+        assert isinstance(proc.output, BulkOutput)
+
+
+class TestProcessDirectOutput:
+    def setup_method(self, method):
+        self.output = {'mode': 'direct', 'rate': 0, 'tail': 2}
+
+    def get_handler(self, tmpdir):
+        self.filename = str(tmpdir.join('build.log'))
+        handler = BatchedFileHandler(
+            self.filename, format_string='{record.message}'
+        )
+        handler.formatter = PlainFormatter()
+        return handler
+
+    def get_proc(self, handler, cmd):
+        proc = Process(Mock(), 'echo', 'logkey', self.output, handler)
+        proc.log = proc.output.log = Mock()
+        return spawn(proc, cmd)
+
+    def read(self):
+        with open(self.filename) as f:
+            return f.read()
+
+    def test_output_goes_to_the_file(self, tmpdir):
+        handler = self.get_handler(tmpdir)
+        handler.emit_output(logbook.LogRecord('test', logbook.INFO, 'before'))
+
+        proc = self.get_proc(handler, 'sh -c "echo 1; echo 2 >&2; echo 3"')
+        proc.run()
+        handler.close()
+
+        assert proc.success is True
+        assert self.read() == 'before\n1\n2\n3\n'
+        assert logged(proc) == ['6 bytes of output written to the build log']
+        assert proc.output.file.closed
+
+    def test_tail_is_logged_on_failure(self, tmpdir):
+        handler = self.get_handler(tmpdir)
+
+        proc = self.get_proc(handler, 'sh -c "printf \'1\\n2\\n3\'; exit 1"')
+        proc.run()
+        handler.close()
+
+        assert proc.success is False
+        proc.log.error.assert_called_once_with(
+            'Last 2 lines of output:', extra=SAMPLE
+        )
+        assert logged(proc) == ['2', '3']
+
+    def test_output_is_sampled(self, tmpdir):
+        handler = self.get_handler(tmpdir)
+        self.output['rate'] = 100
+
+        proc = self.get_proc(handler, 'sh -c "echo 1; sleep 0.2"')
+        proc.run()
+        handler.close()
+
+        assert logged(proc)[0] == '1'
+
+    def run_logged(self, tmpdir, cmd):
+        """
+        Run a process with the build log handler pushed like a build does.
+        Returns what the console got.
+
+        """
+
+        handler = get_file_logger(str(tmpdir.join('build.log')))
+        self.filename = handler.filename
+        self.output['rate'] = 100
+
+        with logbook.TestHandler(level=logbook.INFO) as console:
+            with handler.applicationbound():
+                proc = Process(Mock(), 'echo', 'logkey', self.output, handler)
+                spawn(proc, cmd).run()
+            handler.close()
+
+        return proc, [r.message for r in console.records]
+
+    def test_samples_stay_out_of_the_file(self, tmpdir):
+        proc, console = self.run_logged(tmpdir, 'sh -c "echo 1; sleep 0.3"')
+
+        assert proc.success is True
+        assert '1' in console
+        assert self.read().splitlines()[0] == '1'
+        assert ': 1' not in self.read()
+
+    def test_tail_stays_out_of_the_file(self, tmpdir):
+        proc, console = self.run_logged(
+            tmpdir, 'sh -c "echo 1; echo 2; exit 1"'
+        )
+
+        assert proc.success is False
+        assert console[-3:] == ['Last 2 lines of output:', '1', '2']
+        assert self.read() == '1\n2\n'
+
+    @patch('subprocess.Popen')
+    def test_setup(self, Popen, tmpdir):
+        handler = self.get_handler(tmpdir)
+        proc = self.get_proc(handler, 'true')
+        handler.close()
+
+        Popen.assert_called_once_with(
+            ['true'],
+            stdin=subprocess.DEVNULL,
+            stdout=proc.output.file,
+            stderr=subprocess.STDOUT,
+        )
+
+    @patch('subprocess.Popen')
+    def test_setup_missing_command(self, Popen, tmpdir):
+        Popen.side_effect = FileNotFoundError()
+        handler = self.get_handler(tmpdir)
+        proc = self.get_proc(handler, 'true')
+        proc.run()
+        handler.close()
+
+        assert proc.success is False
+        assert proc.output.file.closed
+
+
+class TestBulkOutput:
+    def setup_method(self, method):
+        self.log = logbook.Logger('logkey')
+        self.handler = Mock()
+
+    def test_write_samples_lines(self):
+        output = BulkOutput(self.log, self.handler, rate=1)
+
+        with logbook.TestHandler() as handler:
+            output.write([b'1', b'2'])
+            output.write([b'3'])
+
+        assert [r.message for r in handler.records] == ['2']
+        assert output.lines == 3
+
+    def test_write_record_has_context(self):
+        output = BulkOutput(self.log, self.handler)
+
+        with context(command='make').threadbound():
+            output.write([b'1', b'2'])
+
+        record = self.handler.emit_output.call_args[0][0]
+        assert record.message == '1\n2'
+        assert record.channel == 'logkey'
+        assert record.extra['command'] == 'make'
+
+    def test_tail_is_bounded(self):
+        output = BulkOutput(self.log, self.handler, rate=0, tail=2)
+        output.write([b'1', b'2', b'3'])
+
+        assert list(output.tail) == [b'2', b'3']
+
+    def test_close_success(self):
+        output = BulkOutput(self.log, self.handler, rate=0)
+        output.write([b'1'])
+
+        with logbook.TestHandler() as handler:
+            output.close(True)
+
+        assert [r.message for r in handler.records] == [
+            '1 lines of output written to the build log',
+        ]
+
+
+class TestDirectOutput:
+    def test_read_tail(self, tmpdir):
+        filename = str(tmpdir.join('build.log'))
+        with open(filename, 'w') as f:
+            f.write('earlier\n')
+
+        output = DirectOutput(Mock(), Mock(filename=filename))
+        output.block_size = 3
+        with output.open() as f:
+            f.write(b'1\n22\n333\n4444')
+            f.flush()
+
+            assert output.read_tail(3) == [b'22', b'333', b'4444']
+            assert output.read_tail(10) == [b'1', b'22', b'333', b'4444']
+            assert output.read_tail(0) == []
+
+        output.handler.flush.assert_called_once_with()
@@ -47,6 +47,20 @@ class TestStepSchema(StepTest):
         self.step.config['requirements'] = None
         self.step.validate()
 
+    def test_validate_with_bulk_output(self):
+        self.step.config['output'] = {'mode': 'bulk', 'rate': 1, 'tail': 5}
+        self.step.validate()
+
+    def test_validate_with_limits(self):
+        self.step.config['limits'] = {
+            'timeout': 60,
+            'idle_timeout': 1.5,
+            'memory': 2 ** 30,
+            'cpu': 60,
+            'files': 256,
+        }
+        self.step.validate()
+
 
 class TestStepSetIndex(StepTest):
     def test_set_index(self):
@@ -0,0 +1,59 @@
+import json
+import threading
+
+from piper.trace import Tracer
+
+import pytest
+
+
+@pytest.fixture
+def tracer(tmpdir):
+    return Tracer(str(tmpdir.join('trace.json')))
+
+
+def complete_events(tracer):
+    return [e for e in tracer.events if e['ph'] == 'X']
+
+
+class TestTracerComplete:
+    def test_event(self, tracer):
+        tracer.complete('setup_env', 'phase', 2.0, 0.5)
+
+        event, = complete_events(tracer)
+        assert event == {
+            'name': 'setup_env',
+            'cat': 'phase',
+            'ph': 'X',
+            'ts': 2000000.0,
+            'dur': 500000.0,
+            'pid': tracer.pid,
+            'tid': threading.current_thread().ident,
+        }
+
+    def test_explicit_pid_and_args(self, tracer):
+        tracer.complete('ls', 'process', 1, 1, pid=42, tid=42, args={'a': 1})
+
+        event, = complete_events(tracer)
+        assert event['pid'] == 42
+        assert event['tid'] == 42
+        assert event['args'] == {'a': 1}
+
+    def test_threads_are_named_once(self, tracer):
+        tracer.complete('a', 'step', 1, 1)
+        tracer.complete('b', 'step', 2, 1)
+
+        names = [e for e in tracer.events if e['name'] == 'thread_name']
+        assert len(names) == 1
+        assert names[0]['args'] == {'name': threading.current_thread().name}
+
+
+class TestTracerWrite:
+    def test_write(self, tracer):
+        tracer.complete('setup_env', 'phase', 2.0, 0.5)
+        tracer.write()
+
+        with open(tracer.filename) as f:
+            data = json.load(f)
+
+        assert data['traceEvents'] == tracer.events
+        assert data['displayTimeUnit'] == 'ms'